@@ -1,3 +1,4 @@
+import re
 from string import Template
 
 CANNOT_PARSE_AUGMENTED_MANIFEST = Template('An augmented manifest file in your request is an invalid JSON file. '
@@ -20,3 +21,30 @@ EMPTY_LABEL_UNSUPPORTED = \
 LABEL_TOO_BIG = Template(
     'The maximum size of an individual label is ${size} characters. The label '
     'on line: ${line} of file: ${file} was greater than the maximum size.')
+
+CONFLICTING_DUPLICATE = Template(
+    'The document on line: ${line} of file: ${file} is a duplicate of an earlier document with different labels. '
+    'Remove one of them or make their labels agree.')
+
+
+class CustomerError(Exception):
+    # error_type is the name of the template the message was built from; errors holds every violation found on the line
+    # when the converter collects all of them instead of stopping at the first one
+    def __init__(self, error_type, line, message, errors=None):
+        super().__init__(message)
+        self.error_type = error_type
+        self.line = line
+        self.message = message
+        self.errors = errors or [self]
+
+    def __reduce__(self):
+        # the errors are returned by the worker processes, errors defaulting to [self] is rebuilt by __init__
+        errors = None if self.errors == [self] else self.errors
+        return type(self), (self.error_type, self.line, self.message, errors)
+
+    def rebase(self, line_offset):
+        # the error of a shard numbered from another line: the templates write the line as "line N" or "line: N"
+        line = self.line + line_offset
+        message = re.sub(rf'\bline(:?) {self.line}\b', rf'line\g<1> {line}', self.message)
+        errors = None if self.errors == [self] else [error.rebase(line_offset) for error in self.errors]
+        return type(self)(self.error_type, line, message, errors)
@@ -0,0 +1,72 @@
+from hashlib import blake2b
+
+FRACTION_BITS = 32
+TEST_DATASET_SUFFIX = '_test'
+
+"""
+    Splits the rows of the dataset into a train and a test dataset while they are written, stratified by their class,
+    or by their set of labels for MULTI_LABEL. The rows of a stratum are assigned systematically: the n-th row of the
+    stratum goes to the test dataset when floor((n + 1) * f + phase) > floor(n * f + phase), with f the test fraction
+    and phase a hash of the seed and the stratum in [0, 1). Every stratum of n rows thus has floor(n * f) or
+    ceil(n * f) test rows, and the phase spreads the rounding over the strata instead of always giving their first row
+    to the train dataset. Only a row count per stratum is kept. The assignment of a row depends on the seed and the rows
+    of its stratum before it, so it is reproducible and does not change when lines are appended to the manifest; the
+    counts are kept in the checkpoint of an incremental conversion. Fixed point arithmetic keeps it exact.
+    Example: with f = 0.25 and phase = 0.5, the rows 1, 5, 9... of a stratum, counted from 0, go to the test dataset.
+"""
+
+
+def test_dataset_name(name):
+    # dataset.csv gives dataset_test.csv
+    stem, dot, extension = name.rpartition('.')
+    return stem + TEST_DATASET_SUFFIX + dot + extension if dot else name + TEST_DATASET_SUFFIX
+
+
+def row_labels(row):
+    # the labels of a dataset row: the source is written with every quote escaped, so the last ," of the row starts it
+    return row[:row.rindex(',"')]
+
+
+class StratifiedSplit:
+
+    def __init__(self, test_fraction, seed=0, label_delimiter=None):
+        self.test_fraction = round(test_fraction * (1 << FRACTION_BITS))
+        self.seed = seed
+        self.label_delimiter = label_delimiter
+        self.counts = {}
+        self.number_of_test_rows = 0
+
+    def stratum(self, labels):
+        if self.label_delimiter is None:
+            return labels
+        return self.label_delimiter.join(sorted(set(labels.split(self.label_delimiter))))
+
+    def is_test(self, labels):
+        # assign the next row with these labels, True when it goes to the test dataset
+        stratum = self.stratum(labels)
+        count, phase = self.counts.get(stratum) or (0, self._phase(stratum))
+        self.counts[stratum] = count + 1, phase
+        is_test = ((count + 1) * self.test_fraction + phase) >> FRACTION_BITS > \
+            (count * self.test_fraction + phase) >> FRACTION_BITS
+        self.number_of_test_rows += is_test
+        return is_test
+
+    def _phase(self, stratum):
+        return int.from_bytes(blake2b(f"{self.seed}\n{stratum}".encode('utf8'), digest_size=FRACTION_BITS // 8).digest(),
+                              'little')
+
+    def get_state(self):
+        return {'test_fraction': self.test_fraction, 'seed': self.seed,
+                'counts': [[stratum, count] for stratum, (count, _) in self.counts.items()],
+                'number_of_test_rows': self.number_of_test_rows}
+
+    def set_state(self, state):
+        # resume from the state saved by get_state. False when it was saved with another seed or test fraction, the
+        # split then starts over
+        if state is None or state['test_fraction'] != self.test_fraction or state['seed'] != self.seed:
+            self.counts = {}
+            self.number_of_test_rows = 0
+            return False
+        self.counts = {stratum: (count, self._phase(stratum)) for stratum, count in state['counts']}
+        self.number_of_test_rows = state['number_of_test_rows']
+        return True
@@ -1,45 +1,322 @@
+import hashlib
+import io
 import json
+import os
+import shutil
+import sys
 import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from urllib.parse import urlparse
 
 from groundtruth_to_comprehend_clr_format_converter import GroundTruthToComprehendCLRFormatConverter
+from manifest_shards import ManifestShard, ManifestShardLines, plan_manifest_shards, iter_manifest_shard_lines
+from manifest_index import open_manifest_index
+from conversion_checkpoint import ConversionCheckpoint, find_complete_lines_end
+from error_report import ErrorReport
+from dataset_split import StratifiedSplit, row_labels, test_dataset_name
+from label_statistics import LabelStatistics, MINIMUM_EXAMPLES_PER_CLASS, document_size
+from document_deduplication import DocumentDeduplicator, DEDUPLICATION_POLICIES, NEW_DOCUMENT, DUPLICATE_DOCUMENT, \
+    CONFLICTING_DOCUMENT, UNION
+from customer_errors import CANNOT_PARSE_AUGMENTED_MANIFEST, CONFLICTING_DUPLICATE, CustomerError
+from storage import get_storage
+
+GROUNDTRUTH_MANIFEST_FILE_NAME = 'output.manifest'
+MULTI_CLASS = 'MULTI_CLASS'
+MULTI_LABEL = 'MULTI_LABEL'
+WRITE_BUFFER_SIZE = 1024 * 1024
 
 
 class GroundTruthToCLRFormatConversionHandler:
 
     def __init__(self):
         self.convert_object = GroundTruthToComprehendCLRFormatConverter()
+        self.manifest_uri = GROUNDTRUTH_MANIFEST_FILE_NAME
         self.dataset_filename = ""
+        # with upload, the dataset is streamed to the output S3Uri instead of being written to a local file
+        self.upload = False
+        self.dataset_uri = ""
+        self.error_report = None
+        # with a checkpoint, only the manifest lines appended since the previous run are converted
+        self.checkpoint = None
+        self.converted_lines = 0
+        # number of manifest lines read by this run, converted or not, for the summary of the error report. With a
+        # checkpoint the run starts at manifest line first_manifest_line
+        self.manifest_lines = 0
+        self.first_manifest_line = 0
+        # with a DocumentDeduplicator, a document whose text was already converted is dropped. With the union policy,
+        # merged_labels holds the length of the written source and the labels of the duplicates of a row
+        self.deduplicator = None
+        self.merged_labels = {}
+        # with LabelStatistics, the labels and document sizes of the written rows are counted
+        self.label_statistics = None
+        # with a StratifiedSplit, the rows assigned to the test dataset are written to the test dataset file instead
+        self.split = None
+        self.test_dataset_filename = ""
+        self.test_dataset_uri = ""
 
     def validate_s3_input(self, args):
         dataset_output_S3Uri = args.dataset_output_S3Uri
+        self.dataset_uri = dataset_output_S3Uri
 
         dataset_url = urlparse(dataset_output_S3Uri)
         dataset_scheme = dataset_url.scheme
         self.dataset_filename = dataset_url.path.split("/")[-1]
+        self.test_dataset_uri = test_dataset_name(dataset_output_S3Uri)
+        self.test_dataset_filename = test_dataset_name(self.dataset_filename)
 
         print(self.dataset_filename)
+        if self.split is not None:
+            print(self.test_dataset_filename)
 
         if dataset_scheme != "s3" or self.dataset_filename.split(".")[-1] != "csv":
             raise Exception("Either of the output S3 lo cation provided is incorrect!")
 
-    def read_write_multiclass_dataset(self):
-        with open('output.manifest', 'r', encoding='utf-8') as groundtruth_output_file, \
-                open(self.dataset_filename, 'a', encoding='utf8') as multiclass_dataset:
-            for index, jsonLine in enumerate(groundtruth_output_file):
-                class_name, source = self.convert_object.convert_to_multiclass_dataset(index, jsonLine)
-                source = json.dumps(source).strip('"')
-                multiclass_dataset.write(class_name + ',"' + source + '"')
-                multiclass_dataset.write("\n")
-
-    def read_write_multilabel_dataset(self, label_delimiter):
-        with open('output.manifest', 'r', encoding='utf-8') as groundtruth_output_file, \
-                open(self.dataset_filename, 'a', encoding='utf8') as multilabel_dataset:
-            for index, jsonLine in enumerate(groundtruth_output_file):
-                labels, source = self.convert_object.convert_to_multilabel_dataset(index, jsonLine, label_delimiter)
+    @contextmanager
+    def open_dataset(self, newline=None, test=False):
+        # open the dataset output once: an appended local file, or a multipart upload to S3. The text layer writes
+        # through to the buffered stream, so bytes written to dataset.buffer stay in order with the text. It is
+        # detached instead of closed, so that the stream is closed by its own context, which aborts an S3 upload when
+        # the conversion fails
+        if self.upload:
+            dataset_uri = self.test_dataset_uri if test else self.dataset_uri
+            dataset_stream = get_storage(dataset_uri).open_write(dataset_uri)
+        else:
+            dataset_stream = open(self.test_dataset_filename if test else self.dataset_filename, 'ab',
+                                  buffering=WRITE_BUFFER_SIZE)
+        with dataset_stream:
+            dataset = io.TextIOWrapper(dataset_stream, encoding='utf8', newline=newline, write_through=True)
+            try:
+                yield dataset
+            finally:
+                dataset.detach()
+
+    @contextmanager
+    def open_datasets(self, newline=None):
+        # the dataset and, with a split, the test dataset, None otherwise
+        with self.open_dataset(newline) as dataset:
+            if self.split is None:
+                yield dataset, None
+            else:
+                with self.open_dataset(newline, test=True) as test_dataset:
+                    yield dataset, test_dataset
+
+    def read_write_multiclass_dataset(self, workers=1):
+        self.read_write_dataset(MULTI_CLASS, None, workers)
+
+    def read_write_multilabel_dataset(self, label_delimiter, workers=1):
+        self.read_write_dataset(MULTI_LABEL, label_delimiter, workers)
+
+    def read_write_dataset(self, mode, label_delimiter, workers=1, start=0, end=None, first_line=0):
+        # convert the manifest lines in the byte range [start, end), the first of them being line first_line
+        if self.checkpoint is not None and end is None:
+            self.read_write_dataset_incrementally(mode, label_delimiter, workers)
+            return
+        if workers > 1:
+            self.read_write_dataset_shards(mode, label_delimiter, workers, start, end, first_line)
+            return
+        storage = get_storage(self.manifest_uri)
+        dataset_start = os.path.getsize(self.dataset_filename) if os.path.exists(self.dataset_filename) else 0
+        with self.open_datasets() as (dataset, test_dataset):
+            if start == 0 and end is None:
+                with storage.open_read(self.manifest_uri) as groundtruth_output_file:
+                    self.convert_manifest_lines(mode, label_delimiter, groundtruth_output_file, dataset,
+                                                test_dataset=test_dataset)
+            else:
+                end = storage.size(self.manifest_uri) if end is None else end
+                shard = ManifestShard(start, end, first_line)
+                self.convert_manifest_lines(mode, label_delimiter,
+                                            iter_manifest_shard_lines(storage, self.manifest_uri, shard),
+                                            dataset, first_line, test_dataset)
+        if self.merged_labels:
+            self.merge_duplicate_labels(label_delimiter, dataset_start)
+
+    def read_write_dataset_incrementally(self, mode, label_delimiter, workers=1):
+        # resume from the checkpoint when the manifest only grew since it was saved, rebuild the dataset otherwise.
+        # Only complete lines are converted, a last line without newline may still be written and waits for the next run.
+        storage = get_storage(self.manifest_uri)
+        output_filenames = [self.dataset_filename] + ([self.test_dataset_filename] if self.split is not None else [])
+        checkpoint = self.checkpoint
+        prefix_hash = None
+        if checkpoint.load():
+            prefix_hash = checkpoint.verify_prefix(storage, self.manifest_uri, output_filenames)
+            # the rows are assigned again when the split was saved with another seed or test fraction
+            if self.split is not None and not self.split.set_state(checkpoint.state.get('split')):
+                prefix_hash = None
+        if prefix_hash is None:
+            checkpoint = self.checkpoint = ConversionCheckpoint(checkpoint.filename)
+            prefix_hash = hashlib.sha256()
+            for output_filename in output_filenames:
+                open(output_filename, 'w').close()
+        else:
+            checkpoint.truncate_outputs()
+        self.converted_lines = checkpoint.dataset_line
+        self.first_manifest_line = checkpoint.line_index
+
+        file_size = storage.size(self.manifest_uri)
+        complete_end = find_complete_lines_end(storage, self.manifest_uri, checkpoint.manifest_offset, file_size)
+        self.read_write_dataset(mode, label_delimiter, workers, checkpoint.manifest_offset, complete_end,
+                                checkpoint.line_index)
+        checkpoint.advance(storage, self.manifest_uri, complete_end, prefix_hash, self.converted_lines,
+                           output_filenames, {'split': self.split.get_state()} if self.split is not None else None)
+        if complete_end < file_size:
+            print(f"The last {file_size - complete_end} bytes of the manifest are not a complete line yet, they are "
+                  f"converted by the next run", file=sys.stderr)
+
+    def read_write_dataset_shards(self, mode, label_delimiter, workers, start=0, end=None, first_line=0):
+        with open_manifest_index(self.manifest_uri) as manifest_index:
+            shards = plan_manifest_shards(get_storage(self.manifest_uri), self.manifest_uri, workers, start, end,
+                                          first_line, manifest_index)
+        report_errors = self.error_report is not None
+        error_extension = os.path.splitext(self.error_report.filename)[1] if report_errors else ''
+        label_statistics = self.label_statistics is not None
+        with tempfile.TemporaryDirectory(dir='.') as shard_directory, \
+                ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for shard_number, shard in enumerate(shards):
+                dataset_shard = os.path.join(shard_directory, f"dataset.{shard_number}")
+                error_shard = os.path.join(shard_directory, f"errors.{shard_number}{error_extension}")
+                futures.append((shard, dataset_shard, error_shard,
+                                executor.submit(convert_manifest_shard, self.manifest_uri, mode, label_delimiter, shard,
+                                                dataset_shard, error_shard, report_errors, label_statistics)))
+
+            # merge the shard outputs in manifest order, stopping at the first shard that failed like a serial run.
+            # The shards are already written with the platform line endings, so they are copied without translation.
+            # With a split, the rows are assigned while they are merged, in the order of a serial run. next_line is the
+            # index of the first line of the next shard in the manifest
+            next_line = first_line
+            with self.open_datasets(newline='') as (dataset, test_dataset):
+                for shard, dataset_shard, error_shard, future in futures:
+                    error, number_of_lines, converted_lines, skipped_lines, error_counts, shard_statistics = \
+                        future.result()
+                    line_offset = next_line - shard.first_line
+                    next_line += number_of_lines
+                    if os.path.exists(dataset_shard):
+                        with open(dataset_shard, 'r', encoding='utf8', newline='') as shard_file:
+                            if self.split is None:
+                                shutil.copyfileobj(shard_file, dataset, WRITE_BUFFER_SIZE)
+                            else:
+                                for row in shard_file:
+                                    (test_dataset if self.split.is_test(row_labels(row)) else dataset).write(row)
+                    if report_errors:
+                        self.error_report.merge(error_shard, skipped_lines, error_counts, line_offset)
+                    self.converted_lines += converted_lines
+                    self.manifest_lines += number_of_lines
+                    if label_statistics:
+                        self.label_statistics.merge(shard_statistics)
+                    if error is not None:
+                        for _, _, _, pending in futures:
+                            pending.cancel()
+                        if line_offset and isinstance(error, CustomerError):
+                            raise error.rebase(line_offset)
+                        raise error
+
+    def convert_manifest_lines(self, mode, label_delimiter, groundtruth_output_lines, dataset, first_index=0,
+                               test_dataset=None):
+        self.convert_object.collect_errors = self.error_report is not None
+        for index, jsonLine in enumerate(groundtruth_output_lines, first_index):
+            self.manifest_lines += 1
+            try:
+                if mode == MULTI_CLASS:
+                    labels, source = self.convert_object.convert_to_multiclass_dataset(index, jsonLine)
+                else:
+                    labels, source = self.convert_object.convert_to_multilabel_dataset(index, jsonLine,
+                                                                                       label_delimiter)
+            except CustomerError as e:
+                if self.error_report is None:
+                    raise
+                self.error_report.record(e.errors)
+                continue
+            except (ValueError, KeyError, TypeError, AttributeError):
+                if self.error_report is None:
+                    raise
+                self.error_report.record([CustomerError('CANNOT_PARSE_AUGMENTED_MANIFEST', index,
+                                                        CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(
+                                                            line=index, file_name=GROUNDTRUTH_MANIFEST_FILE_NAME))])
+                continue
+            if self.deduplicator is not None and self.is_duplicate(index, label_delimiter, labels, source):
+                continue
+            if self.label_statistics is not None:
+                self.label_statistics.add(labels.split(label_delimiter) if label_delimiter is not None else [labels],
+                                          document_size(source))
+            output = test_dataset if self.split is not None and self.split.is_test(labels) else dataset
+            if self.convert_object.escaped_source is not None:
+                # the escaped bytes of the manifest line go straight to the binary buffer, see open_dataset. They are
+                # not kept in a local, which would hold the line while the next one is decoded
+                output.write(labels + ',"')
+                output.buffer.write(self.convert_object.escaped_source)
+                output.write('"\n')
+            else:
                 source = json.dumps(source).strip('"')
-                multilabel_dataset.write(labels + ',"' + source + '"')
-                multilabel_dataset.write("\n")
+                output.write(labels + ',"' + source + '"')
+                output.write("\n")
+            self.converted_lines += 1
+
+    def is_duplicate(self, index, label_delimiter, labels, source):
+        label_list = labels.split(label_delimiter) if label_delimiter is not None else [labels]
+        status = self.deduplicator.check(source, label_list, self.converted_lines)
+        if status == CONFLICTING_DOCUMENT:
+            error = CustomerError('CONFLICTING_DUPLICATE', index,
+                                  CONFLICTING_DUPLICATE.substitute(line=index, file=GROUNDTRUTH_MANIFEST_FILE_NAME))
+            if self.error_report is None:
+                raise error
+            self.error_report.record([error])
+        elif status == DUPLICATE_DOCUMENT and self.deduplicator.policy == UNION:
+            written_source = '"' + json.dumps(source).strip('"') + '"'
+            _, _, merged_labels = self.merged_labels.setdefault(self.deduplicator.first_row,
+                                                                (len(written_source), document_size(source), []))
+            merged_labels.extend(label for label in label_list if label not in merged_labels)
+        return status != NEW_DOCUMENT
+
+    def merge_duplicate_labels(self, label_delimiter, dataset_start):
+        # add the labels of the duplicates to the row of their first copy, in one pass over the rows written from
+        # dataset_start. The labels of a row end before the comma that precedes the source.
+        temporary_filename = self.dataset_filename + '.tmp'
+        with open(self.dataset_filename, 'rb') as dataset, \
+                open(temporary_filename, 'wb', buffering=WRITE_BUFFER_SIZE) as merged_dataset:
+            remaining = dataset_start
+            while remaining > 0:
+                block = dataset.read(min(WRITE_BUFFER_SIZE, remaining))
+                merged_dataset.write(block)
+                remaining -= len(block)
+            for row, line in enumerate(dataset):
+                if row in self.merged_labels:
+                    source_length, source_size, merged_labels = self.merged_labels[row]
+                    line = line.decode('utf8')
+                    labels_end = len(line.rstrip('\r\n')) - source_length - 1
+                    labels = line[:labels_end].split(label_delimiter)
+                    row_labels = list(labels)
+                    labels.extend(label for label in merged_labels if label not in labels)
+                    if self.label_statistics is not None:
+                        self.label_statistics.replace_labels(row_labels, labels, source_size)
+                    line = (label_delimiter.join(labels) + line[labels_end:]).encode('utf8')
+                merged_dataset.write(line)
+        os.replace(temporary_filename, self.dataset_filename)
+        self.merged_labels = {}
+
+
+def convert_manifest_shard(manifest_uri, mode, label_delimiter, shard, dataset_filename, error_filename, report_errors,
+                           label_statistics=False):
+    # runs in a worker process; the error is returned so that the rows converted before it are still merged
+    handler = GroundTruthToCLRFormatConversionHandler()
+    handler.dataset_filename = dataset_filename
+    if label_statistics:
+        handler.label_statistics = LabelStatistics(cooccurrence=mode == MULTI_LABEL)
+    if report_errors:
+        handler.error_report = ErrorReport(error_filename, write_header=False)
+    error = None
+    lines = ManifestShardLines(get_storage(manifest_uri), manifest_uri, shard)
+    try:
+        with handler.open_dataset() as dataset:
+            handler.convert_manifest_lines(mode, label_delimiter, lines, dataset, shard.first_line)
+    except Exception as e:
+        error = e
+    if not report_errors:
+        return error, lines.number_of_lines, handler.converted_lines, 0, {}, handler.label_statistics
+    handler.error_report.close()
+    return error, lines.number_of_lines, handler.converted_lines, handler.error_report.skipped_lines, \
+        dict(handler.error_report.error_counts), handler.label_statistics
 
 
 def main():
@@ -47,15 +324,86 @@ def main():
     parser.add_argument('mode')
     parser.add_argument('dataset_output_S3Uri')
     parser.add_argument('label_delimiter')
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes converting newline aligned shards of the manifest")
+    parser.add_argument('--report-errors', dest='error_report_filename',
+                        help="Record every invalid manifest line in this JSON lines (or .csv) file and skip it, "
+                             "instead of failing on the first one")
+    parser.add_argument('--manifest-uri', default=GROUNDTRUTH_MANIFEST_FILE_NAME,
+                        help="Local path or S3Uri of the output.manifest file, an S3 manifest is streamed")
+    parser.add_argument('--upload', action='store_true',
+                        help="Stream the dataset to the output S3Uri instead of writing a local file")
+    parser.add_argument('--checkpoint',
+                        help="Checkpoint file of an incremental conversion: convert only the manifest lines appended "
+                             "since the previous run and append them to the local dataset")
+    parser.add_argument('--deduplicate', choices=DEDUPLICATION_POLICIES,
+                        help="Convert only the first copy of documents with the same text. A copy with other labels "
+                             "is dropped with first-wins, is an error with report and adds its labels to the first "
+                             "copy with union (MULTI_LABEL only)")
+    parser.add_argument('--deduplication-spill-directory',
+                        help="Spill the document digests of --deduplicate to sorted files in this directory, to bound "
+                             "the memory of large manifests")
+    parser.add_argument('--label-statistics',
+                        help="Write the label vocabulary, class counts and document size histograms of the dataset to "
+                             "this JSON file, and for MULTI_LABEL the label co-occurrence matrix to a .npz file next "
+                             "to it (requires numpy)")
+    parser.add_argument('--split', type=float, metavar='TEST_FRACTION',
+                        help="Write this fraction of the rows of each class, or set of labels for MULTI_LABEL, to a "
+                             "test dataset named after the dataset with a _test suffix")
+    parser.add_argument('--split-seed', type=int, default=0,
+                        help="Seed of the --split assignment, the same seed gives the same split")
     args = parser.parse_args()
+    if args.checkpoint and args.upload:
+        parser.error("--checkpoint appends to the local dataset and cannot be combined with --upload")
+    if args.deduplicate and (args.workers > 1 or args.checkpoint):
+        parser.error("--deduplicate needs every document of the manifest in one process and cannot be combined with "
+                     "--workers or --checkpoint")
+    if args.deduplicate == UNION and (args.mode != MULTI_LABEL or args.upload):
+        parser.error("--deduplicate union merges the labels of a MULTI_LABEL local dataset and cannot be combined "
+                     "with MULTI_CLASS or --upload")
+    if args.split is not None and not 0 < args.split < 1:
+        parser.error("--split takes the fraction of the rows written to the test dataset, between 0 and 1")
+    if args.split is not None and args.deduplicate == UNION:
+        parser.error("--deduplicate union rewrites the rows of the dataset and cannot be combined with --split")
     handler = GroundTruthToCLRFormatConversionHandler()
+    handler.manifest_uri = args.manifest_uri
+    if args.split is not None:
+        handler.split = StratifiedSplit(args.split, args.split_seed,
+                                        args.label_delimiter if args.mode == MULTI_LABEL else None)
+    handler.upload = args.upload
+    if args.checkpoint:
+        handler.checkpoint = ConversionCheckpoint(args.checkpoint)
     handler.validate_s3_input(args)
-    if args.mode == "MULTI_CLASS":
-        handler.read_write_multiclass_dataset()
-    elif args.mode == "MULTI_LABEL":
-        handler.read_write_multilabel_dataset(args.label_delimiter)
-    else:
-        raise Exception("The value provided for mode is invalid. Valid values are MUTLI_CLASS|MULTI_LABEL")
+    if args.error_report_filename:
+        handler.error_report = ErrorReport(args.error_report_filename)
+    if args.deduplicate:
+        handler.deduplicator = DocumentDeduplicator(args.deduplicate, args.deduplication_spill_directory)
+    if args.label_statistics:
+        handler.label_statistics = LabelStatistics(cooccurrence=args.mode == MULTI_LABEL)
+    try:
+        if args.mode == MULTI_CLASS:
+            handler.read_write_multiclass_dataset(args.workers)
+        elif args.mode == MULTI_LABEL:
+            handler.read_write_multilabel_dataset(args.label_delimiter, args.workers)
+        else:
+            raise Exception("The value provided for mode is invalid. Valid values are MUTLI_CLASS|MULTI_LABEL")
+    finally:
+        if handler.deduplicator is not None:
+            handler.deduplicator.close()
+    if handler.error_report is not None:
+        handler.error_report.close()
+        handler.error_report.print_summary(handler.manifest_lines, handler.deduplicator.number_of_duplicates
+                                           if handler.deduplicator is not None else 0, handler.first_manifest_line)
+    elif handler.deduplicator is not None:
+        print(f"Dropped {handler.deduplicator.number_of_duplicates} duplicate documents.", file=sys.stderr)
+    if handler.split is not None:
+        print(f"Wrote {handler.split.number_of_test_rows} of {handler.converted_lines} rows to the test dataset "
+              f"{handler.test_dataset_filename}.", file=sys.stderr)
+    if handler.label_statistics is not None:
+        handler.label_statistics.write(args.label_statistics)
+        for label, count in handler.label_statistics.classes_below_minimum():
+            print(f"The class {label} has {count} documents, a custom classifier needs at least "
+                  f"{MINIMUM_EXAMPLES_PER_CLASS} documents per class.", file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,7 @@
-import json
-
+from json_decoder import loads
+from escaped_source import find_escaped_source
 from customer_errors import CANNOT_PARSE_AUGMENTED_MANIFEST, DOCUMENT_TOO_BIG, LABEL_TOO_BIG, EMPTY_LABEL_UNSUPPORTED, \
-    EMPTY_LABEL_FOUND
+    EMPTY_LABEL_FOUND, CustomerError
 
 
 SOURCE = 'source'
@@ -9,6 +9,7 @@ CLASS_NAME = 'class-name'
 CLASS_MAP = 'class-map'
 ATTRIBUTE_NAME_PARAMETER = 'attributeNames'
 FAILURE_REASON = 'failure-reason'
+METADATA_SUFFIX = '-metadata'
 BYTES_TO_MIB = 1024 * 1024
 
 default_limits = {
@@ -17,48 +18,108 @@ default_limits = {
 }
 
 
+"""
+    Learns the layout of the augmented manifest lines: the labeling job attribute, its metadata key, whether the
+    metadata carries a class-name (MULTI_CLASS) or a class-map (MULTI_LABEL) and the top level keys. Lines of a
+    labeling job share the same layout, so once it is learned the metadata key is found with a dict lookup. A line that
+    does not match the layout is scanned again.
+"""
+
+
+class ManifestSchema:
+
+    def __init__(self):
+        self.attribute_name = None
+        self.metadata_key = None
+        self.label_key = None
+        self.keys = None
+
+    def learn(self, jsonLine_input, metadata_key):
+        self.metadata_key = metadata_key
+        self.attribute_name = metadata_key[:-len(METADATA_SUFFIX)] if metadata_key.endswith(METADATA_SUFFIX) else None
+        metadata = jsonLine_input[metadata_key]
+        self.label_key = next((key for key in (CLASS_NAME, CLASS_MAP) if isinstance(metadata, dict) and key in metadata),
+                              None)
+        # the scan takes the last key with the metadata suffix, which is the learned one only for the same keys
+        self.keys = tuple(jsonLine_input)
+
+    def matches(self, jsonLine_input):
+        if self.metadata_key is None or tuple(jsonLine_input) != self.keys:
+            return False
+        metadata = jsonLine_input.get(self.metadata_key)
+        return isinstance(metadata, dict) and (self.label_key is None or self.label_key in metadata)
+
+
 class GroundTruthToComprehendCLRFormatConverter:
 
     def __init__(self):
         self.groundtruth_manifest_file_name = "output.manifest"
         self.labeling_job_name = ""
         self.label_delimiter = ""
+        self.manifest_schema = ManifestSchema()
+        self.collect_errors = False
+        self.line_errors = []
+        # the source of the last converted line as it is written to the dataset, a memoryview of the line, or None when
+        # it has to be escaped from the decoded source
+        self.escaped_source = None
+
+    # Raise the CustomerError, or keep it in line_errors when every violation of the line is collected
+    def _customer_error(self, error):
+        if not self.collect_errors:
+            raise error
+        self.line_errors.append(error)
+
+    def _raise_line_errors(self, index):
+        if self.line_errors:
+            first_error = self.line_errors[0]
+            raise CustomerError(first_error.error_type, index, first_error.message, errors=self.line_errors)
+
+    def _cannot_parse(self, index):
+        return CustomerError('CANNOT_PARSE_AUGMENTED_MANIFEST', index,
+                             CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(line=index,
+                                                                        file_name=self.groundtruth_manifest_file_name))
 
     def _parse_manifest_input(self, index, input):
         try:
             if input is not None:
-                return json.loads(input)
+                return loads(input)
         except ValueError:
-            raise Exception(CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(line=index,
-                                                                       file_name=self.groundtruth_manifest_file_name))
+            raise self._cannot_parse(index)
 
     # Raise CustomerError if the document size > 10MB
     def _check_document_size(self, source, index, limits):
+        # an escaped source is at least as long as its UTF-8 encoding, so a short one is not encoded to be measured
+        if self.escaped_source is not None and len(self.escaped_source) <= limits['MAX_DOCUMENT_SIZE_MB'] * BYTES_TO_MIB:
+            return
         document_size_mb = len(source.encode('utf-8')) / BYTES_TO_MIB
         if document_size_mb > limits['MAX_DOCUMENT_SIZE_MB']:
-            raise Exception(DOCUMENT_TOO_BIG.substitute(
+            self._customer_error(CustomerError('DOCUMENT_TOO_BIG', index, DOCUMENT_TOO_BIG.substitute(
                 size=limits['MAX_DOCUMENT_SIZE_MB'],
                 line=index,
                 file=self.groundtruth_manifest_file_name,
-            ))
+            )))
 
     def get_labeling_job_name(self, index, jsonLine_input):
+        if self.manifest_schema.matches(jsonLine_input):
+            return self.manifest_schema.metadata_key
+
         job_name = None
-        for key, value in jsonLine_input.items():
-            if "-metadata" in key:
+        for key in jsonLine_input:
+            if METADATA_SUFFIX in key:
                 job_name = key
 
         if job_name is None:
-            raise Exception(CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(line=index,
-                                                                       file_name=self.groundtruth_manifest_file_name))
+            raise self._cannot_parse(index)
+        self.manifest_schema.learn(jsonLine_input, job_name)
         return job_name
 
     # Raise CustomerError if the class/label size is >5000 characters
     def _check_label_size(self, label, index, limits):
         if len(label) > limits['MAX_LABEL_SIZE_IN_CHARS']:
-            raise Exception(LABEL_TOO_BIG.substitute(size=limits['MAX_LABEL_SIZE_IN_CHARS'],
-                                                     line=index,
-                                                     file=self.groundtruth_manifest_file_name))
+            self._customer_error(CustomerError('LABEL_TOO_BIG', index,
+                                               LABEL_TOO_BIG.substitute(size=limits['MAX_LABEL_SIZE_IN_CHARS'],
+                                                                        line=index,
+                                                                        file=self.groundtruth_manifest_file_name)))
 
     """
     Convert dict of labels into a string where each label is joined using the label_delimiter
@@ -69,48 +130,55 @@ class GroundTruthToComprehendCLRFormatConverter:
         return ''.join([value + self.label_delimiter for value in class_map.values()])[:-1]
 
     def convert_to_multiclass_dataset(self, index, jsonLine):
+        self.line_errors = []
+        self.escaped_source = None
 
         jsonLine_object = self._parse_manifest_input(index, jsonLine)
         if jsonLine_object is not None:
             if SOURCE not in jsonLine_object.keys():
-                raise Exception(CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(line=index,
-                                                                           file_name=self.groundtruth_manifest_file_name))
+                raise self._cannot_parse(index)
             source = jsonLine_object[SOURCE]
+            if isinstance(source, str):
+                self.escaped_source = find_escaped_source(jsonLine, source)
             self._check_document_size(source, index, limits=default_limits)
 
             self.labeling_job_name = self.get_labeling_job_name(index, jsonLine_object)
             if CLASS_NAME not in jsonLine_object[self.labeling_job_name].keys():
-                raise Exception(CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(line=index,
-                                                                           file_name=self.groundtruth_manifest_file_name))
+                raise self._cannot_parse(index)
 
             class_name = jsonLine_object[self.labeling_job_name][CLASS_NAME]
             if not class_name:
-                raise Exception(EMPTY_LABEL_UNSUPPORTED.substitute(filename=self.groundtruth_manifest_file_name))
+                self._customer_error(CustomerError('EMPTY_LABEL_UNSUPPORTED', index, EMPTY_LABEL_UNSUPPORTED.substitute(
+                    filename=self.groundtruth_manifest_file_name)))
             self._check_label_size(class_name, index, limits=default_limits)
+            self._raise_line_errors(index)
 
         return class_name, source
 
     def convert_to_multilabel_dataset(self, index, jsonLine, label_delimiter):
+        self.line_errors = []
+        self.escaped_source = None
         self.label_delimiter = label_delimiter
 
         jsonLine_object = self._parse_manifest_input(index, jsonLine)
         if jsonLine_object is not None:
             if SOURCE not in jsonLine_object.keys():
-                raise Exception(CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(line=index,
-                                                                           file_name=self.groundtruth_manifest_file_name))
+                raise self._cannot_parse(index)
             source = jsonLine_object[SOURCE]
+            if isinstance(source, str):
+                self.escaped_source = find_escaped_source(jsonLine, source)
             self._check_document_size(source, index, limits=default_limits)
 
             self.labeling_job_name = self.get_labeling_job_name(index, jsonLine_object)
 
             if CLASS_MAP not in jsonLine_object[self.labeling_job_name].keys():
-                raise Exception(CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(line=index,
-                                                                           file_name=self.groundtruth_manifest_file_name))
+                raise self._cannot_parse(index)
             class_map = jsonLine_object[self.labeling_job_name][CLASS_MAP]
 
             # Raise CustomerError when no label found for the document
             if len(class_map) == 0:
-                raise Exception(EMPTY_LABEL_UNSUPPORTED.substitute(filename=self.groundtruth_manifest_file_name))
+                self._customer_error(CustomerError('EMPTY_LABEL_UNSUPPORTED', index, EMPTY_LABEL_UNSUPPORTED.substitute(
+                    filename=self.groundtruth_manifest_file_name)))
 
             # Raise CustomerError if label size is more than 5000 characters
             for label in class_map.values():
@@ -119,10 +187,13 @@ class GroundTruthToComprehendCLRFormatConverter:
             labels = self._get_labels(class_map)
 
             # Raise Customer error when empty label found in the list of labels
-            label_list = labels.split(self.label_delimiter)
+            label_list = labels.split(self.label_delimiter) if class_map else []
             for label in label_list:
                 if len(label) == 0:
-                    raise Exception(EMPTY_LABEL_FOUND.substitute(line=index,
-                                                                 file=self.groundtruth_manifest_file_name))
+                    self._customer_error(CustomerError('EMPTY_LABEL_FOUND', index,
+                                                       EMPTY_LABEL_FOUND.substitute(line=index,
+                                                                                    file=self.groundtruth_manifest_file_name)))
+                    break
+            self._raise_line_errors(index)
 
         return labels, source
@@ -0,0 +1,37 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+"""
+    Decoding layer for the augmented manifest lines. The fastest installed backend is used (orjson, then simdjson, then
+    the standard library) and every backend decodes straight from the bytes read from the file. The optional backends are
+    stricter than the standard library (NaN, integers above 64 bits, ...), so a line they reject is decoded again with
+    json.loads, which keeps the accepted input and the raised errors identical to a plain json.loads.
+"""
+
+PREFERRED_BACKENDS = ['orjson', 'simdjson', 'json']
+BACKENDS = {'json': json.loads}
+if simdjson is not None:
+    BACKENDS['simdjson'] = simdjson.loads
+if orjson is not None:
+    BACKENDS['orjson'] = orjson.loads
+
+BACKEND = next(name for name in PREFERRED_BACKENDS if name in BACKENDS)
+
+
+def loads(data, backend=None):
+    backend_loads = BACKENDS[backend or BACKEND]
+    try:
+        return backend_loads(data)
+    except ValueError:
+        if backend_loads is json.loads:
+            raise
+        return json.loads(data)
@@ -0,0 +1,141 @@
+import json
+import os
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Comprehend rejects a custom classifier training job with a class of fewer documents
+MINIMUM_EXAMPLES_PER_CLASS = 10
+# bucket b of the document size histograms counts the documents of size.bit_length() == b bytes, the last one is
+# open ended, 10 MB documents fall in bucket 24
+SIZE_BUCKETS = 25
+
+"""
+    Accumulates the label statistics of the rows written to dataset.csv while the manifest is converted, so that the
+    dataset does not have to be read again to count its classes. The labels are interned to ids in the order they are
+    first seen, and the counts are arrays indexed by id: the documents of each class, and the histograms of the UTF-8
+    size of all documents and of the documents of each class, in power of two buckets. With cooccurrence, the documents
+    of every pair of labels of a MULTI_LABEL row are counted in a dict keyed by the pair of ids, which only holds the
+    pairs that occur; it is written as a sparse matrix with NumPy at the end.
+    The statistics of manifest shards converted in other processes are merged in manifest order, which keeps the ids
+    of a serial run.
+    Example: the rows "joy|optimism" and "joy" give the labels ["joy", "optimism"], the class counts [2, 1] and the
+    co-occurrence counts {(0, 1): 1}.
+"""
+
+
+def document_size(source):
+    # UTF-8 size of the document, str.isascii does not scan the string
+    return len(source) if source.isascii() else len(source.encode('utf-8'))
+
+
+class LabelStatistics:
+
+    def __init__(self, cooccurrence=False):
+        if cooccurrence and np is None:
+            raise ImportError("The label co-occurrence matrix requires numpy, install it with: pip install numpy")
+        self.cooccurrence = cooccurrence
+        self.label_ids = {}
+        self.number_of_documents = 0
+        self.class_counts = array('Q')
+        self.size_histogram = array('Q', bytes(8 * SIZE_BUCKETS))
+        self.class_size_histograms = array('Q')
+        self.pair_counts = {}
+
+    def add(self, labels, size, count=1):
+        # count the row of a document of size bytes with these labels, count=-1 takes a counted row back
+        self.number_of_documents += count
+        bucket = min(size.bit_length(), SIZE_BUCKETS - 1)
+        self.size_histogram[bucket] += count
+        ids = []
+        for label in labels:
+            label_id = self.label_ids.get(label)
+            if label_id is None:
+                label_id = self.label_ids[label] = len(self.label_ids)
+                self.class_counts.append(0)
+                self.class_size_histograms.extend(bytes(8 * SIZE_BUCKETS))
+            elif label_id in ids:
+                continue
+            ids.append(label_id)
+            self.class_counts[label_id] += count
+            self.class_size_histograms[label_id * SIZE_BUCKETS + bucket] += count
+        if self.cooccurrence and len(ids) > 1:
+            ids.sort()
+            pair_counts = self.pair_counts
+            for position, first_id in enumerate(ids):
+                for second_id in ids[position + 1:]:
+                    pair = first_id << 32 | second_id
+                    pair_count = pair_counts.get(pair, 0) + count
+                    if pair_count:
+                        pair_counts[pair] = pair_count
+                    else:
+                        del pair_counts[pair]
+
+    def replace_labels(self, labels, merged_labels, size):
+        # the labels of a row were merged with the ones of its duplicates
+        self.add(labels, size, count=-1)
+        self.add(merged_labels, size)
+
+    def merge(self, other):
+        # add the statistics of the rows converted after these ones, e.g. by the next manifest shard
+        self.number_of_documents += other.number_of_documents
+        for bucket, documents in enumerate(other.size_histogram):
+            self.size_histogram[bucket] += documents
+        ids = []
+        for label, other_id in other.label_ids.items():
+            label_id = self.label_ids.get(label)
+            if label_id is None:
+                label_id = self.label_ids[label] = len(self.label_ids)
+                self.class_counts.append(0)
+                self.class_size_histograms.extend(bytes(8 * SIZE_BUCKETS))
+            ids.append(label_id)
+            self.class_counts[label_id] += other.class_counts[other_id]
+            for bucket in range(SIZE_BUCKETS):
+                self.class_size_histograms[label_id * SIZE_BUCKETS + bucket] += \
+                    other.class_size_histograms[other_id * SIZE_BUCKETS + bucket]
+        for pair, pair_count in other.pair_counts.items():
+            first_id, second_id = sorted((ids[pair >> 32], ids[pair & 0xffffffff]))
+            pair = first_id << 32 | second_id
+            self.pair_counts[pair] = self.pair_counts.get(pair, 0) + pair_count
+
+    def classes_below_minimum(self, minimum_examples=MINIMUM_EXAMPLES_PER_CLASS):
+        return [(label, self.class_counts[label_id]) for label, label_id in self.label_ids.items()
+                if self.class_counts[label_id] < minimum_examples]
+
+    def write(self, filename, minimum_examples=MINIMUM_EXAMPLES_PER_CLASS):
+        # the statistics as JSON, and with cooccurrence the matrix next to it in a .npz file readable by
+        # scipy.sparse.load_npz
+        labels = list(self.label_ids)
+        statistics = {
+            'documents': self.number_of_documents,
+            'labels': labels,
+            'class_counts': dict(zip(labels, self.class_counts)),
+            'size_buckets': [[0, 0]] + [[1 << (bucket - 1), (1 << bucket) - 1] for bucket in range(1, SIZE_BUCKETS)],
+            'size_histogram': list(self.size_histogram),
+            'class_size_histograms': {label: list(self.class_size_histograms[label_id * SIZE_BUCKETS:
+                                                                              (label_id + 1) * SIZE_BUCKETS])
+                                      for label, label_id in self.label_ids.items()},
+            'minimum_examples_per_class': minimum_examples,
+            'classes_below_minimum': dict(self.classes_below_minimum(minimum_examples)),
+        }
+        if self.cooccurrence:
+            statistics['cooccurrence_matrix'] = self.write_cooccurrence(os.path.splitext(filename)[0] + '.npz')
+        with open(filename, 'w', encoding='utf8') as statistics_file:
+            json.dump(statistics, statistics_file, ensure_ascii=False)
+
+    def write_cooccurrence(self, filename):
+        # symmetric label by label matrix in COO format, the diagonal holds the class counts
+        pairs = np.fromiter(self.pair_counts.keys(), dtype=np.uint64, count=len(self.pair_counts))
+        pair_counts = np.fromiter(self.pair_counts.values(), dtype=np.int64, count=len(self.pair_counts))
+        first_ids = (pairs >> np.uint64(32)).astype(np.int32)
+        second_ids = (pairs & np.uint64(0xffffffff)).astype(np.int32)
+        diagonal = np.arange(len(self.label_ids), dtype=np.int32)
+        np.savez_compressed(filename, format=b'coo', shape=np.array([len(self.label_ids)] * 2),
+                            row=np.concatenate([diagonal, first_ids, second_ids]),
+                            col=np.concatenate([diagonal, second_ids, first_ids]),
+                            data=np.concatenate([np.array(self.class_counts, dtype=np.int64), pair_counts, pair_counts]),
+                            labels=np.array(list(self.label_ids), dtype=str))
+        return os.path.basename(filename)
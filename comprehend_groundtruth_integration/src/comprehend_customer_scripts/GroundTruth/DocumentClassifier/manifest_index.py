@@ -0,0 +1,128 @@
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+INDEX_SUFFIX = '.lineindex'
+# magic with the byte order of the offsets, manifest size, manifest modification time in ns and number of lines
+INDEX_HEADER = struct.Struct('<8sQQQ')
+INDEX_MAGIC = b'GTLIDX' + (b'LE' if sys.byteorder == 'little' else b'BE')
+NEWLINE = re.compile(b'\n')
+
+"""
+    Random access to the lines of a local manifest file. The manifest is memory mapped, and the offset of the start of
+    every line is kept in an index file next to it, output.manifest.lineindex: a header followed by the offsets as an
+    array of unsigned 64-bit integers. The index is built with one scan of the manifest when it is missing or was built
+    for another size or modification time of the manifest, and is memory mapped otherwise, so that counting the lines,
+    reading line N or finding the line at a byte offset costs no scan of the manifest. When the index cannot be
+    written next to the manifest, it is kept in memory.
+    Example: "{...}\n{...}\n{..." has the line offsets [0, 6, 12] and 3 lines, the last one without newline.
+"""
+
+
+@contextmanager
+def open_manifest_index(manifest_uri):
+    # the ManifestIndex of a local manifest, None for an S3 manifest that is streamed instead
+    if urlparse(manifest_uri).scheme == 's3':
+        yield None
+        return
+    with ManifestIndex(manifest_uri) as manifest_index:
+        yield manifest_index
+
+
+class ManifestIndex:
+
+    def __init__(self, filename, index_filename=None):
+        self.filename = filename
+        self.index_filename = index_filename or filename + INDEX_SUFFIX
+        self.manifest_file = open(filename, 'rb')
+        status = os.fstat(self.manifest_file.fileno())
+        self.size = status.st_size
+        # the lines appended after the file was opened are left out. An empty file cannot be memory mapped
+        self.manifest = mmap.mmap(self.manifest_file.fileno(), self.size, access=mmap.ACCESS_READ) if self.size else b''
+        self.index_file = self.index_map = None
+        self.offsets = self._load_index(status.st_mtime_ns)
+        if self.offsets is None:
+            self.offsets = self._build_index(status.st_mtime_ns)
+
+    def _load_index(self, modification_time):
+        # the offsets memory mapped from a valid index file, None when it has to be built again
+        try:
+            index_file = open(self.index_filename, 'rb')
+        except OSError:
+            return None
+        header = index_file.read(INDEX_HEADER.size)
+        if len(header) == INDEX_HEADER.size:
+            magic, size, index_modification_time, number_of_lines = INDEX_HEADER.unpack(header)
+            is_valid = (magic, size, index_modification_time) == (INDEX_MAGIC, self.size, modification_time) and \
+                os.fstat(index_file.fileno()).st_size == INDEX_HEADER.size + 8 * number_of_lines
+        else:
+            is_valid = False
+        if not is_valid or number_of_lines == 0:
+            index_file.close()
+            return array('Q') if is_valid else None
+        self.index_file = index_file
+        self.index_map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.index_map)[INDEX_HEADER.size:].cast('Q')
+
+    def _build_index(self, modification_time):
+        offsets = array('Q')
+        if self.size:
+            offsets.append(0)
+            offsets.extend(newline.end() for newline in NEWLINE.finditer(self.manifest))
+            # a final newline ends the last line, it does not start another one
+            if offsets[-1] == self.size:
+                offsets.pop()
+        temporary_filename = self.index_filename + '.tmp'
+        try:
+            with open(temporary_filename, 'wb') as index_file:
+                index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, self.size, modification_time, len(offsets)))
+                offsets.tofile(index_file)
+            os.replace(temporary_filename, self.index_filename)
+        except OSError:
+            pass
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def line_start(self, line_number):
+        # byte offset of a line, the size of the manifest for the line after the last one
+        return self.offsets[line_number] if line_number < len(self.offsets) else self.size
+
+    def line(self, line_number):
+        # the bytes of a line with its newline, like a line read from the file
+        return self.manifest[self.offsets[line_number]:self.line_start(line_number + 1)]
+
+    def line_at(self, offset):
+        # number of the first line that starts at or after the byte offset
+        return bisect_left(self.offsets, offset)
+
+    def iter_lines(self, start=0, end=None):
+        # the lines in the byte range [start, end), which are expected to be line aligned
+        end = self.size if end is None else end
+        line_number = self.line_at(start)
+        while line_number < len(self.offsets) and self.offsets[line_number] < end:
+            yield self.line(line_number)
+            line_number += 1
+
+    def close(self):
+        if isinstance(self.offsets, memoryview):
+            self.offsets.release()
+        if self.index_map is not None:
+            self.index_map.close()
+            self.index_file.close()
+        if isinstance(self.manifest, mmap.mmap):
+            self.manifest.close()
+        self.manifest_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,69 @@
+from collections import namedtuple
+
+"""
+    A shard is a newline aligned byte range [start, end) of the manifest file. first_line is the index the lines of the
+    shard are numbered from. With a ManifestIndex it is the global index of the first line in the shard, without one
+    only the first shard knows it and the other shards number their lines from 0: a worker returns the number of lines
+    of its shard, so that the merge rebases the Line column and the customer error messages to match a serial run.
+"""
+ManifestShard = namedtuple('ManifestShard', ['start', 'end', 'first_line'])
+
+
+def plan_manifest_shards(storage, manifest_uri, number_of_shards, start=0, end=None, first_line=0, manifest_index=None):
+    # split the byte range [start, end) of the manifest, which starts at line first_line, into newline aligned shards.
+    # With the ManifestIndex of a local manifest, the boundaries and line numbers are looked up. Without it the lines
+    # are not counted here, which would read the whole manifest before the workers start
+    end = storage.size(manifest_uri) if end is None else end
+    if manifest_index is not None:
+        return _plan_indexed_shards(manifest_index, number_of_shards, start, end, first_line)
+    boundaries = [start]
+    for shard in range(1, number_of_shards):
+        target = max(start + (end - start) * shard // number_of_shards, boundaries[-1])
+        if target >= end:
+            break
+        # move the boundary forward to the start of the next line
+        with storage.open_read(manifest_uri, target) as manifest:
+            boundaries.append(min(target + len(manifest.readline()), end))
+    boundaries.append(end)
+
+    return [ManifestShard(shard_start, shard_end, first_line if shard_start == start else 0)
+            for shard_start, shard_end in zip(boundaries, boundaries[1:]) if shard_start < shard_end]
+
+
+def _plan_indexed_shards(manifest_index, number_of_shards, start, end, first_line):
+    start_line = manifest_index.line_at(start)
+    boundaries = [start_line]
+    for shard in range(1, number_of_shards):
+        boundaries.append(max(manifest_index.line_at(start + (end - start) * shard // number_of_shards),
+                              boundaries[-1]))
+    boundaries.append(manifest_index.line_at(end))
+    return [ManifestShard(manifest_index.line_start(shard_start), min(manifest_index.line_start(shard_end), end),
+                          first_line + shard_start - start_line)
+            for shard_start, shard_end in zip(boundaries, boundaries[1:]) if shard_start < shard_end]
+
+
+def iter_manifest_shard_lines(storage, manifest_uri, shard):
+    with storage.open_read(manifest_uri, shard.start, shard.end) as manifest:
+        position = shard.start
+        while position < shard.end:
+            line = manifest.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+
+class ManifestShardLines:
+    # iterates over the lines of a shard like iter_manifest_shard_lines and counts them, for the merge
+
+    def __init__(self, storage, manifest_uri, shard):
+        self.lines = iter_manifest_shard_lines(storage, manifest_uri, shard)
+        self.number_of_lines = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self.lines)
+        self.number_of_lines += 1
+        return line
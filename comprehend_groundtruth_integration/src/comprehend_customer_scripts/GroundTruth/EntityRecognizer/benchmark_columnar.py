@@ -0,0 +1,52 @@
+import argparse
+import json
+import time
+
+from columnar_annotations import ColumnarAnnotationStore
+from groundtruth_to_comprehend_format_converter import GroundTruthToComprehendFormatConverter
+
+
+def entity_dense_manifest_lines(number_of_lines, entities_per_line):
+    # every line holds entities_per_line non overlapping entities, so that the validation dominates the conversion
+    source = " ".join(["Minneapolis"] * entities_per_line)
+    entities = [{"startOffset": 12 * entity, "endOffset": 12 * entity + 11, "label": f"Location{entity % 7}"}
+                for entity in reversed(range(entities_per_line))]
+    line = json.dumps({"source": source,
+                       "EntityRecognizerPOC-1": {"annotations": {"entities": entities}},
+                       "EntityRecognizerPOC-1-metadata": {"job-name": "labeling-job/entityrecognizerpoc-1",
+                                                          "type": "groundtruth/text-span",
+                                                          "human-annotated": "yes"}})
+    return [(line + "\n").encode('utf-8')] * number_of_lines
+
+
+def row_by_row_validation(lines):
+    for _ in GroundTruthToComprehendFormatConverter().iter_dataset_annotations(lines):
+        pass
+
+
+def columnar_validation(lines):
+    for _ in ColumnarAnnotationStore(GroundTruthToComprehendFormatConverter()).iter_batches(lines):
+        pass
+
+
+def run(validation, lines, entities_per_line):
+    start_time = time.perf_counter()
+    validation(lines)
+    elapsed = time.perf_counter() - start_time
+    print(f"{validation.__name__}: {len(lines) * entities_per_line / elapsed:,.0f} entities/sec "
+          f"({elapsed:.2f} seconds)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the row by row and the columnar validation of the entities")
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--entities', type=int, default=100, help="Number of entities of every manifest line")
+    args = parser.parse_args()
+
+    lines = entity_dense_manifest_lines(args.lines, args.entities)
+    run(row_by_row_validation, lines, args.entities)
+    run(columnar_validation, lines, args.entities)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import csv
+import json
+import os
+import tempfile
+import time
+
+from groundtruth_format_conversion_handler import GroundTruthFormatConversionHandler, ANNOTATION_CSV_HEADER
+
+SAMPLE_SOURCE = "Bob was born on Jan 1 1990 and lived his whole life in Minneapolis."
+SAMPLE_ENTITIES = [{"endOffset": 22, "startOffset": 16, "label": "Date"},
+                   {"endOffset": 3, "startOffset": 0, "label": "Person"},
+                   {"endOffset": 67, "startOffset": 56, "label": "Location"}]
+
+
+def write_synthetic_manifest(path, number_of_lines):
+    line = json.dumps({"source": SAMPLE_SOURCE,
+                       "EntityRecognizerPOC-1": {"annotations": {"entities": SAMPLE_ENTITIES,
+                                                                 "labels": [{"label": "Date"},
+                                                                            {"label": "Location"},
+                                                                            {"label": "Person"}]}},
+                       "EntityRecognizerPOC-1-metadata": {"job-name": "labeling-job/entityrecognizerpoc-1",
+                                                          "type": "groundtruth/text-span",
+                                                          "human-annotated": "yes"}})
+    with open(path, 'w', encoding='utf-8') as manifest:
+        for _ in range(number_of_lines):
+            manifest.write(line + "\n")
+
+
+def reopen_per_line_conversion(handler):
+    # the previous handler behaviour: reopen both outputs and build a new csv writer for every manifest line
+    with open('output.manifest', 'r', encoding='utf-8') as groundtruth_output_file:
+        for index, jsonLine in enumerate(groundtruth_output_file):
+            with open(handler.dataset_filename, 'a', encoding='utf8') as dataset, \
+                    open(handler.annotation_filename, 'a', encoding='utf8') as annotation_file:
+                datawriter = csv.writer(annotation_file, delimiter=',', lineterminator='\n')
+                source, annotations = handler.convert_object.convert_to_dataset_annotations(index, jsonLine)
+                dataset.write('"' + json.dumps(source).strip('"') + '"')
+                dataset.write("\n")
+                for entry in annotations:
+                    datawriter.writerow(entry)
+
+
+def streaming_conversion(handler):
+    handler.read_augmented_manifest_file()
+
+
+def run(conversion, number_of_lines):
+    handler = GroundTruthFormatConversionHandler()
+    handler.dataset_filename = "dataset.csv"
+    handler.annotation_filename = "annotations.csv"
+    with open(handler.annotation_filename, 'w', encoding='utf8') as annotation_file:
+        csv.writer(annotation_file, delimiter=',', lineterminator='\n').writerow(ANNOTATION_CSV_HEADER)
+    if os.path.exists(handler.dataset_filename):
+        os.remove(handler.dataset_filename)
+
+    start_time = time.perf_counter()
+    conversion(handler)
+    elapsed = time.perf_counter() - start_time
+    print(f"{conversion.__name__}: {number_of_lines / elapsed:,.0f} lines/sec ({elapsed:.2f} seconds)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the conversion throughput on a synthetic manifest")
+    parser.add_argument('--lines', type=int, default=100000)
+    args = parser.parse_args()
+
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as benchmark_directory:
+        os.chdir(benchmark_directory)
+        try:
+            write_synthetic_manifest('output.manifest', args.lines)
+            run(reopen_per_line_conversion, args.lines)
+            run(streaming_conversion, args.lines)
+        finally:
+            os.chdir(working_directory)
+
+
+if __name__ == "__main__":
+    main()
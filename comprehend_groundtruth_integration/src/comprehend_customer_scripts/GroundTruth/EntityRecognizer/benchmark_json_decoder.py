@@ -0,0 +1,35 @@
+import argparse
+import os
+import tempfile
+import time
+
+from benchmark_conversion import write_synthetic_manifest
+from json_decoder import BACKEND, BACKENDS, loads
+
+
+def run(backend, lines):
+    start_time = time.perf_counter()
+    for line in lines:
+        loads(line, backend)
+    elapsed = time.perf_counter() - start_time
+    default = " (default)" if backend == BACKEND else ""
+    print(f"{backend}{default}: {len(lines) / elapsed:,.0f} lines/sec ({elapsed:.2f} seconds)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the installed JSON decoding backends on manifest lines")
+    parser.add_argument('--lines', type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as benchmark_directory:
+        manifest_filename = os.path.join(benchmark_directory, 'output.manifest')
+        write_synthetic_manifest(manifest_filename, args.lines)
+        with open(manifest_filename, 'rb') as manifest:
+            lines = manifest.readlines()
+
+    for backend in BACKENDS:
+        run(backend, lines)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+import json
+import os
+from array import array
+from collections import namedtuple
+from itertools import repeat
+from operator import itemgetter
+
+from customer_errors import CANNOT_PARSE_AUGMENTED_MANIFEST, CustomerError
+from groundtruth_to_comprehend_format_converter import START_OFFSET, END_OFFSET, LABEL, MAX_TRAIN_DOC_SIZE
+from offset_mapping import BYTE_OFFSETS
+from document_windows import plan_document_windows
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COLUMNAR_BATCH_SIZE = 10000
+GET_START_OFFSET = itemgetter(START_OFFSET)
+GET_END_OFFSET = itemgetter(END_OFFSET)
+GET_LABEL = itemgetter(LABEL)
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+"""
+    Columnar backend of the EntityRecognizer conversion. The entities of a batch of manifest lines are accumulated in
+    arrays of begin offsets, end offsets, labels and document positions, and the end offset, out of range and overlap
+    checks run as NumPy operations over the whole batch: the valid entities are sorted by (document, begin offset) and
+    every entity is compared with the one before it. The valid documents of a batch are yielded as an AnnotationBatch, in
+    the order and with the annotations of the row by row conversion, and the customer errors are identical to it as well.
+"""
+
+"""
+    sources are the documents of the valid lines of a batch. The annotation columns are sorted by (document, begin
+    offset) and rows is the position of the document of each annotation in sources. The labels are kept as the decoded
+    objects, the checks do not need them and interning them costs more than the checks themselves.
+"""
+AnnotationBatch = namedtuple('AnnotationBatch', ['sources', 'rows', 'begin_offsets', 'end_offsets', 'labels'])
+
+
+class ColumnarAnnotationStore:
+
+    def __init__(self, converter, batch_size=COLUMNAR_BATCH_SIZE):
+        if np is None:
+            raise ImportError("The columnar annotation store requires numpy, install it with: pip install numpy")
+        self.converter = converter
+        self.batch_size = batch_size
+        self._reset()
+
+    def _reset(self):
+        self.indexes = []
+        self.sources = []
+        self.offset_mappings = []
+        self.maximum_offsets = array('q')
+        self.entity_counts = array('q')
+        # errors found while a line is parsed, DOC_SIZE_EXCEEDED or the errors of a line checked row by row
+        self.document_errors = []
+        self.begin_offsets = array('q')
+        self.end_offsets = array('q')
+        self.label_values = []
+
+    def iter_batches(self, groundtruth_output_lines, first_index=0, error_report=None):
+        # the lines are only parsed here, the errors of a line are raised or recorded once the batch is validated, so
+        # a line that cannot be parsed first validates the lines before it to keep the errors in manifest order
+        self.converter.collect_errors = True
+        for index, jsonLine in enumerate(groundtruth_output_lines, first_index):
+            try:
+                self._append(index, jsonLine)
+            except (CustomerError, ValueError, KeyError, TypeError, AttributeError) as e:
+                yield from self._flush(error_report)
+                if error_report is None:
+                    if not isinstance(e, json.JSONDecodeError):
+                        # the line failed after some of its checks, raise the error the row by row conversion raises
+                        self.converter.collect_errors = False
+                        self.converter.convert_to_dataset_annotations(index, jsonLine)
+                    raise
+                errors = e.errors if isinstance(e, CustomerError) else [
+                    CustomerError('CANNOT_PARSE_AUGMENTED_MANIFEST', index,
+                                  CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(
+                                      line=index, file_name=self.converter.groundtruth_manifest_file_name))]
+                error_report.record(errors)
+                continue
+            if len(self.sources) >= self.batch_size:
+                yield from self._flush(error_report)
+        yield from self._flush(error_report)
+
+    def _append(self, index, jsonLine):
+        source, entities = self.converter.extract_entities(index, jsonLine)
+        document_errors = self.converter.line_errors
+        maximum_offset = self.converter.maximum_offset
+        labels = list(map(GET_LABEL, entities))
+        try:
+            begin_offsets = array('q', map(GET_START_OFFSET, entities))
+            end_offsets = array('q', map(GET_END_OFFSET, entities))
+        except (TypeError, OverflowError):
+            # offsets that are not 64 bit integers, e.g. "12" or 12.0, are converted like the row by row conversion
+            entities = [(int(entity[START_OFFSET]), int(entity[END_OFFSET]), entity[LABEL]) for entity in entities]
+            try:
+                begin_offsets = array('q', [begin_offset for begin_offset, _, _ in entities])
+                end_offsets = array('q', [end_offset for _, end_offset, _ in entities])
+            except OverflowError:
+                document_errors.extend(self._check_beyond_64_bits(index, entities, maximum_offset))
+                begin_offsets = end_offsets = labels = []
+        self.indexes.append(index)
+        self.sources.append(source)
+        self.offset_mappings.append(self.converter.offset_mapping)
+        self.maximum_offsets.append(maximum_offset)
+        self.document_errors.append(document_errors)
+        self.entity_counts.append(len(labels))
+        self.begin_offsets.extend(begin_offsets)
+        self.end_offsets.extend(end_offsets)
+        self.label_values.extend(labels)
+
+    def _check_beyond_64_bits(self, index, entities, maximum_offset):
+        # offsets beyond 64 bits only fit the row by row checks, the line is rejected even when they pass them
+        errors = self._check_row_by_row(index, entities, maximum_offset)
+        if not errors:
+            begin_offset, end_offset, _ = next(entity for entity in entities
+                                               if not INT64_MIN <= entity[0] <= INT64_MAX or
+                                               not INT64_MIN <= entity[1] <= INT64_MAX)
+            errors.append(self.converter.invalid_offsets_error(index, begin_offset, end_offset, maximum_offset))
+        return errors
+
+    def _check_row_by_row(self, index, entities, maximum_offset):
+        errors = []
+        annotations = []
+        for begin_offset, end_offset, label in entities:
+            if end_offset < begin_offset:
+                errors.append(self.converter.wrong_annotation_error(index, begin_offset, end_offset))
+            elif begin_offset >= maximum_offset or end_offset > maximum_offset:
+                errors.append(self.converter.invalid_offsets_error(index, begin_offset, end_offset, maximum_offset))
+            else:
+                annotations.append((begin_offset, end_offset, label))
+        annotations.sort(key=lambda annotation: annotation[0])
+        for previous, current in zip(annotations, annotations[1:]):
+            if previous[1] > current[0]:
+                errors.append(self.converter.overlapping_annotations_error(index, previous[2], current[2]))
+        return errors
+
+    def _flush(self, error_report):
+        if not self.sources:
+            return
+        try:
+            yield from self._validate(error_report)
+        finally:
+            self._reset()
+
+    def _validate(self, error_report):
+        entity_counts = np.frombuffer(self.entity_counts, dtype=np.int64)
+        begin_offsets = np.frombuffer(self.begin_offsets, dtype=np.int64)
+        end_offsets = np.frombuffer(self.end_offsets, dtype=np.int64)
+        label_values = np.fromiter(self.label_values, dtype=object, count=len(self.label_values))
+        documents = np.repeat(np.arange(len(self.sources)), entity_counts)
+        maximum_offsets = np.frombuffer(self.maximum_offsets, dtype=np.int64)[documents]
+
+        wrong = end_offsets < begin_offsets
+        out_of_range = ~wrong & ((begin_offsets >= maximum_offsets) | (end_offsets > maximum_offsets))
+        kept = np.flatnonzero(~(wrong | out_of_range))
+        # lexsort is stable, entities with the same begin offset keep their manifest order like the row by row sort
+        order = kept[np.lexsort((begin_offsets[kept], documents[kept]))]
+        overlapping = np.flatnonzero((documents[order[1:]] == documents[order[:-1]]) &
+                                     (end_offsets[order[:-1]] > begin_offsets[order[1:]]))
+
+        invalid = np.zeros(len(self.sources), dtype=bool)
+        invalid[documents[wrong | out_of_range]] = True
+        invalid[documents[order[1:][overlapping]]] = True
+        invalid[[document for document, errors in enumerate(self.document_errors) if errors]] = True
+        windows = self._plan_windows(invalid, documents, order, begin_offsets, end_offsets) \
+            if self.converter.split_documents else {}
+        duplicate = self._deduplicate(invalid, documents, order, begin_offsets, end_offsets, label_values,
+                                      error_report is None) if self.converter.deduplicator is not None else None
+
+        first_error = None
+        for document in np.flatnonzero(invalid).tolist():
+            errors = self._document_errors(document, documents, wrong, out_of_range, order, overlapping)
+            if error_report is None:
+                first_error = errors[0]
+                invalid[document + 1:] = True
+                break
+            error_report.record(errors)
+        if duplicate is not None:
+            invalid |= duplicate
+
+        valid_documents = np.flatnonzero(~invalid)
+        if len(valid_documents):
+            # the annotations of the valid documents, numbered by the position of their document among the valid ones
+            order = order[~invalid[documents[order]]]
+            rows = np.cumsum(~invalid)[documents[order]] - 1
+            begin_offsets = begin_offsets[order]
+            end_offsets = end_offsets[order]
+            if self.converter.offset_unit == BYTE_OFFSETS:
+                self._to_byte_offsets(valid_documents, rows, begin_offsets, end_offsets)
+            sources = [self.sources[document] for document in valid_documents.tolist()]
+            if windows:
+                sources, rows = self._split_windows(valid_documents, windows, rows, begin_offsets, end_offsets)
+            yield AnnotationBatch(sources, rows, begin_offsets, end_offsets, label_values[order])
+        if first_error is not None:
+            raise CustomerError(first_error.error_type, first_error.line, first_error.message)
+
+    def _plan_windows(self, invalid, documents, order, begin_offsets, end_offsets):
+        # plan the windows of the valid documents over the size limit, the ones that cannot be split become invalid
+        windows = {}
+        document_sizes = np.fromiter((offset_mapping.number_of_bytes for offset_mapping in self.offset_mappings),
+                                     dtype=np.int64, count=len(self.offset_mappings))
+        ordered_documents = documents[order]
+        for document in np.flatnonzero(~invalid & (document_sizes > MAX_TRAIN_DOC_SIZE)).tolist():
+            start, end = np.searchsorted(ordered_documents, [document, document + 1])
+            entities = order[start:end]
+            annotations = list(zip(repeat(None), repeat(None), begin_offsets[entities].tolist(),
+                                   end_offsets[entities].tolist()))
+            document_windows = plan_document_windows(self.sources[document], annotations,
+                                                     self.offset_mappings[document], MAX_TRAIN_DOC_SIZE)
+            if document_windows is None:
+                self.document_errors[document] = [self.converter.document_size_error(self.indexes[document])]
+                invalid[document] = True
+            else:
+                windows[document] = document_windows
+        return windows
+
+    def _deduplicate(self, invalid, documents, order, begin_offsets, end_offsets, label_values, strict):
+        # check the valid documents against the deduplicator in manifest order, the duplicates are dropped without an
+        # error and the conflicting ones become invalid. A strict conversion stops at the first invalid document.
+        duplicate = np.zeros(len(self.sources), dtype=bool)
+        ordered_documents = documents[order]
+        checked = len(self.sources)
+        if strict and invalid.any():
+            checked = int(np.argmax(invalid))
+        for document in np.flatnonzero(~invalid[:checked]).tolist():
+            start, end = np.searchsorted(ordered_documents, [document, document + 1])
+            entities = order[start:end]
+            annotations = list(zip(repeat(None), repeat(None), begin_offsets[entities].tolist(),
+                                   end_offsets[entities].tolist(), label_values[entities].tolist()))
+            try:
+                duplicate[document] = self.converter.is_duplicate(self.indexes[document], self.sources[document],
+                                                                  annotations)
+            except CustomerError as e:
+                self.document_errors[document] = [e]
+                invalid[document] = True
+                if strict:
+                    break
+        return duplicate
+
+    def _split_windows(self, valid_documents, windows, rows, begin_offsets, end_offsets):
+        # one row per window of the split documents. The annotations keep their order, an annotation goes to the last
+        # window starting at or before it and its offsets are rebased to that window.
+        sources = []
+        window_rows = rows.copy()
+        row_boundaries = np.searchsorted(rows, np.arange(len(valid_documents) + 1))
+        for row, document in enumerate(valid_documents.tolist()):
+            start, end = row_boundaries[row], row_boundaries[row + 1]
+            if document not in windows:
+                window_rows[start:end] = len(sources)
+                sources.append(self.sources[document])
+                continue
+            window_starts = [window_start for window_start, _ in windows[document]]
+            if self.converter.offset_unit == BYTE_OFFSETS:
+                window_starts = self.offset_mappings[document].to_byte_offsets(window_starts)
+            window_starts = np.array(window_starts, dtype=np.int64)
+            entity_windows = np.maximum(np.searchsorted(window_starts, begin_offsets[start:end], side='right') - 1, 0)
+            begin_offsets[start:end] -= window_starts[entity_windows]
+            end_offsets[start:end] -= window_starts[entity_windows]
+            window_rows[start:end] = len(sources) + entity_windows
+            sources.extend(self.sources[document][window_start:window_end]
+                           for window_start, window_end in windows[document])
+        return sources, window_rows
+
+    def _to_byte_offsets(self, valid_documents, rows, begin_offsets, end_offsets):
+        # only the annotations of non ASCII documents move, they are contiguous since rows is sorted
+        for row, document in enumerate(valid_documents.tolist()):
+            offset_mapping = self.offset_mappings[document]
+            if offset_mapping.is_ascii:
+                continue
+            start, end = np.searchsorted(rows, [row, row + 1])
+            begin_offsets[start:end] = offset_mapping.to_byte_offsets(begin_offsets[start:end].tolist())
+            end_offsets[start:end] = offset_mapping.to_byte_offsets(end_offsets[start:end].tolist())
+
+    def _document_errors(self, document, documents, wrong, out_of_range, order, overlapping):
+        # the errors of one line, in the order of the row by row conversion
+        index = self.indexes[document]
+        maximum_offset = self.maximum_offsets[document]
+        errors = list(self.document_errors[document])
+        for entity in np.flatnonzero(documents == document).tolist():
+            if wrong[entity]:
+                errors.append(self.converter.wrong_annotation_error(index, self.begin_offsets[entity],
+                                                                    self.end_offsets[entity]))
+            elif out_of_range[entity]:
+                errors.append(self.converter.invalid_offsets_error(index, self.begin_offsets[entity],
+                                                                   self.end_offsets[entity], maximum_offset))
+        for position in overlapping[documents[order[1:][overlapping]] == document].tolist():
+            errors.append(self.converter.overlapping_annotations_error(
+                index, self.label_values[order[position]], self.label_values[order[position + 1]]))
+        return errors
+
+
+"""
+    Writes the annotations to a Parquet file, or to an Arrow IPC file when the name ends with .arrow or .feather, with
+    the columns of annotations.csv. The Type column holds the text written to annotations.csv, null for a missing label.
+"""
+
+
+class AnnotationTableWriter:
+
+    def __init__(self, stream, filename):
+        if pyarrow is None:
+            raise ImportError("The annotations table requires pyarrow, install it with: pip install pyarrow")
+        self.is_arrow = os.path.splitext(filename)[1] in ('.arrow', '.feather')
+        self.schema = pyarrow.schema([('File', pyarrow.string()), ('Line', pyarrow.int64()),
+                                      ('Begin Offset', pyarrow.int64()), ('End Offset', pyarrow.int64()),
+                                      ('Type', pyarrow.string())])
+        if self.is_arrow:
+            self.writer = pyarrow.ipc.new_file(stream, self.schema)
+        else:
+            self.writer = pyarrow.parquet.ParquetWriter(stream, self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, file_name, lines, begin_offsets, end_offsets, labels):
+        try:
+            label_text = pyarrow.array(labels, pyarrow.string())
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            label_text = pyarrow.array([None if label is None else str(label) for label in labels], pyarrow.string())
+        self.writer.write_table(pyarrow.table([pyarrow.array([file_name] * len(lines), pyarrow.string()),
+                                               pyarrow.array(lines, pyarrow.int64()),
+                                               pyarrow.array(begin_offsets, pyarrow.int64()),
+                                               pyarrow.array(end_offsets, pyarrow.int64()),
+                                               label_text],
+                                              schema=self.schema))
+
+    def append(self, table_filename, line_offset):
+        # append the table written by a worker process for one shard of the manifest, rebasing its Line column
+        if self.is_arrow:
+            with pyarrow.memory_map(table_filename) as source:
+                table = pyarrow.ipc.open_file(source).read_all()
+        else:
+            table = pyarrow.parquet.read_table(table_filename, schema=self.schema)
+        if line_offset:
+            table = table.set_column(1, 'Line', pyarrow.compute.add(table.column('Line'), line_offset))
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+"""
+    Checkpoint of an incremental conversion of a growing output.manifest. It records the byte offset and index of the
+    first manifest line that is not converted yet, a hash of the manifest up to that offset, the number of rows written
+    to the dataset file, the length of every output file and the state the conversion carries to the next run, e.g. the
+    row counts of a split. The offset always follows a newline, a last line that is
+    still being written is left for the next run.
+    Example:
+    {"manifest_offset": 5271794, "line_index": 20011, "prefix_sha256": "9f86d0...", "dataset_line": 20011,
+     "output_lengths": {"dataset.csv": 1580869, "annotations.csv": 1236813}, "state": {}}
+"""
+
+
+class ConversionCheckpoint:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.manifest_offset = 0
+        self.line_index = 0
+        self.prefix_sha256 = hashlib.sha256().hexdigest()
+        self.dataset_line = 0
+        self.output_lengths = {}
+        self.state = {}
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return False
+        with open(self.filename, 'r', encoding='utf8') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        self.manifest_offset = checkpoint['manifest_offset']
+        self.line_index = checkpoint['line_index']
+        self.prefix_sha256 = checkpoint['prefix_sha256']
+        self.dataset_line = checkpoint['dataset_line']
+        self.output_lengths = checkpoint['output_lengths']
+        self.state = checkpoint.get('state', {})
+        return True
+
+    def save(self):
+        # write a new file and rename it, so that an interrupted run never leaves a truncated checkpoint
+        temporary_filename = self.filename + '.tmp'
+        with open(temporary_filename, 'w', encoding='utf8') as checkpoint_file:
+            json.dump({'manifest_offset': self.manifest_offset,
+                       'line_index': self.line_index,
+                       'prefix_sha256': self.prefix_sha256,
+                       'dataset_line': self.dataset_line,
+                       'output_lengths': self.output_lengths,
+                       'state': self.state}, checkpoint_file)
+        os.replace(temporary_filename, self.filename)
+
+    def verify_prefix(self, storage, manifest_uri, output_filenames):
+        # returns the running hash of the converted prefix when the manifest prefix and the outputs written from it are
+        # unchanged, None when the outputs must be rebuilt from the first line
+        if set(self.output_lengths) != set(output_filenames):
+            return None
+        for output_filename, length in self.output_lengths.items():
+            if not os.path.exists(output_filename) or os.path.getsize(output_filename) < length:
+                return None
+        if storage.size(manifest_uri) < self.manifest_offset:
+            return None
+        prefix_hash = hashlib.sha256()
+        scan_manifest_range(storage, manifest_uri, 0, self.manifest_offset, prefix_hash)
+        if prefix_hash.hexdigest() != self.prefix_sha256:
+            return None
+        return prefix_hash
+
+    def truncate_outputs(self):
+        # drop whatever was written after the checkpoint, e.g. the last line that was not complete or an interrupted run
+        for output_filename, length in self.output_lengths.items():
+            with open(output_filename, 'r+b') as output_file:
+                output_file.truncate(length)
+
+    def advance(self, storage, manifest_uri, end, prefix_hash, dataset_line, output_filenames, state=None):
+        # record that the manifest lines up to the byte offset end are converted and save the checkpoint
+        self.line_index += scan_manifest_range(storage, manifest_uri, self.manifest_offset, end, prefix_hash)
+        self.manifest_offset = end
+        self.prefix_sha256 = prefix_hash.hexdigest()
+        self.dataset_line = dataset_line
+        self.output_lengths = {output_filename: os.path.getsize(output_filename) for output_filename in output_filenames}
+        self.state = state or {}
+        self.save()
+
+
+def scan_manifest_range(storage, manifest_uri, start, end, prefix_hash):
+    # add the bytes [start, end) of the manifest to prefix_hash and return the number of lines in them
+    number_of_lines = 0
+    if start >= end:
+        return number_of_lines
+    with storage.open_read(manifest_uri, start, end) as manifest:
+        remaining = end - start
+        while remaining > 0:
+            block = manifest.read(min(READ_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            prefix_hash.update(block)
+            number_of_lines += block.count(b'\n')
+            remaining -= len(block)
+    return number_of_lines
+
+
+def find_complete_lines_end(storage, manifest_uri, start, file_size):
+    # offset just after the last newline of the manifest, the lines before it are complete
+    end = file_size
+    while end > start:
+        block_start = max(start, end - READ_BLOCK_SIZE)
+        with storage.open_read(manifest_uri, block_start, end) as manifest:
+            block = manifest.read(end - block_start)
+        newline = block.rfind(b'\n')
+        if newline != -1:
+            return block_start + newline + 1
+        end = block_start
+    return start
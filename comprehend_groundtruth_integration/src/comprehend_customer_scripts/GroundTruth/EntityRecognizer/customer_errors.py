@@ -1,3 +1,4 @@
+import re
 from string import Template
 
 CANNOT_PARSE_AUGMENTED_MANIFEST = Template('An augmented manifest file in your request is an invalid JSON lines file. '
@@ -17,5 +18,31 @@ INVALID_OFFSETS = Template('An offset exceeds the maximum length in the file ${d
 OVERLAPPING_ANNOTATIONS = Template('Overlapping annotations are located in the file ${doc} on line ${line}. '
                                    'Annotations must not overlap. The annotations are: ${annotations1} and ${annotations2}.')
 
+CONFLICTING_DUPLICATE = Template('The document on line ${line} of the file ${file} is a duplicate of an earlier document '
+                                 'with different annotations. Remove one of them or make their annotations agree.')
+
 
 INVALID_END_OFFSET = 'End Offset cannot be less than Begin Offset.'
+
+
+class CustomerError(Exception):
+    # error_type is the name of the template the message was built from; errors holds every violation found on the line
+    # when the converter collects all of them instead of stopping at the first one
+    def __init__(self, error_type, line, message, errors=None):
+        super().__init__(message)
+        self.error_type = error_type
+        self.line = line
+        self.message = message
+        self.errors = errors or [self]
+
+    def __reduce__(self):
+        # the errors are returned by the worker processes, errors defaulting to [self] is rebuilt by __init__
+        errors = None if self.errors == [self] else self.errors
+        return type(self), (self.error_type, self.line, self.message, errors)
+
+    def rebase(self, line_offset):
+        # the error of a shard numbered from another line: the templates write the line as "line N" or "line: N"
+        line = self.line + line_offset
+        message = re.sub(rf'\bline(:?) {self.line}\b', rf'line\g<1> {line}', self.message)
+        errors = None if self.errors == [self] else [error.rebase(line_offset) for error in self.errors]
+        return type(self)(self.error_type, line, message, errors)
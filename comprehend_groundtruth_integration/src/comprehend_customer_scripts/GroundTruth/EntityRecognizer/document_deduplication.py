@@ -0,0 +1,201 @@
+import json
+import mmap
+import os
+import shutil
+import tempfile
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+from heapq import merge
+
+FIRST_WINS = 'first-wins'
+UNION = 'union'
+REPORT = 'report'
+DEDUPLICATION_POLICIES = [FIRST_WINS, UNION, REPORT]
+NEW_DOCUMENT, DUPLICATE_DOCUMENT, CONFLICTING_DOCUMENT = range(3)
+INITIAL_CAPACITY = 1 << 16
+# digests held in memory before they are spilled to a sorted run on disk, 64 MiB of slots at most
+SPILL_THRESHOLD = 1 << 21
+MAXIMUM_RUNS = 8
+WRITE_CHUNK_SIZE = 1 << 16
+
+"""
+    Finds the documents whose text was already converted, with an index of 64-bit digests of the documents. The index is
+    an open addressing hash table of two arrays, the digests and a value per digest, probed linearly and grown at 3/4
+    load, so a document costs 16 bytes of slots instead of a Python set entry. With a spill directory, the table is
+    written as a sorted run of digests and values once it holds SPILL_THRESHOLD of them and is cleared; the runs are
+    memory mapped and searched by bisection, and merged into one when there are more than MAXIMUM_RUNS of them.
+    The policy decides what a duplicate with other labels than its first copy is:
+    first-wins drops it like any duplicate, report makes it a customer error and union adds its labels to the first copy.
+    Example: with the report policy, the value of a digest is the digest of the labels of the first copy, so
+    "Bob lives in Paris." with (12, 17, LOCATION) then with (0, 3, PERSON) is a conflict.
+"""
+
+
+def content_digest(text):
+    # 64-bit digest of the UTF-8 text, 0 marks the empty slots of the index
+    return int.from_bytes(blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+
+def labels_digest(labels):
+    return content_digest(json.dumps(sorted(labels)))
+
+
+class DocumentDeduplicator:
+
+    def __init__(self, policy=FIRST_WINS, spill_directory=None):
+        self.policy = policy
+        self.index = DigestIndex(spill_directory)
+        self.number_of_duplicates = 0
+        # with the union policy, the dataset row of the first copy of the last duplicate
+        self.first_row = None
+
+    def check(self, source, labels, row):
+        # NEW_DOCUMENT once the document is recorded, DUPLICATE_DOCUMENT, or CONFLICTING_DOCUMENT with the report
+        # policy when its labels differ from the ones of its first copy
+        if self.policy == UNION:
+            value = row
+        elif self.policy == REPORT:
+            value = labels_digest(labels)
+        else:
+            value = 0
+        previous = self.index.setdefault(content_digest(source), value)
+        if previous is None:
+            return NEW_DOCUMENT
+        if self.policy == REPORT and previous != value:
+            return CONFLICTING_DOCUMENT
+        self.first_row = previous
+        self.number_of_duplicates += 1
+        return DUPLICATE_DOCUMENT
+
+    def close(self):
+        self.index.close()
+
+
+class DigestIndex:
+
+    def __init__(self, spill_directory=None, spill_threshold=SPILL_THRESHOLD):
+        self.spill_directory = spill_directory
+        self.spill_threshold = spill_threshold
+        self.run_directory = None
+        self.runs = []
+        self.number_of_runs_written = 0
+        self._allocate(INITIAL_CAPACITY)
+
+    def _allocate(self, capacity):
+        self.mask = capacity - 1
+        self.digests = array('Q', bytes(8 * capacity))
+        self.values = array('Q', bytes(8 * capacity))
+        self.size = 0
+
+    def __len__(self):
+        return self.size + sum(len(run) for run in self.runs)
+
+    def setdefault(self, digest, value):
+        # the value of the digest when it is in the index, otherwise None once the digest is inserted with value
+        digests = self.digests
+        slot = digest & self.mask
+        while digests[slot]:
+            if digests[slot] == digest:
+                return self.values[slot]
+            slot = (slot + 1) & self.mask
+        for run in self.runs:
+            previous = run.get(digest)
+            if previous is not None:
+                return previous
+        digests[slot] = digest
+        self.values[slot] = value
+        self.size += 1
+        if self.spill_directory is not None and self.size >= self.spill_threshold:
+            self._spill()
+        elif 4 * self.size >= 3 * len(digests):
+            self._grow()
+        return None
+
+    def _grow(self):
+        digests, values = self.digests, self.values
+        self._allocate(2 * len(digests))
+        for digest, value in zip(digests, values):
+            if digest:
+                slot = digest & self.mask
+                while self.digests[slot]:
+                    slot = (slot + 1) & self.mask
+                self.digests[slot] = digest
+                self.values[slot] = value
+                self.size += 1
+
+    def _spill(self):
+        if self.run_directory is None:
+            self.run_directory = tempfile.mkdtemp(prefix='deduplication.', dir=self.spill_directory)
+        # bucket the digests by their top 4 bits, so that a single bucket at a time is sorted as a list of pairs
+        buckets = [(array('Q'), array('Q')) for _ in range(16)]
+        for digest, value in zip(self.digests, self.values):
+            if digest:
+                bucket_digests, bucket_values = buckets[digest >> 60]
+                bucket_digests.append(digest)
+                bucket_values.append(value)
+        self.runs.append(self._write_run(entry for bucket_digests, bucket_values in buckets
+                                         for entry in sorted(zip(bucket_digests, bucket_values))))
+        self._allocate(len(self.digests))
+        if len(self.runs) > MAXIMUM_RUNS:
+            runs = self.runs
+            self.runs = [self._write_run(merge(*runs))]
+            for run in runs:
+                run.close(remove=True)
+
+    def _write_run(self, entries):
+        filename = os.path.join(self.run_directory, f"run.{self.number_of_runs_written}")
+        self.number_of_runs_written += 1
+        with open(filename + '.digests', 'wb') as digests_file, open(filename + '.values', 'wb') as values_file:
+            digests, values = array('Q'), array('Q')
+            for digest, value in entries:
+                digests.append(digest)
+                values.append(value)
+                if len(digests) >= WRITE_CHUNK_SIZE:
+                    digests.tofile(digests_file)
+                    values.tofile(values_file)
+                    del digests[:], values[:]
+            digests.tofile(digests_file)
+            values.tofile(values_file)
+        return SpilledRun(filename)
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        if self.run_directory is not None:
+            shutil.rmtree(self.run_directory, ignore_errors=True)
+            self.run_directory = None
+
+
+class SpilledRun:
+    # the sorted digests and their values, memory mapped from the files filename.digests and filename.values
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.files = [open(filename + '.digests', 'rb'), open(filename + '.values', 'rb')]
+        self.maps = [mmap.mmap(run_file.fileno(), 0, access=mmap.ACCESS_READ) for run_file in self.files]
+        self.digests = memoryview(self.maps[0]).cast('Q')
+        self.values = memoryview(self.maps[1]).cast('Q')
+
+    def __len__(self):
+        return len(self.digests)
+
+    def __iter__(self):
+        return zip(self.digests, self.values)
+
+    def get(self, digest):
+        position = bisect_left(self.digests, digest)
+        if position < len(self.digests) and self.digests[position] == digest:
+            return self.values[position]
+        return None
+
+    def close(self, remove=False):
+        self.digests.release()
+        self.values.release()
+        for run_map, run_file in zip(self.maps, self.files):
+            run_map.close()
+            run_file.close()
+        if remove:
+            os.remove(self.filename + '.digests')
+            os.remove(self.filename + '.values')
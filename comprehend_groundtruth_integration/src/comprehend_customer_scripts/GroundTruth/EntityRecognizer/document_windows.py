@@ -0,0 +1,79 @@
+import re
+from bisect import bisect_left, bisect_right
+
+SENTENCE_BOUNDARY = re.compile(r'[.!?。！？]+["\')\]”’]*\s+')
+WHITESPACE_BOUNDARY = re.compile(r'\s+')
+
+"""
+    Splits a document larger than the size limit into consecutive windows that fit it, so that a long document is
+    trained on instead of failing the conversion. A window ends after the last sentence boundary that fits, or after the
+    last whitespace when no sentence boundary does, or at the last character that fits as a last resort. A window never
+    ends inside an entity. The windows are planned in one pass over the boundaries of the document, with the entities
+    sorted by begin offset and not overlapping, as they are once validated.
+    Example: with a limit of 12 bytes, "Bob lives. In Paris." is split into "Bob lives. " and "In Paris." and the entity
+    (14, 19, LOCATION) becomes (3, 8, LOCATION) of the second window.
+"""
+
+
+def plan_document_windows(source, annotations, offset_mapping, maximum_size):
+    # returns the (start, end) character positions of the windows, None when an entity does not fit in a window
+    sentence_cuts = [match.end() for match in SENTENCE_BOUNDARY.finditer(source)]
+    whitespace_cuts = [match.end() for match in WHITESPACE_BOUNDARY.finditer(source)]
+    begin_offsets = [annotation[2] for annotation in annotations]  # 2 represents the index of beginOffset in the tuple
+    end_offsets = [annotation[3] for annotation in annotations]  # 3 represents the index of endOffset in the tuple
+
+    def entity_around(position):
+        # index of the entity that the position falls strictly inside of, if any
+        entity = bisect_left(begin_offsets, position) - 1
+        if entity >= 0 and end_offsets[entity] > position:
+            return entity
+        return None
+
+    def last_cut(cuts, start, limit):
+        cut = bisect_right(cuts, limit) - 1
+        while cut >= 0 and cuts[cut] > start:
+            if entity_around(cuts[cut]) is None:
+                return cuts[cut]
+            cut -= 1
+        return None
+
+    windows = []
+    start = 0
+    while offset_mapping.to_byte_offset(len(source)) - offset_mapping.to_byte_offset(start) > maximum_size:
+        limit = _last_position_that_fits(offset_mapping, start, len(source), maximum_size)
+        cut = last_cut(sentence_cuts, start, limit) or last_cut(whitespace_cuts, start, limit)
+        if cut is None:
+            entity = entity_around(limit)
+            cut = limit if entity is None else begin_offsets[entity]
+            if cut <= start:
+                return None
+        windows.append((start, cut))
+        start = cut
+    windows.append((start, len(source)))
+    return windows
+
+
+def _last_position_that_fits(offset_mapping, start, end, maximum_size):
+    # binary search of the last character position whose window from start is at most maximum_size bytes
+    start_byte = offset_mapping.to_byte_offset(start)
+    low, high = start, min(end, start + maximum_size)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if offset_mapping.to_byte_offset(middle) - start_byte <= maximum_size:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def split_annotations(annotations, window_starts, window_ends):
+    # distribute the annotations, sorted by begin offset, over the windows and rebase their offsets to the window.
+    # The windows are given in the unit of the annotation offsets.
+    begin_offsets = [annotation[2] for annotation in annotations]
+    windows = []
+    for window_start, window_end in zip(window_starts, window_ends):
+        first = bisect_left(begin_offsets, window_start) if windows else 0
+        last = bisect_left(begin_offsets, window_end) if len(windows) < len(window_starts) - 1 else len(annotations)
+        windows.append([(file_name, index, begin_offset - window_start, end_offset - window_start, label)
+                        for file_name, index, begin_offset, end_offset, label in annotations[first:last]])
+    return windows
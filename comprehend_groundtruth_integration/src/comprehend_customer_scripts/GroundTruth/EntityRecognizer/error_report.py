@@ -0,0 +1,75 @@
+import csv
+import json
+import shutil
+import sys
+from collections import Counter
+from customer_errors import CustomerError
+
+ERROR_REPORT_CSV_HEADER = ['Line', 'Error Type', 'Message']
+
+"""
+    Records the customer errors of a --report-errors run, one record per violation. The report is written as CSV when
+    the file name ends with .csv and as JSON lines otherwise, e.g.
+    {"line": 12, "error_type": "OVERLAPPING_ANNOTATIONS", "message": "Overlapping annotations are located in ..."}
+"""
+
+
+class ErrorReport:
+
+    def __init__(self, filename, write_header=True):
+        self.filename = filename
+        self.is_csv = filename.endswith('.csv')
+        self.error_counts = Counter()
+        self.skipped_lines = 0
+        self.report_file = open(filename, 'w', encoding='utf8')
+        self.datawriter = csv.writer(self.report_file, delimiter=',', lineterminator='\n') if self.is_csv else None
+        if self.is_csv and write_header:
+            self.datawriter.writerow(ERROR_REPORT_CSV_HEADER)
+
+    def record(self, errors):
+        self.skipped_lines += 1
+        for error in errors:
+            self.error_counts[error.error_type] += 1
+            self._write(error)
+
+    def _write(self, error):
+        if self.is_csv:
+            self.datawriter.writerow([error.line, error.error_type, error.message])
+        else:
+            self.report_file.write(json.dumps({'line': error.line,
+                                               'error_type': error.error_type,
+                                               'message': error.message}) + '\n')
+
+    def merge(self, shard_filename, skipped_lines, error_counts, line_offset=0):
+        # append the report written by a worker process for one shard of the manifest, whose lines are numbered
+        # line_offset lines before their index in the manifest
+        with open(shard_filename, 'r', encoding='utf8') as shard_file:
+            if line_offset == 0:
+                shutil.copyfileobj(shard_file, self.report_file)
+            elif self.is_csv:
+                for line, error_type, message in csv.reader(shard_file):
+                    self._write(CustomerError(error_type, int(line), message).rebase(line_offset))
+            else:
+                for record in shard_file:
+                    record = json.loads(record)
+                    self._write(CustomerError(record['error_type'], record['line'], record['message'])
+                                .rebase(line_offset))
+        self.skipped_lines += skipped_lines
+        self.error_counts.update(error_counts)
+
+    def close(self):
+        self.report_file.close()
+
+    def print_summary(self, manifest_lines, duplicate_lines=0, first_line=0):
+        # manifest_lines is the number of manifest lines read, which is not the number of rows written: a document split
+        # into windows writes several rows. Every line is converted, skipped or, with --deduplicate, dropped as one of
+        # the duplicate_lines. Like the report, the summary only covers the lines of this run, which start at first_line
+        # when a checkpoint is resumed. It goes to stderr, stdout carries the output file names read by the shell scripts
+        converted_lines = manifest_lines - self.skipped_lines - duplicate_lines
+        lines = f"{manifest_lines} manifest lines" + (f" from line {first_line}" if first_line else "")
+        duplicates = f" and dropped {duplicate_lines} duplicate documents" if duplicate_lines else ""
+        print(f"Converted {converted_lines} of {lines}, skipped {self.skipped_lines} invalid lines{duplicates}.",
+              file=sys.stderr)
+        for error_type, count in sorted(self.error_counts.items()):
+            print(f"  {error_type}: {count}", file=sys.stderr)
+        print(f"The errors are reported in {self.filename}", file=sys.stderr)
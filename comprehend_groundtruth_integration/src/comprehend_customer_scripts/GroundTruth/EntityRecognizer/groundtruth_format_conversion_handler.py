@@ -1,22 +1,64 @@
 from groundtruth_to_comprehend_format_converter import GroundTruthToComprehendFormatConverter
+from manifest_shards import ManifestShard, ManifestShardLines, plan_manifest_shards, iter_manifest_shard_lines
+from manifest_index import open_manifest_index
+from conversion_checkpoint import ConversionCheckpoint, find_complete_lines_end
+from offset_mapping import OFFSET_UNITS, CHARACTER_OFFSETS
+from error_report import ErrorReport
+from customer_errors import CustomerError
+from columnar_annotations import ColumnarAnnotationStore, AnnotationTableWriter
+from document_deduplication import DocumentDeduplicator, FIRST_WINS, REPORT
+from storage import get_storage
 import csv
+import hashlib
+import io
 import json
+import os
+import shutil
+import sys
 import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from itertools import repeat
 from urllib.parse import urlparse
 
 ANNOTATION_CSV_HEADER = ['File', 'Line', 'Begin Offset', 'End Offset', 'Type']
+GROUNDTRUTH_MANIFEST_FILE_NAME = 'output.manifest'
+WRITE_BUFFER_SIZE = 1024 * 1024
 
 
 class GroundTruthFormatConversionHandler:
 
     def __init__(self):
         self.convert_object = GroundTruthToComprehendFormatConverter()
+        self.manifest_uri = GROUNDTRUTH_MANIFEST_FILE_NAME
         self.dataset_filename = ""
         self.annotation_filename = ""
+        # with upload, the outputs are streamed to the output S3Uri's instead of being written to local files
+        self.upload = False
+        self.dataset_uri = ""
+        self.annotation_uri = ""
+        self.error_report = None
+        # with a checkpoint, only the manifest lines appended since the previous run are converted
+        self.checkpoint = None
+        # the columnar backend validates the offsets of a batch of lines at once and can also write a Parquet table
+        self.columnar = False
+        self.annotation_table_uri = None
+        self.annotation_table = None
+        # index of the next row of the dataset file, which differs from the manifest line once invalid lines are skipped
+        self.dataset_line = 0
+        # the row this run starts at, which follows the rows of the previous runs of a checkpoint
+        self.first_dataset_line = 0
+        # number of manifest lines read by this run, converted or not, for the summary of the error report. With a
+        # checkpoint the run starts at manifest line first_manifest_line
+        self.manifest_lines = 0
+        self.first_manifest_line = 0
 
     def validate_s3_input(self, args):
         dataset_output_S3Uri = args.dataset_output_S3Uri
         annotations_output_S3Uri = args.annotations_output_S3Uri
+        self.dataset_uri = dataset_output_S3Uri
+        self.annotation_uri = annotations_output_S3Uri
 
         dataset_url = urlparse(dataset_output_S3Uri)
         dataset_scheme = dataset_url.scheme
@@ -32,38 +74,297 @@ class GroundTruthFormatConversionHandler:
         if dataset_scheme != "s3" or annotation_scheme != "s3" or self.dataset_filename.split(".")[-1] != "csv" or self.annotation_filename.split(".")[-1] != "csv":
             raise Exception("Either of the output S3 location provided is incorrect!")
         
-        # write header
+        # write header, the uploaded annotations get theirs when the upload is opened and a checkpointed run writes it
+        # only when the outputs are rebuilt
+        if not self.upload and self.checkpoint is None:
+            self.write_annotation_header()
+
+    def write_annotation_header(self):
         with open(self.annotation_filename, 'w', encoding='utf8') as annotation_file:
             datawriter = csv.writer(annotation_file, delimiter=',', lineterminator='\n')
             datawriter.writerow(ANNOTATION_CSV_HEADER)
+
+    @contextmanager
+    def open_outputs(self, newline=None):
+        # open the dataset and annotations outputs once: appended local files, or multipart uploads to S3
+        with ExitStack() as outputs:
+            if self.upload:
+                storage = get_storage(self.dataset_uri)
+                dataset_stream = outputs.enter_context(storage.open_write(self.dataset_uri))
+                annotation_stream = outputs.enter_context(storage.open_write(self.annotation_uri))
+            else:
+                dataset_stream = outputs.enter_context(open(self.dataset_filename, 'ab', buffering=WRITE_BUFFER_SIZE))
+                annotation_stream = outputs.enter_context(open(self.annotation_filename, 'ab',
+                                                               buffering=WRITE_BUFFER_SIZE))
+            # the text layers are detached instead of closed, so that each stream is closed by its own context, which
+            # aborts an S3 upload when the conversion fails
+            dataset = io.TextIOWrapper(dataset_stream, encoding='utf8', newline=newline)
+            outputs.callback(dataset.detach)
+            annotation_file = io.TextIOWrapper(annotation_stream, encoding='utf8', newline=newline)
+            outputs.callback(annotation_file.detach)
+            if self.upload:
+                csv.writer(annotation_file, delimiter=',', lineterminator='\n').writerow(ANNOTATION_CSV_HEADER)
+            if self.annotation_table_uri:
+                table_stream = outputs.enter_context(get_storage(self.annotation_table_uri).open_write(
+                    self.annotation_table_uri))
+                self.annotation_table = outputs.enter_context(AnnotationTableWriter(table_stream,
+                                                                                    self.annotation_table_uri))
+                outputs.callback(setattr, self, 'annotation_table', None)
+            yield dataset, annotation_file
     
-    def read_augmented_manifest_file(self):
-        with open('output.manifest', 'r', encoding='utf-8') as groundtruth_output_file:
-            for index, jsonLine in enumerate(groundtruth_output_file):
-                self.read_write_dataset_annotations(index, jsonLine)
+    def read_augmented_manifest_file(self, workers=1, start=0, end=None, first_line=0):
+        # convert the manifest lines in the byte range [start, end), the first of them being line first_line
+        if workers > 1:
+            self.read_augmented_manifest_shards(workers, start, end, first_line)
+            return
+        storage = get_storage(self.manifest_uri)
+        with self.open_outputs() as (dataset, annotation_file):
+            datawriter = csv.writer(annotation_file, delimiter=',', lineterminator='\n')
+            if start == 0 and end is None:
+                with storage.open_read(self.manifest_uri) as groundtruth_output_file:
+                    self.convert_manifest_lines(groundtruth_output_file, dataset, datawriter)
+            else:
+                end = storage.size(self.manifest_uri) if end is None else end
+                shard = ManifestShard(start, end, first_line)
+                self.convert_manifest_lines(iter_manifest_shard_lines(storage, self.manifest_uri, shard),
+                                            dataset, datawriter, first_line)
+
+    def read_augmented_manifest_incrementally(self, workers=1):
+        # resume from the checkpoint when the manifest only grew since it was saved, rebuild the outputs otherwise.
+        # Only complete lines are converted, a last line without newline may still be written and waits for the next run.
+        storage = get_storage(self.manifest_uri)
+        output_filenames = [self.dataset_filename, self.annotation_filename]
+        checkpoint = self.checkpoint
+        prefix_hash = None
+        if checkpoint.load():
+            prefix_hash = checkpoint.verify_prefix(storage, self.manifest_uri, output_filenames)
+        if prefix_hash is None:
+            checkpoint = self.checkpoint = ConversionCheckpoint(checkpoint.filename)
+            prefix_hash = hashlib.sha256()
+            open(self.dataset_filename, 'w').close()
+            self.write_annotation_header()
+        else:
+            checkpoint.truncate_outputs()
+        self.dataset_line = self.first_dataset_line = checkpoint.dataset_line
+        self.first_manifest_line = checkpoint.line_index
+
+        file_size = storage.size(self.manifest_uri)
+        complete_end = find_complete_lines_end(storage, self.manifest_uri, checkpoint.manifest_offset, file_size)
+        self.read_augmented_manifest_file(workers, checkpoint.manifest_offset, complete_end, checkpoint.line_index)
+        checkpoint.advance(storage, self.manifest_uri, complete_end, prefix_hash, self.dataset_line, output_filenames)
+        if complete_end < file_size:
+            print(f"The last {file_size - complete_end} bytes of the manifest are not a complete line yet, they are "
+                  f"converted by the next run", file=sys.stderr)
+
+    def read_augmented_manifest_shards(self, workers, start=0, end=None, first_line=0):
+        with open_manifest_index(self.manifest_uri) as manifest_index:
+            shards = plan_manifest_shards(get_storage(self.manifest_uri), self.manifest_uri, workers, start, end,
+                                          first_line, manifest_index)
+        report_errors = self.error_report is not None
+        error_extension = os.path.splitext(self.error_report.filename)[1] if report_errors else ''
+        table_extension = os.path.splitext(self.annotation_table_uri)[1] if self.annotation_table_uri else None
+        with tempfile.TemporaryDirectory(dir='.') as shard_directory, \
+                ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for shard_number, shard in enumerate(shards):
+                shard_filenames = [os.path.join(shard_directory, f"dataset.{shard_number}"),
+                                   os.path.join(shard_directory, f"annotations.{shard_number}"),
+                                   os.path.join(shard_directory, f"errors.{shard_number}{error_extension}"),
+                                   os.path.join(shard_directory, f"annotations.{shard_number}{table_extension}")
+                                   if table_extension is not None else None]
+                futures.append((shard, shard_filenames,
+                                executor.submit(convert_manifest_shard, self.manifest_uri, shard, *shard_filenames,
+                                                report_errors, self.columnar, self.convert_object.offset_unit,
+                                                self.convert_object.split_documents)))
+
+            # merge the shard outputs in manifest order, stopping at the first shard that failed like a serial run.
+            # The shards are already written with the platform line endings, so they are copied without translation.
+            # next_line is the index of the first line of the next shard in the manifest
+            next_line = first_line
+            with self.open_outputs(newline='') as (dataset, annotation_file):
+                for shard, (dataset_shard, annotation_shard, error_shard, table_shard), future in futures:
+                    error, number_of_lines, converted_lines, skipped_lines, error_counts = future.result()
+                    line_offset = next_line - shard.first_line
+                    next_line += number_of_lines
+                    if os.path.exists(dataset_shard):
+                        with open(dataset_shard, 'r', encoding='utf8', newline='') as shard_file:
+                            shutil.copyfileobj(shard_file, dataset, WRITE_BUFFER_SIZE)
+                    if os.path.exists(annotation_shard):
+                        # a shard numbers its rows as if no earlier line was skipped, rebase them when lines were
+                        self.append_annotation_shard(annotation_file, annotation_shard,
+                                                     self.dataset_line - shard.first_line)
+                    if table_shard is not None and os.path.exists(table_shard):
+                        self.annotation_table.append(table_shard, self.dataset_line - shard.first_line)
+                    if report_errors:
+                        self.error_report.merge(error_shard, skipped_lines, error_counts, line_offset)
+                    self.dataset_line += converted_lines
+                    self.manifest_lines += number_of_lines
+                    if error is not None:
+                        for _, _, pending in futures:
+                            pending.cancel()
+                        if line_offset and isinstance(error, CustomerError):
+                            raise error.rebase(line_offset)
+                        raise error
+
+    def append_annotation_shard(self, annotation_file, annotation_shard, line_offset):
+        with open(annotation_shard, 'r', encoding='utf8', newline='') as shard_file:
+            if line_offset == 0:
+                shutil.copyfileobj(shard_file, annotation_file, WRITE_BUFFER_SIZE)
+                return
+            datawriter = csv.writer(annotation_file, delimiter=',', lineterminator='\n')
+            for row in csv.reader(shard_file):
+                row[1] = int(row[1]) + line_offset  # 1 represents the index of the Line column
+                datawriter.writerow(row)
 
-    def read_write_dataset_annotations(self, index, jsonLine):
-        with open(self.dataset_filename, 'a', encoding='utf8') as dataset, open(self.annotation_filename, 'a', encoding='utf8') as annotation_file:
+    def convert_manifest_lines(self, groundtruth_output_lines, dataset, datawriter, first_index=0):
+        # the outputs are opened once and their large write buffers batch the rows instead of reopening per line
+        groundtruth_output_lines = self.count_manifest_lines(groundtruth_output_lines)
+        if self.columnar:
+            store = ColumnarAnnotationStore(self.convert_object)
+            for batch in store.iter_batches(groundtruth_output_lines, first_index, self.error_report):
+                self.write_annotation_batch(dataset, datawriter, batch)
+            return
+        for source, annotations in self.convert_object.iter_dataset_annotations(groundtruth_output_lines,
+                                                                                first_index,
+                                                                                self.error_report):
+            self.write_dataset_annotations(dataset, datawriter, source, annotations)
+
+    def count_manifest_lines(self, groundtruth_output_lines):
+        for jsonLine in groundtruth_output_lines:
+            self.manifest_lines += 1
+            yield jsonLine
+
+    def write_dataset_annotations(self, dataset, datawriter, source, annotations):
+        # write the document in the dataset file
+        source = json.dumps(source).strip('"')
+        dataset.write('"' + source + '"\n')
+
+        # write the annotations of each document in the annotations file, numbered by their row in the dataset file
+        if annotations and annotations[0][1] != self.dataset_line:
+            annotations = [(file_name, self.dataset_line, begin_offset, end_offset, label)
+                           for file_name, _, begin_offset, end_offset, label in annotations]
+        datawriter.writerows(annotations)
+        self.dataset_line += 1
+
+    def write_annotation_batch(self, dataset, datawriter, batch):
+        for source in batch.sources:
+            dataset.write('"' + json.dumps(source).strip('"') + '"\n')
+
+        lines = batch.rows + self.dataset_line
+        datawriter.writerows(zip(repeat(self.convert_object.input_file_name), lines.tolist(),
+                                 batch.begin_offsets.tolist(), batch.end_offsets.tolist(), batch.labels))
+        if self.annotation_table is not None:
+            self.annotation_table.write(self.convert_object.input_file_name, lines, batch.begin_offsets,
+                                        batch.end_offsets, batch.labels)
+        self.dataset_line += len(batch.sources)
+
+
+def convert_manifest_shard(manifest_uri, shard, dataset_filename, annotation_filename, error_filename, table_filename,
+                           report_errors, columnar, offset_unit, split_documents):
+    # runs in a worker process; the error is returned so that the rows converted before it are still merged
+    handler = GroundTruthFormatConversionHandler()
+    handler.dataset_filename = dataset_filename
+    handler.annotation_filename = annotation_filename
+    handler.columnar = columnar
+    handler.annotation_table_uri = table_filename
+    handler.convert_object.offset_unit = offset_unit
+    handler.convert_object.split_documents = split_documents
+    handler.dataset_line = shard.first_line
+    if report_errors:
+        handler.error_report = ErrorReport(error_filename, write_header=False)
+    error = None
+    lines = ManifestShardLines(get_storage(manifest_uri), manifest_uri, shard)
+    try:
+        with handler.open_outputs() as (dataset, annotation_file):
             datawriter = csv.writer(annotation_file, delimiter=',', lineterminator='\n')
-            source, annotations = self.convert_object.convert_to_dataset_annotations(index, jsonLine)
-            # write the document in the dataset file
-            source = json.dumps(source).strip('"')
-            dataset.write('"' + source + '"')
-            dataset.write("\n")
-            
-            # write the annotations of each document in the annotations file
-            for entry in annotations:
-                datawriter.writerow(entry)
-                
+            handler.convert_manifest_lines(lines, dataset, datawriter, shard.first_line)
+    except Exception as e:
+        error = e
+    converted_lines = handler.dataset_line - shard.first_line
+    if not report_errors:
+        return error, lines.number_of_lines, converted_lines, 0, {}
+    handler.error_report.close()
+    return error, lines.number_of_lines, converted_lines, handler.error_report.skipped_lines, \
+        dict(handler.error_report.error_counts)
+
 
 def main():
     parser = argparse.ArgumentParser(description="Parsing the output S3Uri")
     parser.add_argument('dataset_output_S3Uri')
     parser.add_argument('annotations_output_S3Uri')
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes converting newline aligned shards of the manifest")
+    parser.add_argument('--report-errors', dest='error_report_filename',
+                        help="Record every invalid manifest line in this JSON lines (or .csv) file and skip it, "
+                             "instead of failing on the first one")
+    parser.add_argument('--manifest-uri', default=GROUNDTRUTH_MANIFEST_FILE_NAME,
+                        help="Local path or S3Uri of the output.manifest file, an S3 manifest is streamed")
+    parser.add_argument('--upload', action='store_true',
+                        help="Stream the outputs to the output S3Uri's instead of writing local files")
+    parser.add_argument('--checkpoint',
+                        help="Checkpoint file of an incremental conversion: convert only the manifest lines appended "
+                             "since the previous run and append them to the local outputs")
+    parser.add_argument('--columnar', action='store_true',
+                        help="Validate the annotation offsets of batches of lines with NumPy, requires numpy")
+    parser.add_argument('--annotations-table',
+                        help="Also write the annotations to this Parquet file, or Arrow file when it ends with .arrow, "
+                             "local path or S3Uri, requires pyarrow and implies --columnar")
+    parser.add_argument('--offset-unit', choices=OFFSET_UNITS, default=CHARACTER_OFFSETS,
+                        help="Write the annotation offsets as character offsets, like GroundTruth, or as byte offsets "
+                             "in the UTF-8 encoded document")
+    parser.add_argument('--split-documents', action='store_true',
+                        help="Split the documents larger than the size limit into windows at sentence or whitespace "
+                             "boundaries, instead of failing on them")
+    parser.add_argument('--deduplicate', choices=[FIRST_WINS, REPORT],
+                        help="Convert only the first copy of documents with the same text. A copy with other "
+                             "annotations is dropped with first-wins and is an error with report")
+    parser.add_argument('--deduplication-spill-directory',
+                        help="Spill the document digests of --deduplicate to sorted files in this directory, to bound "
+                             "the memory of large manifests")
     args = parser.parse_args()
+    if args.checkpoint and args.upload:
+        parser.error("--checkpoint appends to the local outputs and cannot be combined with --upload")
+    if args.checkpoint and args.annotations_table:
+        parser.error("--checkpoint appends to the local outputs and cannot be combined with --annotations-table")
+    if args.deduplicate and (args.workers > 1 or args.checkpoint):
+        parser.error("--deduplicate needs every document of the manifest in one process and cannot be combined with "
+                     "--workers or --checkpoint")
     handler = GroundTruthFormatConversionHandler()
+    handler.manifest_uri = args.manifest_uri
+    handler.upload = args.upload
+    handler.columnar = args.columnar or args.annotations_table is not None
+    handler.annotation_table_uri = args.annotations_table
+    handler.convert_object.offset_unit = args.offset_unit
+    handler.convert_object.split_documents = args.split_documents
+    if args.checkpoint:
+        handler.checkpoint = ConversionCheckpoint(args.checkpoint)
     handler.validate_s3_input(args)
-    handler.read_augmented_manifest_file()
+    if args.error_report_filename:
+        handler.error_report = ErrorReport(args.error_report_filename)
+    if args.deduplicate:
+        handler.convert_object.deduplicator = DocumentDeduplicator(args.deduplicate,
+                                                                   args.deduplication_spill_directory)
+    try:
+        if handler.checkpoint is not None:
+            handler.read_augmented_manifest_incrementally(args.workers)
+        else:
+            handler.read_augmented_manifest_file(args.workers)
+    finally:
+        if handler.convert_object.deduplicator is not None:
+            handler.convert_object.deduplicator.close()
+    deduplicator = handler.convert_object.deduplicator
+    duplicate_lines = deduplicator.number_of_duplicates if deduplicator is not None else 0
+    skipped_lines = 0
+    if handler.error_report is not None:
+        handler.error_report.close()
+        handler.error_report.print_summary(handler.manifest_lines, duplicate_lines, handler.first_manifest_line)
+        skipped_lines = handler.error_report.skipped_lines
+    elif deduplicator is not None:
+        print(f"Dropped {duplicate_lines} duplicate documents.", file=sys.stderr)
+    if handler.convert_object.split_documents:
+        # a document split into windows writes a row per window
+        print(f"Wrote {handler.dataset_line - handler.first_dataset_line} rows from "
+              f"{handler.manifest_lines - skipped_lines - duplicate_lines} documents.", file=sys.stderr)
 
 
 if __name__ == "__main__":
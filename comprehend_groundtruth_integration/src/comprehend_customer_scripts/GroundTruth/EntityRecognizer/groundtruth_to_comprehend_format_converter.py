@@ -1,7 +1,10 @@
-import json
 from operator import itemgetter
+from json_decoder import loads
+from offset_mapping import OffsetMapping, BYTE_OFFSETS, CHARACTER_OFFSETS
+from document_windows import plan_document_windows, split_annotations
+from document_deduplication import DUPLICATE_DOCUMENT, CONFLICTING_DOCUMENT
 from customer_errors import CANNOT_PARSE_AUGMENTED_MANIFEST, DOC_SIZE_EXCEEDED, WRONG_ANNOTATION, INVALID_END_OFFSET, \
-    INVALID_OFFSETS, OVERLAPPING_ANNOTATIONS
+    INVALID_OFFSETS, OVERLAPPING_ANNOTATIONS, CONFLICTING_DUPLICATE, CustomerError
 
 SOURCE = 'source'
 ANNOTATIONS = 'annotations'
@@ -12,82 +15,216 @@ LABEL = 'label'
 MAX_TRAIN_DOC_SIZE = 5000
 
 
+"""
+    Learns the layout of the augmented manifest lines: the attribute holding the labeling job annotations and the top
+    level keys. Lines of a labeling job share the same layout, so once it is learned the labeling job attribute is found
+    with a dict lookup. A line that does not match the layout is scanned again.
+"""
+
+
+class ManifestSchema:
+
+    def __init__(self):
+        self.attribute_name = None
+        self.keys = None
+        self.trailing_keys = ()
+
+    def learn(self, jsonObj, attribute_name):
+        self.attribute_name = attribute_name
+        self.keys = tuple(jsonObj)
+        # the scan takes the last attribute holding annotations, so the attributes after it must still hold none
+        self.trailing_keys = self.keys[self.keys.index(attribute_name) + 1:]
+
+    def matches(self, jsonObj):
+        if self.attribute_name is None or tuple(jsonObj) != self.keys:
+            return False
+        return is_entity_annotation_payload(jsonObj[self.attribute_name]) and \
+            not any(isinstance(jsonObj[key], dict) and ANNOTATIONS in jsonObj[key] for key in self.trailing_keys)
+
+
+def is_entity_annotation_payload(value):
+    return isinstance(value, dict) and isinstance(value.get(ANNOTATIONS), dict) and ENTITIES in value[ANNOTATIONS]
+
+
 class GroundTruthToComprehendFormatConverter:
 
     def __init__(self):
         self.input_file_name = "dataset.csv"
         self.groundtruth_manifest_file_name = "output.manifest"
         self.labeling_job_name = ""
+        # the annotation offsets are character offsets, they are validated against the number of characters of the
+        # source and written as character offsets or, with BYTE_OFFSETS, as offsets in its UTF-8 encoding
         self.maximum_offset = 0
+        self.offset_mapping = None
+        self.offset_unit = CHARACTER_OFFSETS
+        # with split_documents, a document over MAX_TRAIN_DOC_SIZE is split into windows instead of being rejected
+        self.split_documents = False
+        # with a DocumentDeduplicator, a document whose text was already converted is dropped
+        self.deduplicator = None
+        self.manifest_schema = ManifestSchema()
+        self.collect_errors = False
+        self.line_errors = []
 
     def convert_to_dataset_annotations(self, index, jsonLine):
-        # parse the jsonLine to generate the dataset entry
-        jsonObj = self.parse_manifest_input(jsonLine)
-        if SOURCE not in jsonObj:
-            raise Exception(CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(line=index,
-                                                                       file_name=self.groundtruth_manifest_file_name))
-        source = jsonObj[SOURCE]
-        if len(source.encode('utf-8')) > MAX_TRAIN_DOC_SIZE:
-            raise Exception(DOC_SIZE_EXCEEDED.substitute(file=self.groundtruth_manifest_file_name,
-                                                         line=index,
-                                                         size=MAX_TRAIN_DOC_SIZE))
-        self.maximum_offset = len(source.encode('utf-8'))
+        source, annotations = self.convert_to_character_annotations(index, jsonLine)
+        if self.offset_unit == BYTE_OFFSETS:
+            annotations = self._to_byte_offsets(annotations)
+        return source, annotations
+
+    def convert_to_dataset_documents(self, index, jsonLine):
+        # the (source, annotations) pair of every dataset row of the line: a single one, or one per window of a
+        # document over MAX_TRAIN_DOC_SIZE with split_documents
+        source, annotations = self.convert_to_character_annotations(index, jsonLine)
+        windows = None
+        if self.split_documents and self.offset_mapping.number_of_bytes > MAX_TRAIN_DOC_SIZE:
+            windows = plan_document_windows(source, annotations, self.offset_mapping, MAX_TRAIN_DOC_SIZE)
+            if windows is None:
+                raise self.document_size_error(index)
+        if self.deduplicator is not None and self.is_duplicate(index, source, annotations):
+            return []
+        if self.offset_unit == BYTE_OFFSETS:
+            annotations = self._to_byte_offsets(annotations)
+        if windows is None:
+            return [(source, annotations)]
+        window_starts = [start for start, _ in windows]
+        window_ends = [end for _, end in windows]
+        if self.offset_unit == BYTE_OFFSETS:
+            window_starts = self.offset_mapping.to_byte_offsets(window_starts)
+            window_ends = self.offset_mapping.to_byte_offsets(window_ends)
+        return list(zip([source[start:end] for start, end in windows],
+                        split_annotations(annotations, window_starts, window_ends)))
+
+    def is_duplicate(self, index, source, annotations):
+        # the annotations are compared in character offsets, as (begin offset, end offset, label)
+        status = self.deduplicator.check(source, [annotation[2:] for annotation in annotations], index)
+        if status == CONFLICTING_DOCUMENT:
+            raise CustomerError('CONFLICTING_DUPLICATE', index,
+                                CONFLICTING_DUPLICATE.substitute(line=index, file=self.groundtruth_manifest_file_name))
+        return status == DUPLICATE_DOCUMENT
+
+    def _to_byte_offsets(self, annotations):
+        return [(file_name, index, self.offset_mapping.to_byte_offset(begin_offset),
+                 self.offset_mapping.to_byte_offset(end_offset), label)
+                for file_name, index, begin_offset, end_offset, label in annotations]
+
+    def convert_to_character_annotations(self, index, jsonLine):
+        source, entities = self.extract_entities(index, jsonLine)
 
         # parse the jsonLine to generate the annotations entry
         annotations = []
-        
-        self.labeling_job_name = self.get_labeling_job_name(index, jsonObj)
-        number_of_labels = len(jsonObj[self.labeling_job_name][ANNOTATIONS][ENTITIES])
-        labeling_job_info = jsonObj[self.labeling_job_name][ANNOTATIONS][ENTITIES]
-        for ind in range(number_of_labels):
-            begin_offset = int(labeling_job_info[ind][START_OFFSET])
-            end_offset = int(labeling_job_info[ind][END_OFFSET])
-            label = labeling_job_info[ind][LABEL]
+        for entity in entities:
+            begin_offset = int(entity[START_OFFSET])
+            end_offset = int(entity[END_OFFSET])
+            label = entity[LABEL]
             if end_offset < begin_offset:
-                raise Exception(WRONG_ANNOTATION.substitute(file_name=self.groundtruth_manifest_file_name,
-                                                            line=int(index),
-                                                            begin_offset=begin_offset,
-                                                            end_offset=end_offset,
-                                                            message=INVALID_END_OFFSET))
+                self._customer_error(self.wrong_annotation_error(index, begin_offset, end_offset))
+                continue
             if (begin_offset >= self.maximum_offset) or (end_offset > self.maximum_offset):
-                raise Exception(INVALID_OFFSETS.substitute(doc=self.groundtruth_manifest_file_name,
-                                                           line_index=index,
-                                                           begin_offset=begin_offset,
-                                                           end_offset=end_offset,
-                                                           line_size=self.maximum_offset))
+                self._customer_error(self.invalid_offsets_error(index, begin_offset, end_offset, self.maximum_offset))
+                continue
             annotations.append((self.input_file_name, index, begin_offset, end_offset, label))
         
         self._check_for_overlapping_annotations(annotations)
-           
+
+        if self.line_errors:
+            first_error = self.line_errors[0]
+            raise CustomerError(first_error.error_type, index, first_error.message, errors=self.line_errors)
         return source, annotations
 
+    def extract_entities(self, index, jsonLine):
+        # parse the jsonLine and return the source with its entities, before their offsets are validated
+        self.line_errors = []
+        jsonObj = self.parse_manifest_input(jsonLine)
+        if SOURCE not in jsonObj:
+            raise CustomerError('CANNOT_PARSE_AUGMENTED_MANIFEST', index,
+                                CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(line=index,
+                                                                           file_name=self.groundtruth_manifest_file_name))
+        source = jsonObj[SOURCE]
+        self.offset_mapping = OffsetMapping(source)
+        if self.offset_mapping.number_of_bytes > MAX_TRAIN_DOC_SIZE and not self.split_documents:
+            self._customer_error(self.document_size_error(index))
+        self.maximum_offset = self.offset_mapping.number_of_characters
+
+        self.labeling_job_name = self.get_labeling_job_name(index, jsonObj)
+        return source, jsonObj[self.labeling_job_name][ANNOTATIONS][ENTITIES]
+
+    def document_size_error(self, index):
+        return CustomerError('DOC_SIZE_EXCEEDED', index,
+                             DOC_SIZE_EXCEEDED.substitute(file=self.groundtruth_manifest_file_name,
+                                                          line=index,
+                                                          size=MAX_TRAIN_DOC_SIZE))
+
+    def wrong_annotation_error(self, index, begin_offset, end_offset):
+        return CustomerError('WRONG_ANNOTATION', index,
+                             WRONG_ANNOTATION.substitute(file_name=self.groundtruth_manifest_file_name,
+                                                         line=int(index),
+                                                         begin_offset=begin_offset,
+                                                         end_offset=end_offset,
+                                                         message=INVALID_END_OFFSET))
+
+    def invalid_offsets_error(self, index, begin_offset, end_offset, maximum_offset):
+        return CustomerError('INVALID_OFFSETS', index,
+                             INVALID_OFFSETS.substitute(doc=self.groundtruth_manifest_file_name,
+                                                        line_index=index,
+                                                        begin_offset=begin_offset,
+                                                        end_offset=end_offset,
+                                                        line_size=maximum_offset))
+
+    def overlapping_annotations_error(self, index, previous_label, label):
+        return CustomerError('OVERLAPPING_ANNOTATIONS', index,
+                             OVERLAPPING_ANNOTATIONS.substitute(doc=self.groundtruth_manifest_file_name,
+                                                                line=index,
+                                                                annotations1=previous_label,
+                                                                annotations2=label))
+
+    def iter_dataset_annotations(self, groundtruth_output_lines, first_index=0, error_report=None):
+        # yield the converted (source, annotations) pair of each dataset row without going through the csv files.
+        # With an error_report, every violation is recorded in it and the invalid lines are skipped instead of raising.
+        self.collect_errors = error_report is not None
+        for index, jsonLine in enumerate(groundtruth_output_lines, first_index):
+            if error_report is None:
+                yield from self.convert_to_dataset_documents(index, jsonLine)
+                continue
+            try:
+                converted = self.convert_to_dataset_documents(index, jsonLine)
+            except CustomerError as e:
+                error_report.record(e.errors)
+                continue
+            except (ValueError, KeyError, TypeError, AttributeError):
+                error_report.record([CustomerError('CANNOT_PARSE_AUGMENTED_MANIFEST', index,
+                                                   CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(
+                                                       line=index, file_name=self.groundtruth_manifest_file_name))])
+                continue
+            yield from converted
+
+    def _customer_error(self, error):
+        if not self.collect_errors:
+            raise error
+        self.line_errors.append(error)
+
     def parse_manifest_input(self, jsonLine):
         try:
-            jsonObj = json.loads(jsonLine)
+            jsonObj = loads(jsonLine)
             return jsonObj
         except ValueError as e:
             print(f"Error decoding the string: {jsonLine}, {e}")
             raise
 
     def get_labeling_job_name(self, index, jsonObj):
+        if self.manifest_schema.matches(jsonObj):
+            return self.manifest_schema.attribute_name
+
         job_name = None
         for key, value in jsonObj.items():
-            if self.is_json_serializable(value):
-                if ANNOTATIONS in value:
-                    job_name = key
-        if job_name is None or ANNOTATIONS not in jsonObj[job_name].keys() or ENTITIES not in jsonObj[job_name][ANNOTATIONS].keys():
-            raise Exception(CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(line=index,
-                                                                       file_name=self.groundtruth_manifest_file_name))
+            if isinstance(value, dict) and ANNOTATIONS in value:
+                job_name = key
+        if job_name is None or not is_entity_annotation_payload(jsonObj[job_name]):
+            raise CustomerError('CANNOT_PARSE_AUGMENTED_MANIFEST', index,
+                                CANNOT_PARSE_AUGMENTED_MANIFEST.substitute(line=index,
+                                                                           file_name=self.groundtruth_manifest_file_name))
+        self.manifest_schema.learn(jsonObj, job_name)
         return job_name
 
-    def is_json_serializable(self, value):
-        try:
-            json.dumps(value)
-            return True
-        except ValueError as e:
-            print(e)
-            return False
-    
     """
         Example: annotations = [(doc.txt,0,25,16,DATE), (doc.txt,0,0,3,PROGRAMMER), (doc.txt,0,55,66,LOCATION)]
         Sort the annotations based on the begin offset,
@@ -102,7 +239,6 @@ class GroundTruthToComprehendFormatConverter:
             previous_end_offset = annotations[i - 1][3]  # 3 represents the index of the endOffset in the previous tuple
             current_begin_offset = annotations[i][2]  # 2 represents the index of the beginOffset in the current tuple
             if previous_end_offset > current_begin_offset:
-                raise Exception(OVERLAPPING_ANNOTATIONS.substitute(doc=self.groundtruth_manifest_file_name,
-                                                                   line=annotations[i][1],
-                                                                   annotations1=annotations[i - 1][4], # represents entity types in the previous tuple that is overlapping
-                                                                   annotations2=annotations[i][4]))  # represents other entity type in the current tuple that is overlapping
+                # 4 represents the entity types of the overlapping tuples
+                self._customer_error(self.overlapping_annotations_error(annotations[i][1], annotations[i - 1][4],
+                                                                        annotations[i][4]))
@@ -0,0 +1,53 @@
+import re
+from array import array
+from bisect import bisect_left
+
+CHARACTER_OFFSETS = 'character'
+BYTE_OFFSETS = 'byte'
+OFFSET_UNITS = [CHARACTER_OFFSETS, BYTE_OFFSETS]
+NON_ASCII_CHARACTER = re.compile('[^\x00-\x7f]')
+
+"""
+    Maps the character offsets of a document, the offsets of the GroundTruth annotations, to the offsets of the same
+    positions in its UTF-8 encoding. An ASCII document maps every offset to itself. Otherwise the first mapped offset
+    indexes the document in one pass: the positions of the non ASCII characters are recorded with the number of extra
+    bytes encoded up to each of them, and an offset is mapped with a binary search over those positions.
+    Example: "é1€" is encoded in 2 + 1 + 3 bytes, non_ascii_positions = [0, 2] and extra_bytes = [0, 1, 3], so the
+    character offsets 0, 1, 2, 3 map to the byte offsets 0, 2, 3, 6.
+"""
+
+
+class OffsetMapping:
+
+    __slots__ = ['source', 'number_of_characters', 'number_of_bytes', 'non_ascii_positions', 'extra_bytes']
+
+    def __init__(self, source):
+        self.source = source
+        self.number_of_characters = len(source)
+        self.number_of_bytes = len(source.encode('utf-8'))
+        self.non_ascii_positions = None
+        self.extra_bytes = None
+
+    @property
+    def is_ascii(self):
+        return self.number_of_bytes == self.number_of_characters
+
+    def _index(self):
+        self.non_ascii_positions = array('q')
+        self.extra_bytes = array('q', [0])
+        extra_bytes = 0
+        for match in NON_ASCII_CHARACTER.finditer(self.source):
+            code_point = ord(match.group())
+            extra_bytes += 1 if code_point < 0x800 else 2 if code_point < 0x10000 else 3
+            self.non_ascii_positions.append(match.start())
+            self.extra_bytes.append(extra_bytes)
+
+    def to_byte_offset(self, character_offset):
+        if self.number_of_bytes == self.number_of_characters:
+            return character_offset
+        if self.non_ascii_positions is None:
+            self._index()
+        return character_offset + self.extra_bytes[bisect_left(self.non_ascii_positions, character_offset)]
+
+    def to_byte_offsets(self, character_offsets):
+        return [self.to_byte_offset(character_offset) for character_offset in character_offsets]
@@ -0,0 +1,168 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+READ_BUFFER_SIZE = 1024 * 1024
+MULTIPART_PART_SIZE = 8 * 1024 * 1024  # S3 requires at least 5 MiB for every part but the last one
+MULTIPART_CONCURRENCY = 4
+
+"""
+    Storage layer of the conversion handlers. The manifest is read as a binary stream and the outputs are written as
+    binary streams, so the handlers convert straight from and to S3 without a local copy of the files. LocalStorage
+    reads and writes files on disk and is the stand-in used when the handlers run on local files.
+"""
+
+
+def get_storage(uri, s3_client=None):
+    if urlparse(uri).scheme == 's3':
+        return S3Storage(s3_client)
+    return LocalStorage()
+
+
+class LocalStorage:
+
+    def size(self, path):
+        return os.path.getsize(path)
+
+    def open_read(self, path, start=0, end=None):
+        manifest = open(path, 'rb', buffering=READ_BUFFER_SIZE)
+        manifest.seek(start)
+        return manifest
+
+    def open_write(self, path, append=False):
+        return open(path, 'ab' if append else 'wb')
+
+
+class S3Storage:
+
+    def __init__(self, s3_client=None):
+        if s3_client is None:
+            import boto3
+            s3_client = boto3.client('s3')
+        self.s3_client = s3_client
+
+    def size(self, uri):
+        bucket, key = bucket_key_from_s3_uri(uri)
+        return self.s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+    def open_read(self, uri, start=0, end=None):
+        bucket, key = bucket_key_from_s3_uri(uri)
+        if start or end is not None:
+            byte_range = f"bytes={start}-{'' if end is None else end - 1}"
+            body = self.s3_client.get_object(Bucket=bucket, Key=key, Range=byte_range)['Body']
+        else:
+            body = self.s3_client.get_object(Bucket=bucket, Key=key)['Body']
+        return io.BufferedReader(S3BodyReader(body), buffer_size=READ_BUFFER_SIZE)
+
+    def open_write(self, uri, append=False):
+        if append:
+            raise ValueError(f"S3 objects cannot be appended to: {uri}")
+        bucket, key = bucket_key_from_s3_uri(uri)
+        return S3UploadStream(S3MultipartWriter(self.s3_client, bucket, key), buffer_size=MULTIPART_PART_SIZE)
+
+
+def bucket_key_from_s3_uri(uri):
+    s3_url = urlparse(uri, allow_fragments=False)
+    return s3_url.netloc, s3_url.path.lstrip('/')
+
+
+class S3BodyReader(io.RawIOBase):
+    # adapts the streamed S3 body to a raw stream, so that io.BufferedReader can iterate over its lines
+
+    def __init__(self, body):
+        self.body = body
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.body.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.body.close()
+        super().close()
+
+
+class S3UploadStream(io.BufferedWriter):
+    # the object is only published when the with block of the stream exits normally, leaving it on an exception aborts
+    # the upload so that a failed conversion does not overwrite the output with a partial object
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.raw.abort()
+        return super().__exit__(exc_type, exc_value, traceback)
+
+
+class S3MultipartWriter(io.RawIOBase):
+    # uploads the written bytes as parts of a multipart upload, MULTIPART_CONCURRENCY parts at a time. Objects smaller
+    # than one part are uploaded with a single put_object when the writer is closed.
+
+    def __init__(self, s3_client, bucket, key):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.executor = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= MULTIPART_PART_SIZE:
+            self._upload_part(bytes(self.buffer[:MULTIPART_PART_SIZE]))
+            del self.buffer[:MULTIPART_PART_SIZE]
+        return len(data)
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+            self.executor = ThreadPoolExecutor(max_workers=MULTIPART_CONCURRENCY)
+        # bound the parts held in memory to the ones being uploaded
+        if len(self.parts) >= MULTIPART_CONCURRENCY:
+            self.parts[-MULTIPART_CONCURRENCY].result()
+        part_number = len(self.parts) + 1
+        self.parts.append(self.executor.submit(self.s3_client.upload_part, Bucket=self.bucket, Key=self.key,
+                                               UploadId=self.upload_id, PartNumber=part_number, Body=data))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self._upload_part(bytes(self.buffer))
+                parts = [{'ETag': part.result()['ETag'], 'PartNumber': part_number}
+                         for part_number, part in enumerate(self.parts, 1)]
+                self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                         MultipartUpload={'Parts': parts})
+        except Exception:
+            if self.upload_id is not None:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            raise
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.buffer = bytearray()
+            super().close()
+
+    def abort(self):
+        # close without publishing the object, the parts uploaded so far are discarded
+        if self.closed:
+            return
+        try:
+            if self.executor is not None:
+                self.executor.shutdown()
+            if self.upload_id is not None:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        finally:
+            self.buffer = bytearray()
+            super().close()
@@ -0,0 +1,140 @@
+from math import isfinite
+
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.annotation_model import (
+    BlockFields, BlockReferenceFields, BoundingBoxFields, ChildBlockFields, EntitiesFields, Fields, GeometryFields,
+    PolygonCoordinateFields, RelationshipFields
+)
+
+# the largest integers a Float field converts exactly, larger ones are left to marshmallow
+MAX_EXACT_INTEGER = 2 ** 53
+TEXT_BLOCK_TYPES = ("WORD", "LINE")
+
+VERSION = Fields.VERSION.value
+DOCUMENT_TYPE = Fields.DOCUMENT_TYPE.value
+DOCUMENT_METADATA = Fields.DOCUMENT_METADATA.value
+BLOCKS = Fields.BLOCKS.value
+ENTITIES = Fields.ENTITIES.value
+BLOCK_TYPE = BlockFields.BLOCK_TYPE.value
+ID = BlockFields.ID.value
+TEXT = BlockFields.TEXT.value
+GEOMETRY = BlockFields.GEOMETRY.value
+RELATIONSHIPS = BlockFields.RELATIONSHIPS.value
+PAGE = BlockFields.PAGE.value
+BOUNDING_BOX = GeometryFields.BOUNDING_BOX.value
+POLYGON = GeometryFields.POLYGON.value
+BOUNDING_BOX_FIELDS = tuple(field.value for field in BoundingBoxFields)
+X = PolygonCoordinateFields.X.value
+Y = PolygonCoordinateFields.Y.value
+RELATIONSHIP_IDS = RelationshipFields.IDS.value
+RELATIONSHIP_TYPE = RelationshipFields.TYPE.value
+ENTITY_TEXT = EntitiesFields.TEXT.value
+ENTITY_TYPE = EntitiesFields.TYPE.value
+SCORE = EntitiesFields.SCORE.value
+BLOCK_REFERENCES = EntitiesFields.BLOCK_REFERENCES.value
+BEGIN_OFFSET = BlockReferenceFields.BEGIN_OFFSET.value
+END_OFFSET = BlockReferenceFields.END_OFFSET.value
+BLOCK_ID = BlockReferenceFields.BLOCK_ID.value
+CHILD_BLOCKS = BlockReferenceFields.CHILD_BLOCKS.value
+CHILD_BLOCK_ID = ChildBlockFields.CHILD_BLOCK_ID.value
+
+
+def _is_float(value) -> bool:
+    value_type = type(value)
+    if value_type is float:
+        return isfinite(value)
+    return value_type is int and -MAX_EXACT_INTEGER <= value <= MAX_EXACT_INTEGER
+
+
+def _is_valid_block(block) -> bool:
+    if type(block) is not dict or type(block.get(ID)) is not str:
+        return False
+    block_type = block.get(BLOCK_TYPE)
+    text = block.get(TEXT)
+    if type(block_type) is not str or (text is not None and type(text) is not str):
+        return False
+    # BlockSchema.validate_text_field
+    if not text and block_type in TEXT_BLOCK_TYPES:
+        return False
+    page = block.get(PAGE)
+    if page is not None and type(page) is not int:
+        return False
+    relationships = block.get(RELATIONSHIPS)
+    if relationships is not None:
+        if type(relationships) is not list:
+            return False
+        for relationship in relationships:
+            if type(relationship) is not dict:
+                return False
+            if RELATIONSHIP_IDS in relationship:
+                ids = relationship[RELATIONSHIP_IDS]
+                if type(ids) is not list or not all(type(relationship_id) is str for relationship_id in ids):
+                    return False
+            if RELATIONSHIP_TYPE in relationship and type(relationship[RELATIONSHIP_TYPE]) is not str:
+                return False
+    geometry = block.get(GEOMETRY)
+    if type(geometry) is not dict:
+        return False
+    bounding_box = geometry.get(BOUNDING_BOX)
+    if type(bounding_box) is not dict or not all(_is_float(bounding_box.get(field)) for field in BOUNDING_BOX_FIELDS):
+        return False
+    polygon = geometry.get(POLYGON)
+    if type(polygon) is not list:
+        return False
+    for point in polygon:
+        if type(point) is not dict or not _is_float(point.get(X)) or not _is_float(point.get(Y)):
+            return False
+    return True
+
+
+def _is_valid_entity(entity) -> bool:
+    if type(entity) is not dict or type(entity.get(ENTITY_TEXT)) is not str or type(entity.get(ENTITY_TYPE)) is not str:
+        return False
+    score = entity.get(SCORE)
+    if score is not None and not _is_float(score):
+        return False
+    block_references = entity.get(BLOCK_REFERENCES)
+    if block_references is None:
+        return True
+    if type(block_references) is not list:
+        return False
+    for block_reference in block_references:
+        if type(block_reference) is not dict or type(block_reference.get(BLOCK_ID)) is not str or \
+                type(block_reference.get(BEGIN_OFFSET)) is not int or type(block_reference.get(END_OFFSET)) is not int:
+            return False
+        child_blocks = block_reference.get(CHILD_BLOCKS)
+        if child_blocks is None:
+            continue
+        if type(child_blocks) is not list:
+            return False
+        for child_block in child_blocks:
+            if type(child_block) is not dict or type(child_block.get(CHILD_BLOCK_ID)) is not str or \
+                    type(child_block.get(BEGIN_OFFSET)) is not int or type(child_block.get(END_OFFSET)) is not int:
+                return False
+    return True
+
+
+def is_valid_annotation_schema(annotation_json) -> bool:
+    """Check an annotation against the rules of AnnotationSchema in one pass over the decoded JSON.
+
+    It accepts a subset of what AnnotationSchema().load accepts: the JSON types of the valid annotations, e.g. an int
+    and not the string "1" for an Int field. When it returns False, AnnotationSchema().load is the reference, it raises
+    the ValidationError with the paths of every error, or accepts the values that marshmallow converts.
+    """
+    if type(annotation_json) is not dict:
+        return False
+    for field in (VERSION, DOCUMENT_TYPE):
+        if type(annotation_json.get(field)) is not str:
+            return False
+    if type(annotation_json.get(DOCUMENT_METADATA)) is not dict:
+        return False
+    blocks = annotation_json.get(BLOCKS)
+    entities = annotation_json.get(ENTITIES)
+    if type(blocks) is not list or type(entities) is not list:
+        return False
+    for block in blocks:
+        if not _is_valid_block(block):
+            return False
+    for entity in entities:
+        if not _is_valid_entity(entity):
+            return False
+    return True
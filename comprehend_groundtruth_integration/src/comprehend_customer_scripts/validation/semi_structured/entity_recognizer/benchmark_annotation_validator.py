@@ -0,0 +1,78 @@
+import argparse
+import time
+import uuid
+
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.annotation_model import AnnotationSchema
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.annotation_validator import is_valid_annotation_schema
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.annotation_utils import is_valid_entities
+
+WORDS_PER_LINE = 8
+
+
+def geometry(left: float, top: float, width: float, height: float) -> dict:
+    return {
+        "BoundingBox": {"Width": width, "Top": top, "Left": left, "Height": height},
+        "Polygon": [
+            {"X": left, "Y": top}, {"X": left + width, "Y": top},
+            {"X": left + width, "Y": top + height}, {"X": left, "Y": top + height}
+        ]
+    }
+
+
+def synthetic_annotation(number_of_blocks: int) -> dict:
+    """Build a valid annotation of LINE blocks of WORDS_PER_LINE WORD blocks, with an entity on every line."""
+    blocks = []
+    entities = []
+    for line_number in range(number_of_blocks // (WORDS_PER_LINE + 1)):
+        top = (line_number % 80) / 80
+        words = [{
+            "BlockType": "WORD", "Id": str(uuid.uuid4()), "Text": f"word{word_number}", "Page": 1 + line_number // 80,
+            "Geometry": geometry(word_number / WORDS_PER_LINE, top, 0.1, 0.01)
+        } for word_number in range(WORDS_PER_LINE)]
+        line = {
+            "BlockType": "LINE", "Id": str(uuid.uuid4()), "Text": " ".join(word["Text"] for word in words),
+            "Page": 1 + line_number // 80, "Geometry": geometry(0.0, top, 1.0, 0.01),
+            "Relationships": [{"Ids": [word["Id"] for word in words], "Type": "CHILD"}]
+        }
+        blocks.append(line)
+        blocks.extend(words)
+        entities.append({
+            "BlockReferences": [{
+                "BeginOffset": 0, "EndOffset": len(words[0]["Text"]), "BlockId": line["Id"],
+                "ChildBlocks": [{"BeginOffset": 0, "EndOffset": len(words[0]["Text"]), "ChildBlockId": words[0]["Id"]}]
+            }],
+            "Text": words[0]["Text"], "Type": "WORD0", "Score": 1.0
+        })
+    return {
+        "Version": "2021-04-30", "DocumentType": "NativePDF", "DocumentMetadata": {"Pages": ["1"]},
+        "Blocks": blocks, "Entities": entities
+    }
+
+
+def run(name: str, validate, annotation: dict, repeat: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        validate(annotation)
+    elapsed = (time.perf_counter() - start_time) / repeat
+    print(f"  {name}: {len(annotation['Blocks']) / elapsed:,.0f} blocks/sec ({elapsed * 1000:.2f} ms per annotation)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the single pass annotation schema check with AnnotationSchema().load and time the entity validation")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 50000], help="Number of blocks of the synthetic annotations.")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for number_of_blocks in args.sizes:
+        annotation = synthetic_annotation(number_of_blocks)
+        assert is_valid_annotation_schema(annotation)
+        print(f"{len(annotation['Blocks'])} blocks, {len(annotation['Entities'])} entities:")
+        marshmallow_time = run("marshmallow", lambda annotation: AnnotationSchema().load(annotation), annotation, args.repeat)
+        single_pass_time = run("single pass", is_valid_annotation_schema, annotation, args.repeat)
+        print(f"  speedup: {marshmallow_time / single_pass_time:.1f}x")
+        run("entity validation", lambda annotation: is_valid_entities(annotation, "synthetic.json"), annotation, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,132 @@
 import json
 import logging
+from typing import Union
 
 from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.annotation_model import AnnotationSchema
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.annotation_validator import is_valid_annotation_schema
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.block_utils import BlockIndex
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.json_utils import loads
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.metrics_utils import count, timed
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.stats_utils import ValidationStats
 
 
-def is_valid_entities(annotation_json: dict, annotation_name: str, stats: dict = {}, fail_on_invalid: bool = True):
-    """Validate if all entities are correctly referenced by their line and word blocks and there are no duplicates."""
-    blocks_map = {block["Id"]: block for block in annotation_json["Blocks"]}
-    block_reference_id_set = set()
-    annotation_stats_valid = stats[annotation_name]["VALID"]
-    for entity in annotation_json["Entities"]:
-        if entity["Type"] not in annotation_stats_valid:
-            annotation_stats_valid[entity["Type"]] = {"VALID": 0, "INVALID": 0}
+def is_valid_entities(annotation_json: dict, annotation_name: str, stats: ValidationStats = None, fail_on_invalid: bool = True):
+    """Validate if all entities are correctly referenced by their line and word blocks and there are no duplicates.
 
-        line_block_strings = [] 
+    The word blocks of an entity must also be children of its line blocks and inside their bounding boxes. The blocks
+    are looked up in a BlockIndex, the (line, word) pairs of all the entities are checked at once and the duplicates are
+    found with the tuples of the referenced block numbers.
+    """
+    if stats is None:
+        stats = ValidationStats()
+    blocks = annotation_json["Blocks"]
+    block_index = BlockIndex(blocks)
+    block_numbers = block_index.block_numbers
+    # the blocks not found get negative numbers, so entities referencing the same missing blocks are still duplicates
+    missing_block_numbers = {}
+    entity_references = []
+    pair_entities = []
+    pair_lines = []
+    pair_words = []
+    for entity_number, entity in enumerate(annotation_json["Entities"]):
+        missing_block_logs = []
+        line_block_strings = []
         word_block_strings = []
-        block_reference_ids = []
+        block_reference_numbers = []
         for block_reference in entity["BlockReferences"]:
-            block_reference_ids.append(block_reference["BlockId"])
-            line_block = blocks_map.get(block_reference["BlockId"])
-            if not line_block:
-                log_content = f"Line block not found for line block id: {block_reference['BlockId']}"
-                logging.error(log_content)
+            line_number = block_numbers.get(block_reference["BlockId"])
+            if line_number is None:
+                block_reference_numbers.append(missing_block_numbers.setdefault(block_reference["BlockId"], -1 - len(missing_block_numbers)))
+                missing_block_logs.append(f"Line block not found for line block id: {block_reference['BlockId']}")
                 continue
-            line_block_strings.append(line_block["Text"][block_reference["BeginOffset"]:block_reference["EndOffset"]])
+            block_reference_numbers.append(line_number)
+            line_block_strings.append(blocks[line_number]["Text"][block_reference["BeginOffset"]:block_reference["EndOffset"]])
 
             for child_block_reference in block_reference["ChildBlocks"]:
-                block_reference_ids.append(child_block_reference["ChildBlockId"])
-                word_block = blocks_map.get(child_block_reference["ChildBlockId"])
-                if not word_block:
-                    log_content = f"Word block not found for word block id: {block_reference['BlockId']}"
-                    logging.error(log_content)
+                word_number = block_numbers.get(child_block_reference["ChildBlockId"])
+                if word_number is None:
+                    block_reference_numbers.append(
+                        missing_block_numbers.setdefault(child_block_reference["ChildBlockId"], -1 - len(missing_block_numbers))
+                    )
+                    missing_block_logs.append(f"Word block not found for word block id: {block_reference['BlockId']}")
                     continue
-                word_block_strings.append(word_block["Text"][child_block_reference["BeginOffset"]:child_block_reference["EndOffset"]])
-        block_reference_id = "-".join(block_reference_ids)
-        is_duplicate_entity = block_reference_id in block_reference_id_set
+                block_reference_numbers.append(word_number)
+                word_block_strings.append(blocks[word_number]["Text"][child_block_reference["BeginOffset"]:child_block_reference["EndOffset"]])
+                pair_entities.append(entity_number)
+                pair_lines.append(line_number)
+                pair_words.append(word_number)
+        entity_references.append((missing_block_logs, tuple(block_reference_numbers), line_block_strings, word_block_strings))
+
+    not_children, not_inside = block_index.invalid_pairs(pair_lines, pair_words)
+    block_issues = {}
+    for pairs, issue in ((not_children, "is not a child of"), (not_inside, "is not inside the bounding box of")):
+        for pair in pairs:
+            block_issues.setdefault(pair_entities[pair], []).append(
+                f"word block id: {blocks[pair_words[pair]]['Id']} {issue} line block id: {blocks[pair_lines[pair]]['Id']}"
+            )
+
+    block_reference_number_set = set()
+    for entity_number, entity in enumerate(annotation_json["Entities"]):
+        stats.add_entity(annotation_name, entity["Type"])
+        missing_block_logs, block_reference_numbers, line_block_strings, word_block_strings = entity_references[entity_number]
+        for log_content in missing_block_logs:
+            logging.error(log_content)
+
+        is_duplicate_entity = block_reference_numbers in block_reference_number_set
         if is_duplicate_entity:
             log_content = f"Duplicate entity: {json.dumps(entity)}"
             logging.error(log_content)
             continue
+        is_valid_entity = True
         if " ".join(line_block_strings) != entity["Text"] or " ".join(word_block_strings) != entity["Text"]:
             log_content = f"For annotation: {annotation_name}, failed to validate entity: {json.dumps(entity)}, " \
                             f"using line_block_strings: {line_block_strings} and word_block_strings: {word_block_strings}"
             logging.error(log_content)
-            annotation_stats_valid[entity["Type"]]["INVALID"] += 1
+            is_valid_entity = False
+        if entity_number in block_issues:
+            log_content = f"For annotation: {annotation_name}, failed to validate entity: {json.dumps(entity)}, " \
+                            f"{'; '.join(block_issues[entity_number])}"
+            logging.error(log_content)
+            is_valid_entity = False
+        if not is_valid_entity:
+            stats.add_entity(annotation_name, entity["Type"], invalid=1)
 
             if fail_on_invalid:
                 return False
-        block_reference_id_set.add(block_reference_id)
+        block_reference_number_set.add(block_reference_numbers)
 
-        annotation_stats_valid[entity["Type"]]["VALID"] += 1
+        stats.add_entity(annotation_name, entity["Type"], valid=1)
 
     return True
 
 
-def is_valid_annotation(annotation_content: str, annotation_name: str, stats: dict = {}, fail_on_invalid: bool = True):
+def is_valid_annotation(
+    annotation_content: Union[str, bytes], annotation_name: str, stats: ValidationStats = None, fail_on_invalid: bool = True
+):
     """Validate an annotation."""
-    if annotation_name not in stats:
-        stats[annotation_name] = {"VALID": {}, "INVALID_FORMAT": False}
+    if stats is None:
+        stats = ValidationStats()
+    stats.add_annotation(annotation_name)
+    count("annotations_validated")
     try:
-        annotation_json = json.loads(annotation_content)
-        AnnotationSchema().load(annotation_json)
+        with timed("json_decode"):
+            annotation_json = loads(annotation_content)
+        # marshmallow only runs for the annotations the single pass check rejects, to report their errors
+        with timed("schema_validation"):
+            is_valid_schema = is_valid_annotation_schema(annotation_json)
+        if not is_valid_schema:
+            with timed("marshmallow_load"):
+                AnnotationSchema().load(annotation_json)
     except Exception as e:
         logging.error(f"Failed to validate annotation schema {annotation_name} due to {e}.")
-        stats[annotation_name]["INVALID_FORMAT"] = True
+        stats.set_invalid_format(annotation_name)
 
         if fail_on_invalid:
             return False
         return True
 
-    return is_valid_entities(
-        annotation_json=annotation_json, annotation_name=annotation_name, stats=stats, fail_on_invalid=fail_on_invalid
-    )
+    count("entities", len(annotation_json["Entities"]))
+    with timed("entity_validation"):
+        return is_valid_entities(
+            annotation_json=annotation_json, annotation_name=annotation_name, stats=stats, fail_on_invalid=fail_on_invalid
+        )
@@ -0,0 +1,95 @@
+from operator import itemgetter
+from typing import List, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# how far, as a ratio of the page size, a word block may extend past the bounding box of its line block
+CONTAINMENT_TOLERANCE = 0.01
+BOUNDING_BOX_FIELDS = itemgetter("Left", "Top", "Width", "Height")
+
+
+class BlockIndex:
+    """Index of the blocks of an annotation, to check the line and word blocks referenced by its entities.
+
+    The blocks are numbered in annotation order, a block id used by several blocks refers to the last one like in a
+    dict of the blocks. The CHILD relationships and the bounding boxes are only read for the referenced blocks, which
+    are usually a small part of a large form: the relationships as line number * number of blocks + word number codes
+    and the bounding boxes as (left, top, right, bottom) rows. With numpy the (line, word) pairs of all the entities of
+    the annotation are checked in vectorized operations, without it one pair at a time.
+    """
+
+    def __init__(self, blocks: list):
+        self.blocks = blocks
+        self.block_numbers = {block["Id"]: block_number for block_number, block in enumerate(blocks)}
+
+    def child_codes(self, line_numbers, word_numbers) -> List[int]:
+        """Get the codes of the CHILD relationships from the lines to the words."""
+        number_of_blocks = len(self.blocks)
+        # the children are looked up in a map of the referenced words, much smaller than the map of all the blocks
+        word_number_map = {self.blocks[word_number]["Id"]: word_number for word_number in word_numbers}
+        child_codes = []
+        for line_number in line_numbers:
+            for relationship in self.blocks[line_number].get("Relationships") or ():
+                if relationship.get("Type") != "CHILD":
+                    continue
+                line_code = line_number * number_of_blocks
+                child_codes.extend(
+                    line_code + child_number for child_number in map(word_number_map.get, relationship.get("Ids") or ())
+                    if child_number is not None
+                )
+        return child_codes
+
+    def bounding_boxes(self, block_numbers) -> list:
+        # the schema accepts numbers in strings, e.g. "0.5", which float converts like marshmallow
+        return [BOUNDING_BOX_FIELDS(self.blocks[block_number]["Geometry"]["BoundingBox"]) for block_number in block_numbers]
+
+    def invalid_pairs(self, line_numbers: List[int], word_numbers: List[int]) -> Tuple[List[int], List[int]]:
+        """Get the positions of the (line, word) pairs whose word is not a child of the line and not inside its box."""
+        if not line_numbers:
+            return [], []
+        if numpy is None:
+            return self._invalid_pairs_without_numpy(line_numbers, word_numbers)
+        lines = numpy.array(line_numbers, dtype=numpy.int64)
+        words = numpy.array(word_numbers, dtype=numpy.int64)
+        referenced_lines = numpy.unique(lines)
+        child_codes = numpy.unique(numpy.array(self.child_codes(referenced_lines.tolist(), numpy.unique(words).tolist()), dtype=numpy.int64))
+        codes = lines * len(self.blocks) + words
+        is_child = numpy.zeros(len(codes), dtype=bool)
+        if len(child_codes):
+            is_child = child_codes[numpy.minimum(numpy.searchsorted(child_codes, codes), len(child_codes) - 1)] == codes
+
+        referenced_blocks, positions = numpy.unique(numpy.concatenate((lines, words)), return_inverse=True)
+        boxes = numpy.array(self.bounding_boxes(referenced_blocks.tolist()), dtype=numpy.float64).reshape(-1, 4)
+        boxes[:, 2:] += boxes[:, :2]
+        line_boxes = boxes[positions[:len(lines)]]
+        word_boxes = boxes[positions[len(lines):]]
+        is_inside = (
+            (word_boxes[:, :2] >= line_boxes[:, :2] - CONTAINMENT_TOLERANCE).all(axis=1)
+            & (word_boxes[:, 2:] <= line_boxes[:, 2:] + CONTAINMENT_TOLERANCE).all(axis=1)
+        )
+        return numpy.flatnonzero(~is_child).tolist(), numpy.flatnonzero(~is_inside).tolist()
+
+    def _invalid_pairs_without_numpy(self, line_numbers: List[int], word_numbers: List[int]) -> Tuple[List[int], List[int]]:
+        number_of_blocks = len(self.blocks)
+        child_codes = set(self.child_codes(set(line_numbers), set(word_numbers)))
+        referenced_blocks = list(set(line_numbers).union(word_numbers))
+        bounding_boxes = {
+            block_number: (float(left), float(top), float(left) + float(width), float(top) + float(height))
+            for block_number, (left, top, width, height) in zip(referenced_blocks, self.bounding_boxes(referenced_blocks))
+        }
+        not_children = []
+        not_inside = []
+        for position, (line_number, word_number) in enumerate(zip(line_numbers, word_numbers)):
+            if line_number * number_of_blocks + word_number not in child_codes:
+                not_children.append(position)
+            line_left, line_top, line_right, line_bottom = bounding_boxes[line_number]
+            word_left, word_top, word_right, word_bottom = bounding_boxes[word_number]
+            if not (
+                word_left >= line_left - CONTAINMENT_TOLERANCE and word_top >= line_top - CONTAINMENT_TOLERANCE
+                and word_right <= line_right + CONTAINMENT_TOLERANCE and word_bottom <= line_bottom + CONTAINMENT_TOLERANCE
+            ):
+                not_inside.append(position)
+        return not_children, not_inside
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+from urllib.request import pathname2url
+
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer import annotation_model, annotation_validator
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils import annotation_utils, block_utils, stats_utils
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.stats_utils import ValidationStats
+
+CACHE_FILENAME = os.path.join(os.path.expanduser("~"), ".cache", "comprehend_customer_scripts", "validation_cache.sqlite3")
+DEFAULT_MAX_ENTRIES = 1000000
+DEFAULT_MAX_AGE_DAYS = 30
+# number of results and hits held in memory before they are written to the cache
+FLUSH_INTERVAL = 1000
+
+
+def validator_version() -> str:
+    """Hash of the source of the annotation validation, the cached results of another version are not used."""
+    digest = hashlib.sha256()
+    for module in (annotation_model, annotation_validator, annotation_utils, block_utils, stats_utils):
+        with open(module.__file__, "rb") as module_file:
+            digest.update(module_file.read())
+    return digest.hexdigest()
+
+
+class ValidationCache:
+    """SQLite cache of the annotation validation results of the previous runs.
+
+    A result is the pass/fail outcome of an annotation, its stats and the messages logged while it was validated. It is
+    stored with the version of the annotation, the ETag of an S3 object or the modification time and size of a local
+    file, and of the validator, and it is only used while both are unchanged. There is one result per annotation
+    reference and --fail-on-invalid setting, which replaces the result of the previous version. The results not used for
+    max_age_days are evicted, then the least recently used ones above max_entries. The cache can be shared by threads.
+    A read_only cache, e.g. in a worker process, does not write its new results and hits: take_updates returns them to
+    be written by the cache of the main process with add_updates.
+    """
+
+    def __init__(self, filename: str = CACHE_FILENAME, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_age_days: float = DEFAULT_MAX_AGE_DAYS, read_only: bool = False):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.read_only = read_only
+        self.validator_version = validator_version()
+        self.lock = threading.Lock()
+        self.new_results = []
+        self.used_results = []
+        self.hits = 0
+        self.misses = 0
+        if read_only:
+            self.connection = sqlite3.connect(f"file:{pathname2url(os.path.abspath(filename))}?mode=ro", uri=True, check_same_thread=False)
+            return
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results (ref TEXT NOT NULL, fail_on_invalid INTEGER NOT NULL, version TEXT NOT NULL, "
+            "validator_version TEXT NOT NULL, is_valid INTEGER NOT NULL, stats TEXT NOT NULL, logs TEXT NOT NULL, "
+            "last_used REAL NOT NULL, PRIMARY KEY (ref, fail_on_invalid))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.connection.commit()
+
+    def get(self, ref: str, version: str, fail_on_invalid: bool) -> Optional[Tuple[bool, ValidationStats, List[Tuple[int, str]]]]:
+        """Get the (is_valid, stats, logs) of a version of an annotation, None when it is not cached."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT is_valid, stats, logs FROM results WHERE ref = ? AND fail_on_invalid = ? AND version = ? AND validator_version = ?",
+                (ref, fail_on_invalid, version, self.validator_version)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.used_results.append((time.time(), ref, fail_on_invalid))
+            self._flush_if_full()
+        is_valid, stats, logs = row
+        return bool(is_valid), ValidationStats.from_dict(json.loads(stats)), [tuple(log) for log in json.loads(logs)]
+
+    def put(self, ref: str, version: str, fail_on_invalid: bool, is_valid: bool, stats: ValidationStats, logs: List[Tuple[int, str]]):
+        with self.lock:
+            self.new_results.append(
+                (ref, fail_on_invalid, version, self.validator_version, is_valid, json.dumps(stats.to_dict()), json.dumps(logs), time.time())
+            )
+            self._flush_if_full()
+
+    def take_updates(self) -> Tuple[list, list]:
+        """Get and forget the results and hits not written yet."""
+        with self.lock:
+            updates = self.new_results, self.used_results
+            self.new_results = []
+            self.used_results = []
+        return updates
+
+    def add_updates(self, updates: Tuple[list, list]):
+        """Write the results and hits of another cache, taken with take_updates."""
+        new_results, used_results = updates
+        with self.lock:
+            self.new_results.extend(new_results)
+            self.used_results.extend(used_results)
+            self._flush_if_full()
+
+    def _flush_if_full(self):
+        if not self.read_only and len(self.new_results) + len(self.used_results) >= FLUSH_INTERVAL:
+            self._flush()
+
+    def _flush(self):
+        self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.new_results)
+        self.connection.executemany("UPDATE results SET last_used = ? WHERE ref = ? AND fail_on_invalid = ?", self.used_results)
+        self.connection.commit()
+        self.new_results = []
+        self.used_results = []
+
+    def evict(self):
+        """Delete the results not used for max_age_days, then the least recently used ones above max_entries."""
+        with self.lock:
+            self._flush()
+            self.connection.execute("DELETE FROM results WHERE last_used < ?", (time.time() - self.max_age_days * 86400,))
+            self.connection.execute(
+                "DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self.connection.commit()
+
+    def close(self):
+        if not self.read_only:
+            self.evict()
+        self.connection.close()
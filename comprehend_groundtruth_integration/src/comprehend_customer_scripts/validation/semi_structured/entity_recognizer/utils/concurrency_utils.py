@@ -0,0 +1,165 @@
+import logging
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+# number of items sent to a worker process at a time
+PROCESS_BATCH_SIZE = 16
+
+_capture = threading.local()
+
+
+class LineOutput:
+    """Log records and text written while one manifest line is validated in a worker thread."""
+
+    def __init__(self):
+        self.items = []
+
+    def write(self, text: str):
+        self.items.append(text)
+
+    def flush(self):
+        pass
+
+    def replay(self, handler: "OrderedLogHandler"):
+        for item in self.items:
+            if isinstance(item, logging.LogRecord):
+                handler.dispatch(item)
+            else:
+                sys.stderr.write(item)
+
+
+class OrderedLogHandler(logging.Handler):
+    """Root handler that holds the records of worker threads in their LineOutput and passes the others through."""
+
+    def __init__(self, handlers: list):
+        super().__init__()
+        self.handlers = handlers
+
+    def handle(self, record: logging.LogRecord):
+        line_output = getattr(_capture, "line_output", None)
+        if line_output is not None:
+            line_output.items.append(record)
+        else:
+            self.dispatch(record)
+        return True
+
+    def dispatch(self, record: logging.LogRecord):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def line_output():
+    """Get the stream of the line validated by the current thread, sys.stderr outside of a worker thread."""
+    return getattr(_capture, "line_output", None) or sys.stderr
+
+
+def _run_captured(function: Callable, item):
+    _capture.line_output = LineOutput()
+    try:
+        return function(item), _capture.line_output
+    finally:
+        _capture.line_output = None
+
+
+def ordered_concurrent_map(function: Callable, items: Iterable, max_workers: int = 1,
+                           max_in_flight: int = 1) -> Iterator[Tuple[object, object]]:
+    """Yield (item, function(item)) in the order of items, calling function in a bounded thread pool.
+
+    At most max_in_flight items are submitted and not yet yielded, so the items are read lazily. The log records and
+    the text written to line_output() by each call are held until the items before it are yielded, then emitted, so the
+    output is the same as calling function on the items one at a time. When the caller stops early, e.g. at the first
+    invalid line, the pending calls are cancelled and the output of the calls already running is dropped.
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield item, function(item)
+        return
+
+    root_logger = logging.getLogger()
+    if not root_logger.handlers:
+        # what the first logging call of a worker thread would do
+        logging.basicConfig()
+    root_handlers = root_logger.handlers
+    ordered_handler = OrderedLogHandler(root_handlers)
+    root_logger.handlers = [ordered_handler]
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = deque()
+
+    def next_result():
+        item, future = pending.popleft()
+        result, output = future.result()
+        output.replay(ordered_handler)
+        return item, result
+
+    try:
+        for item in items:
+            pending.append((item, executor.submit(_run_captured, function, item)))
+            if len(pending) >= max_in_flight:
+                yield next_result()
+        while pending:
+            yield next_result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        root_logger.handlers = root_handlers
+
+
+def _init_process(initializer: Optional[Callable], initargs: tuple):
+    # the records of a worker process are only held in the LineOutput of the item being processed
+    logging.getLogger().handlers = [OrderedLogHandler([])]
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _run_captured_batch(function: Callable, batch: list) -> List[Tuple[object, LineOutput]]:
+    results = []
+    for item in batch:
+        result, output = _run_captured(function, item)
+        for record in output.items:
+            if isinstance(record, logging.LogRecord):
+                # the arguments and the exception of a record may not be picklable, its message is
+                record.msg = record.getMessage()
+                record.args = None
+                record.exc_info = None
+        results.append((result, output))
+    return results
+
+
+def ordered_process_map(function: Callable, items: Iterable, processes: int, max_in_flight: int,
+                        batch_size: int = PROCESS_BATCH_SIZE, initializer: Optional[Callable] = None,
+                        initargs: tuple = ()) -> Iterator[Tuple[object, object]]:
+    """Yield (item, function(item)) in the order of items, calling function in a pool of worker processes.
+
+    Like ordered_concurrent_map, with processes for CPU bound functions. The items are sent to the workers in batches
+    of batch_size, at most max_in_flight items, and at least a batch per process, are submitted and not yet yielded.
+    The function, items and results must be picklable; initializer(*initargs) is called once in every worker process,
+    e.g. to open the resources the function uses.
+    """
+    root_logger = logging.getLogger()
+    if not root_logger.handlers:
+        logging.basicConfig()
+    ordered_handler = OrderedLogHandler(root_logger.handlers)
+    max_batches_in_flight = max(-(-max_in_flight // batch_size), processes)
+    executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_process, initargs=(initializer, initargs))
+    pending = deque()
+    items = iter(items)
+
+    def next_results():
+        batch, future = pending.popleft()
+        for item, (result, output) in zip(batch, future.result()):
+            output.replay(ordered_handler)
+            yield item, result
+
+    try:
+        for batch in iter(lambda: list(islice(items, batch_size)), []):
+            pending.append((batch, executor.submit(_run_captured_batch, function, batch)))
+            if len(pending) >= max_batches_in_flight:
+                yield from next_results()
+        while pending:
+            yield from next_results()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
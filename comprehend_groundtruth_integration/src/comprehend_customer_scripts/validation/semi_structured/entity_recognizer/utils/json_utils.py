@@ -0,0 +1,36 @@
+import json
+from typing import Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+PREFERRED_BACKENDS = ["orjson", "simdjson", "json"]
+BACKENDS = {"json": json.loads}
+if simdjson is not None:
+    BACKENDS["simdjson"] = simdjson.loads
+if orjson is not None:
+    BACKENDS["orjson"] = orjson.loads
+
+BACKEND = next(name for name in PREFERRED_BACKENDS if name in BACKENDS)
+
+
+def loads(data: Union[str, bytes], backend: Optional[str] = None):
+    """Decode JSON from str or bytes with the fastest installed backend.
+
+    The optional backends are stricter than the standard library (NaN, integers above 64 bits, ...), so a document they
+    reject is decoded again with json.loads to accept the same input and raise the same errors as json.loads.
+    """
+    backend_loads = BACKENDS[backend or BACKEND]
+    try:
+        return backend_loads(data)
+    except ValueError:
+        if backend_loads is json.loads:
+            raise
+        return json.loads(data)
@@ -1,41 +1,63 @@
 import logging
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
 
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.sampling_utils import SampleEstimates
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.stats_utils import StatsAggregator
 
-def log_stats(stats: dict):
-    dataset_level_stats = {"annotation_files_with_format_issues": [], "entity_stats": {}, "annotation_files_containing_invalid_entities": {}}
-    annotation_file_level_stats = {}
-    for annotation_name in stats.keys():
-        if stats[annotation_name]["INVALID_FORMAT"]:
-            dataset_level_stats["annotation_files_with_format_issues"].append(annotation_name)
-
-        valid_annotation_stats = stats[annotation_name]["VALID"]
-        for entity_type in valid_annotation_stats.keys():
-            if annotation_name not in annotation_file_level_stats:
-                annotation_file_level_stats[annotation_name] = {}
-            if entity_type not in annotation_file_level_stats[annotation_name]:
-                annotation_file_level_stats[annotation_name][entity_type] = {"VALID": 0, "INVALID": 0}
-            annotation_file_level_stats[annotation_name][entity_type]["VALID"] = valid_annotation_stats[entity_type]["VALID"]
-            annotation_file_level_stats[annotation_name][entity_type]["INVALID"] = valid_annotation_stats[entity_type]["INVALID"]
-
-            dataset_level_entity_stats = dataset_level_stats["entity_stats"]
-            if entity_type not in dataset_level_entity_stats:
-                dataset_level_entity_stats[entity_type] = {"VALID": 0, "INVALID": 0}
-            dataset_level_entity_stats[entity_type]["VALID"] += annotation_file_level_stats[annotation_name][entity_type]["VALID"]
-            dataset_level_entity_stats[entity_type]["INVALID"] += annotation_file_level_stats[annotation_name][entity_type]["INVALID"]
-
-            if annotation_file_level_stats[annotation_name][entity_type]["INVALID"]:
-                annotation_files_containing_invalid_entities = dataset_level_stats["annotation_files_containing_invalid_entities"]
-                if entity_type not in annotation_files_containing_invalid_entities:
-                    annotation_files_containing_invalid_entities[entity_type] = {}
-                if annotation_name not in annotation_files_containing_invalid_entities[entity_type]:
-                    annotation_files_containing_invalid_entities[entity_type][annotation_name] = 0
-
-                annotation_files_containing_invalid_entities[entity_type][annotation_name] += 1
+_recording = threading.local()
 
+
+class _RecordingFilter(logging.Filter):
+    """Root logger filter that keeps the level and message of the records of the threads recording their logs."""
+
+    def filter(self, record: logging.LogRecord):
+        records = getattr(_recording, "records", None)
+        if records is not None:
+            records.append((record.levelno, record.getMessage()))
+        return True
+
+
+_recording_filter = _RecordingFilter()
+
+
+@contextmanager
+def record_logs() -> Iterator[List[Tuple[int, str]]]:
+    """Collect the (level, message) of the records the current thread logs to the root logger, they are still emitted."""
+    root_logger = logging.getLogger()
+    if _recording_filter not in root_logger.filters:
+        root_logger.addFilter(_recording_filter)
+    _recording.records = []
+    try:
+        yield _recording.records
+    finally:
+        _recording.records = None
+
+
+def replay_logs(logs: List[Tuple[int, str]]):
+    """Log again the records collected by record_logs."""
+    for level, message in logs:
+        logging.log(level, message)
+
+
+def log_stats(stats: StatsAggregator):
     logging.info(f"DATASET AGGREGATE STATS")
-    logging.info(f"annotation_files_with_format_issues: {list(dataset_level_stats['annotation_files_with_format_issues'])}")
-    logging.info(f"annotation_files_containing_invalid_entities: {dataset_level_stats['annotation_files_containing_invalid_entities']}")
-    logging.info(f"{dataset_level_stats['entity_stats']}\n")
+    logging.info(f"annotation_files_with_format_issues: {stats.files_with_format_issues()}")
+    logging.info(f"annotation_files_containing_invalid_entities: {stats.files_containing_invalid_entities()}")
+    logging.info(f"{stats.entity_stats()}\n")
 
     logging.info(f"ANNOTATION FILE AGGREGATE STATS")
-    logging.info(f"{annotation_file_level_stats}\n")
+    logging.info(f"{stats.file_entity_stats()}\n")
+    if stats.number_of_unlisted_files:
+        logging.info(f"{stats.number_of_unlisted_files} annotation files without issues are not listed.")
+
+
+def log_sample_estimates(estimates: SampleEstimates, confidence: float):
+    estimated_rates = estimates.to_dict(confidence)
+    logging.info(f"SAMPLE ESTIMATES")
+    logging.info(f"Sampled {estimated_rates['sampled_lines']} of {estimated_rates['manifest_lines']} manifest lines in {len(estimated_rates['strata'])} strata, "
+                 f"{estimated_rates['invalid_lines']} sampled lines are invalid.")
+    rate = estimated_rates["invalid_line_rate"]
+    logging.info(f"Estimated invalid manifest line rate: {rate['estimate']:.4%}, {confidence:.0%} confidence interval: [{rate['low']:.4%}, {rate['high']:.4%}]")
+    logging.info(f"Estimated invalid entity rates: {estimated_rates['entity_invalid_rates']}\n")
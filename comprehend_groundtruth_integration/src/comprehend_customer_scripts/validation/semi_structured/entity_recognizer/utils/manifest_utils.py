@@ -0,0 +1,114 @@
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Iterator, Optional
+
+INDEX_SUFFIX = ".lineindex"
+# magic with the byte order of the offsets, manifest size, manifest modification time in ns and number of lines
+INDEX_HEADER = struct.Struct("<8sQQQ")
+INDEX_MAGIC = b"GTLIDX" + (b"LE" if sys.byteorder == "little" else b"BE")
+NEWLINE = re.compile(b"\n")
+
+
+class ManifestIndex:
+    """Memory mapped local manifest with a persistent index of its line offsets.
+
+    The offset of the start of every line is kept next to the manifest in <manifest>.lineindex, a header followed by the
+    offsets as unsigned 64-bit integers. The index is built with one scan of the manifest when it is missing or was
+    built for another size or modification time of the manifest, and is memory mapped otherwise. Counting the lines,
+    reading line N and finding the line at a byte offset then cost no scan of the manifest, and the manifest is never
+    loaded in memory. When the index cannot be written next to the manifest, it is kept in memory.
+    """
+
+    def __init__(self, filename: str, index_filename: Optional[str] = None):
+        self.filename = filename
+        self.index_filename = index_filename or filename + INDEX_SUFFIX
+        self.manifest_file = open(filename, "rb")
+        status = os.fstat(self.manifest_file.fileno())
+        self.size = status.st_size
+        # the lines appended after the file was opened are left out. An empty file cannot be memory mapped
+        self.manifest = mmap.mmap(self.manifest_file.fileno(), self.size, access=mmap.ACCESS_READ) if self.size else b""
+        self.index_file = self.index_map = None
+        self.offsets = self._load_index(status.st_mtime_ns)
+        if self.offsets is None:
+            self.offsets = self._build_index(status.st_mtime_ns)
+
+    def _load_index(self, modification_time: int):
+        """Memory map the offsets of a valid index file, None when the index has to be built again."""
+        try:
+            index_file = open(self.index_filename, "rb")
+        except OSError:
+            return None
+        header = index_file.read(INDEX_HEADER.size)
+        if len(header) == INDEX_HEADER.size:
+            magic, size, index_modification_time, number_of_lines = INDEX_HEADER.unpack(header)
+            is_valid = (magic, size, index_modification_time) == (INDEX_MAGIC, self.size, modification_time) and \
+                os.fstat(index_file.fileno()).st_size == INDEX_HEADER.size + 8 * number_of_lines
+        else:
+            is_valid = False
+        if not is_valid or number_of_lines == 0:
+            index_file.close()
+            return array("Q") if is_valid else None
+        self.index_file = index_file
+        self.index_map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.index_map)[INDEX_HEADER.size:].cast("Q")
+
+    def _build_index(self, modification_time: int):
+        """Scan the manifest for the line offsets and write them to the index file."""
+        offsets = array("Q")
+        if self.size:
+            offsets.append(0)
+            offsets.extend(newline.end() for newline in NEWLINE.finditer(self.manifest))
+            # a final newline ends the last line, it does not start another one
+            if offsets[-1] == self.size:
+                offsets.pop()
+        temporary_filename = self.index_filename + ".tmp"
+        try:
+            with open(temporary_filename, "wb") as index_file:
+                index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, self.size, modification_time, len(offsets)))
+                offsets.tofile(index_file)
+            os.replace(temporary_filename, self.index_filename)
+        except OSError:
+            pass
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def line_start(self, line_number: int) -> int:
+        """Get the byte offset of a line, the size of the manifest for the line after the last one."""
+        return self.offsets[line_number] if line_number < len(self.offsets) else self.size
+
+    def line(self, line_number: int) -> bytes:
+        """Get the bytes of a line without its line ending."""
+        return self.manifest[self.offsets[line_number]:self.line_start(line_number + 1)].rstrip(b"\r\n")
+
+    def line_at(self, offset: int) -> int:
+        """Get the number of the first line that starts at or after the byte offset."""
+        return bisect_left(self.offsets, offset)
+
+    def iter_lines(self, first_line: int = 0, last_line: Optional[int] = None) -> Iterator[bytes]:
+        """Iterate over the lines [first_line, last_line) without their line endings."""
+        last_line = len(self.offsets) if last_line is None else min(last_line, len(self.offsets))
+        for line_number in range(first_line, last_line):
+            yield self.line(line_number)
+
+    def close(self):
+        if isinstance(self.offsets, memoryview):
+            self.offsets.release()
+        if self.index_map is not None:
+            self.index_map.close()
+            self.index_file.close()
+        if isinstance(self.manifest, mmap.mmap):
+            self.manifest.close()
+        self.manifest_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,202 @@
+import cProfile
+import heapq
+import marshal
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROMETHEUS_PREFIX = "comprehend_manifest_validation"
+
+_metrics = None
+_profile_lock = threading.Lock()
+_NO_OP = nullcontext()
+
+
+class ValidationMetrics:
+    """Latency histograms of the validation phases, counters and the cProfile stats of the slowest annotations.
+
+    The metrics of the worker threads are recorded in one instance, the ones of worker processes are taken after every
+    manifest line and merged in the main process. Phase histograms count the latencies in LATENCY_BUCKETS, the
+    percentiles of the report are the upper bounds of the buckets they fall in.
+    """
+
+    def __init__(self, profile_slowest: int = 0):
+        self.profile_slowest = profile_slowest
+        # phase -> [bucket counts, sum of the latencies, max latency]
+        self.phases = {}
+        self.counters = {}
+        # min heap of the (seconds, annotation name, cProfile stats) of the slowest annotations
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def observe(self, phase: str, seconds: float):
+        with self.lock:
+            phase_metrics = self.phases.get(phase)
+            if phase_metrics is None:
+                phase_metrics = self.phases[phase] = [array("Q", bytes(8 * (len(LATENCY_BUCKETS) + 1))), 0.0, 0.0]
+            phase_metrics[0][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            phase_metrics[1] += seconds
+            phase_metrics[2] = max(phase_metrics[2], seconds)
+
+    def count(self, counter: str, value: int = 1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def is_slowest(self, seconds: float) -> bool:
+        return len(self.profiles) < self.profile_slowest or seconds > self.profiles[0][0]
+
+    def add_profile(self, seconds: float, annotation_name: str, stats: dict):
+        with self.lock:
+            if len(self.profiles) < self.profile_slowest:
+                heapq.heappush(self.profiles, (seconds, annotation_name, stats))
+            elif self.profiles and seconds > self.profiles[0][0]:
+                heapq.heapreplace(self.profiles, (seconds, annotation_name, stats))
+
+    def merge(self, other: "ValidationMetrics"):
+        """Add the metrics recorded by another process."""
+        for phase, (buckets, latency_sum, latency_max) in other.phases.items():
+            with self.lock:
+                phase_metrics = self.phases.get(phase)
+                if phase_metrics is None:
+                    self.phases[phase] = [array("Q", buckets), latency_sum, latency_max]
+                    continue
+                for bucket, bucket_count in enumerate(buckets):
+                    phase_metrics[0][bucket] += bucket_count
+                phase_metrics[1] += latency_sum
+                phase_metrics[2] = max(phase_metrics[2], latency_max)
+        for counter, value in other.counters.items():
+            self.count(counter, value)
+        for profile in other.profiles:
+            self.add_profile(*profile)
+
+    def report(self) -> dict:
+        phases = {}
+        for phase, (buckets, latency_sum, latency_max) in self.phases.items():
+            phase_count = sum(buckets)
+            phases[phase] = {
+                "count": phase_count,
+                "sum_seconds": latency_sum,
+                "mean_seconds": latency_sum / phase_count if phase_count else 0.0,
+                "max_seconds": latency_max,
+                **{f"p{percentile}_seconds": _bucket_percentile(buckets, percentile, latency_max) for percentile in (50, 90, 99)},
+                "buckets": {str(upper_bound): bucket_count for upper_bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), buckets)},
+            }
+        return {"phases": phases, "counters": dict(self.counters)}
+
+    def write_prometheus(self, filename: str, gauges: dict):
+        """Write the metrics in the Prometheus text format, for the textfile collector of the node exporter."""
+        lines = [f"# TYPE {PROMETHEUS_PREFIX}_phase_seconds histogram"]
+        for phase, (buckets, latency_sum, _) in self.phases.items():
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative_count += bucket_count
+                lines.append(f'{PROMETHEUS_PREFIX}_phase_seconds_bucket{{phase="{phase}",le="{upper_bound}"}} {cumulative_count}')
+            lines.append(f'{PROMETHEUS_PREFIX}_phase_seconds_sum{{phase="{phase}"}} {latency_sum}')
+            lines.append(f'{PROMETHEUS_PREFIX}_phase_seconds_count{{phase="{phase}"}} {cumulative_count}')
+        for counter, value in self.counters.items():
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{counter}_total counter")
+            lines.append(f"{PROMETHEUS_PREFIX}_{counter}_total {value}")
+        for gauge, value in gauges.items():
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{gauge} gauge")
+            lines.append(f"{PROMETHEUS_PREFIX}_{gauge} {value}")
+        # the collector must not read a partly written file
+        temporary_filename = filename + ".tmp"
+        with open(temporary_filename, "w", encoding="utf-8") as prometheus_file:
+            prometheus_file.write("\n".join(lines) + "\n")
+        os.replace(temporary_filename, filename)
+
+    def write_profiles(self, directory: str) -> list:
+        """Write the cProfile stats of the slowest annotations, readable by pstats, slowest first."""
+        os.makedirs(directory, exist_ok=True)
+        profiles = []
+        for rank, (seconds, annotation_name, stats) in enumerate(sorted(self.profiles, key=lambda profile: -profile[0])):
+            filename = os.path.join(directory, f"{rank + 1:03d}_{annotation_name}.prof")
+            with open(filename, "wb") as profile_file:
+                marshal.dump(stats, profile_file)
+            profiles.append({"annotation": annotation_name, "seconds": seconds, "profile": filename})
+        return profiles
+
+
+def _bucket_percentile(buckets: array, percentile: int, latency_max: float) -> float:
+    rank = sum(buckets) * percentile / 100
+    cumulative_count = 0
+    for upper_bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+        cumulative_count += bucket_count
+        if cumulative_count >= rank:
+            return min(upper_bound, latency_max)
+    return latency_max
+
+
+def enable_metrics(metrics: Optional[ValidationMetrics]):
+    """Record the metrics of this process in metrics, None disables them."""
+    global _metrics
+    _metrics = metrics
+
+
+def take_metrics() -> Optional[ValidationMetrics]:
+    """Get the metrics recorded so far by this process and record the next ones in new metrics."""
+    metrics = _metrics
+    if metrics is not None:
+        enable_metrics(ValidationMetrics(profile_slowest=metrics.profile_slowest))
+    return metrics
+
+
+@contextmanager
+def _timed(metrics: ValidationMetrics, phase: str):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(phase, time.perf_counter() - start_time)
+
+
+def timed(phase: str):
+    """Context manager recording the latency of a phase, it does nothing when the metrics are disabled."""
+    if _metrics is None:
+        return _NO_OP
+    return _timed(_metrics, phase)
+
+
+def count(counter: str, value: int = 1):
+    if _metrics is not None:
+        _metrics.count(counter, value)
+
+
+@contextmanager
+def _profiled(metrics: ValidationMetrics, annotation_name: str):
+    # one annotation is profiled at a time, a profiler only sees its own thread and cannot run in two threads since
+    # Python 3.12
+    with _profile_lock:
+        profile = cProfile.Profile()
+        start_time = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            seconds = time.perf_counter() - start_time
+            if metrics.is_slowest(seconds):
+                profile.create_stats()
+                metrics.add_profile(seconds, annotation_name, profile.stats)
+
+
+def profiled(annotation_name: str):
+    """Context manager profiling the validation of an annotation when the slowest annotations are profiled."""
+    if _metrics is None or not _metrics.profile_slowest:
+        return _NO_OP
+    return _profiled(_metrics, annotation_name)
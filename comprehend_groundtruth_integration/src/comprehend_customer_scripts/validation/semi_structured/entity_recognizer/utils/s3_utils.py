@@ -1,5 +1,15 @@
+import logging
+import threading
+from typing import Iterator, Optional, Tuple
 from urllib.parse import urlparse
 
+from botocore.exceptions import ConnectionClosedError, ReadTimeoutError, ResponseStreamingError
+
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.metrics_utils import count, timed
+
+# size of the reads of a streamed S3 object
+STREAM_CHUNK_SIZE = 1024 * 1024
+
 
 def bucket_key_from_s3_uri(s3_path: str):
     """Get bucket and key from s3 URL."""
@@ -9,10 +19,64 @@ def bucket_key_from_s3_uri(s3_path: str):
     return bucket, key
 
 
+def get_object_bytes(s3_client, ref: str):
+    """Get the raw content from an S3 object."""
+    bucket, path = bucket_key_from_s3_uri(ref)
+    return s3_client.get_object(Bucket=bucket, Key=path).get('Body').read()
+
+
 def get_object_content(s3_client, ref: str):
     """Get UTF-8 content from an S3 object."""
+    return get_object_bytes(s3_client=s3_client, ref=ref).decode('utf-8')
+
+
+def get_object_etag(s3_client, ref: str):
+    """Get the ETag of an S3 object."""
     bucket, path = bucket_key_from_s3_uri(ref)
-    return s3_client.get_object(Bucket=bucket, Key=path).get('Body').read().decode('utf-8')
+    return s3_client.head_object(Bucket=bucket, Key=path)["ETag"]
+
+
+def iter_object_lines(s3_client, ref: str, max_attempts: int = 5, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """Iterate over the lines of an S3 object without their line endings, while it is downloaded.
+
+    The object is read chunk_size bytes at a time, and only the line being received is held in memory. When the
+    connection is reset or times out, the download resumes at the first byte not received yet with a range request,
+    which must match the ETag of the object, up to max_attempts times in a row.
+    """
+    bucket, key = bucket_key_from_s3_uri(ref)
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    size = response["ContentLength"]
+    etag = response["ETag"]
+    position = 0
+    attempts = 1
+    line_parts = []
+    while True:
+        try:
+            for chunk in response["Body"].iter_chunks(chunk_size):
+                position += len(chunk)
+                attempts = 1
+                lines = chunk.split(b"\n")
+                line_parts.append(lines[0])
+                if len(lines) > 1:
+                    yield b"".join(line_parts).rstrip(b"\r")
+                    for line in lines[1:-1]:
+                        yield line.rstrip(b"\r")
+                    line_parts = [lines[-1]]
+        except (ConnectionClosedError, ReadTimeoutError, ResponseStreamingError) as error:
+            response["Body"].close()
+            if position >= size:
+                break
+            if attempts >= max_attempts:
+                raise
+            attempts += 1
+            logging.warning(f"Resuming the download of {ref} at byte {position} after: {error}")
+            response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={position}-", IfMatch=etag)
+            continue
+        break
+    # a final newline ends the last line, it does not start another one
+    last_line = b"".join(line_parts)
+    if last_line:
+        yield last_line.rstrip(b"\r")
 
 
 def get_bucket_and_objects_in_folder(s3_client, ref: str, is_file=False):
@@ -29,5 +93,61 @@ def get_bucket_and_objects_in_folder(s3_client, ref: str, is_file=False):
 
 
 def s3_file_exists(s3_client, ref: str):
-    bucket, objs = get_bucket_and_objects_in_folder(s3_client=s3_client, ref=ref, is_file=True)
+    count("s3_listings")
+    with timed("s3_listing"):
+        bucket, objs = get_bucket_and_objects_in_folder(s3_client=s3_client, ref=ref, is_file=True)
     return len(objs) and f"s3://{bucket}/{objs[0]['Key']}" == ref
+
+
+class S3ObjectIndex:
+    """Existence, size and ETag of S3 objects, answered from one listing of every folder they are in.
+
+    The first lookup of an object lists its folder, i.e. the prefix of its key up to the last "/", with the
+    list_objects_v2 paginator and keeps the key, size and ETag of every object under it. The next lookups of objects
+    in that folder or below it are answered in memory, so validating N documents and annotations stored in a few
+    folders takes a few paginated listings instead of a listing per object. Objects added after their folder was listed
+    are not seen. The index can be shared by threads, a folder is listed once.
+    """
+
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+        # bucket -> key -> (size, ETag), and the folders of each bucket listed so far
+        self.objects = {}
+        self.listed_folders = {}
+        self.lock = threading.Lock()
+
+    def _is_listed(self, bucket: str, key: str) -> bool:
+        listed_folders = self.listed_folders.get(bucket, ())
+        folder_end = key.rfind("/")
+        while folder_end != -1:
+            if key[:folder_end + 1] in listed_folders:
+                return True
+            folder_end = key.rfind("/", 0, folder_end)
+        return "" in listed_folders
+
+    def _list_folder(self, bucket: str, key: str):
+        folder = key[:key.rfind("/") + 1]
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        objects = {}
+        with timed("s3_listing"):
+            for page in paginator.paginate(Bucket=bucket, Prefix=folder):
+                for obj in page.get("Contents", []):
+                    objects[obj["Key"]] = (obj["Size"], obj.get("ETag"))
+        count("s3_listings")
+        count("objects_listed", len(objects))
+        self.objects.setdefault(bucket, {}).update(objects)
+        self.listed_folders.setdefault(bucket, set()).add(folder)
+
+    def get_object_info(self, ref: str) -> Optional[Tuple[int, str]]:
+        """Get the (size, ETag) of an S3 object, None when it does not exist."""
+        bucket, key = bucket_key_from_s3_uri(ref)
+        if not self._is_listed(bucket, key):
+            with self.lock:
+                if not self._is_listed(bucket, key):
+                    self._list_folder(bucket, key)
+        return self.objects[bucket].get(key)
+
+    def exists(self, ref: str) -> bool:
+        """Check that an object exists, with the same result as s3_file_exists."""
+        bucket, key = bucket_key_from_s3_uri(ref)
+        return f"s3://{bucket}/{key}" == ref and not key.endswith("/") and self.get_object_info(ref) is not None
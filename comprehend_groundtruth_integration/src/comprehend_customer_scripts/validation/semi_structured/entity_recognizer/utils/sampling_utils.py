@@ -0,0 +1,190 @@
+import heapq
+import math
+import random
+import re
+from statistics import NormalDist
+from typing import Callable, Dict, List, Optional, Tuple
+
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.stats_utils import ValidationStats
+
+ANNOTATION_REF_PATTERN = re.compile(r'"annotation-ref"\s*:\s*"([^"]*)"')
+
+
+def annotation_prefix(manifest_line: str) -> str:
+    """Get the folder of the annotation reference of a manifest line, the prefix up to the last /, without parsing it."""
+    match = ANNOTATION_REF_PATTERN.search(manifest_line)
+    if match is None:
+        return ""
+    annotation_ref = match.group(1)
+    return annotation_ref[:annotation_ref.rfind("/") + 1]
+
+
+class ManifestSampler:
+    """Stratified random sample of the lines of a manifest read once, e.g. while an S3 manifest is streamed.
+
+    Every line gets a random key and every stratum keeps the sample_size lines with the smallest keys, a reservoir of
+    uniformly sampled lines. Once all the lines are added, each stratum gets a share of sample_size proportional to its
+    number of lines, at least one line, taken from its reservoir. Without a stratify function there is one stratum.
+    """
+
+    def __init__(self, sample_size: int, stratify: Optional[Callable[[str], str]] = None, seed: Optional[int] = None):
+        self.sample_size = sample_size
+        self.stratify = stratify
+        self.random = random.Random(seed)
+        self.stratum_sizes = {}
+        # stratum -> max heap of the (-key, line number, line) of the lines with the smallest keys
+        self.reservoirs = {}
+
+    def add(self, line_number: int, manifest_line: str):
+        stratum = self.stratify(manifest_line) if self.stratify is not None else ""
+        self.stratum_sizes[stratum] = self.stratum_sizes.get(stratum, 0) + 1
+        reservoir = self.reservoirs.setdefault(stratum, [])
+        key = -self.random.random()
+        if len(reservoir) < self.sample_size:
+            heapq.heappush(reservoir, (key, line_number, manifest_line))
+        elif key > reservoir[0][0]:
+            heapq.heapreplace(reservoir, (key, line_number, manifest_line))
+
+    def allocation(self) -> Dict[str, int]:
+        """Get the number of sampled lines of every stratum, proportional to its size with the largest remainders."""
+        number_of_lines = sum(self.stratum_sizes.values())
+        if number_of_lines <= self.sample_size:
+            return dict(self.stratum_sizes)
+        shares = {stratum: self.sample_size * size / number_of_lines for stratum, size in self.stratum_sizes.items()}
+        allocation = {stratum: max(int(share), 1) for stratum, share in shares.items()}
+        remaining = self.sample_size - sum(allocation.values())
+        for stratum in sorted(shares, key=lambda stratum: allocation[stratum] - shares[stratum])[:max(remaining, 0)]:
+            allocation[stratum] += 1
+        return allocation
+
+    def sample(self) -> List[Tuple[int, str, str]]:
+        """Get the (line number, stratum, line) of the sampled lines in manifest order."""
+        sampled_lines = []
+        for stratum, stratum_sample_size in self.allocation().items():
+            smallest_keys = heapq.nlargest(stratum_sample_size, self.reservoirs[stratum])
+            sampled_lines.extend((line_number, stratum, manifest_line) for _, line_number, manifest_line in smallest_keys)
+        return sorted(sampled_lines)
+
+
+def effective_sample_size(rate: float, variance: float, sample_size: int, population_size: int) -> float:
+    """Get the size of the simple random sample with the variance of an estimated rate, for its Wilson interval.
+
+    Without variance, e.g. no invalid line in the sample, it is the sample size with the finite population correction.
+    """
+    if variance > 0:
+        return rate * (1 - rate) / variance
+    if sample_size < population_size:
+        return sample_size / (1 - sample_size / population_size)
+    return math.inf
+
+
+def wilson_interval(rate: float, effective_sample_size: float, confidence: float) -> Tuple[float, float]:
+    if math.isinf(effective_sample_size):
+        return rate, rate
+    if effective_sample_size <= 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    denominator = 1 + z * z / effective_sample_size
+    center = (rate + z * z / (2 * effective_sample_size)) / denominator
+    half_width = z * math.sqrt(rate * (1 - rate) / effective_sample_size + z * z / (4 * effective_sample_size ** 2)) / denominator
+    return max(center - half_width, 0.0), min(center + half_width, 1.0)
+
+
+class SampleEstimates:
+    """Invalid rates of a manifest estimated from the validation of a stratified sample of its lines.
+
+    A line is invalid when its validation fails, it is skipped, e.g. without annotation-ref, or its annotation has a
+    format issue or an invalid entity: the lines a run with --fail-on-invalid stops at. The rate of invalid lines is the
+    stratified estimate, with a Wilson score interval for the effective sample size of the design and the finite
+    population correction. The invalid rate of every entity type is a ratio estimate over the sampled annotations, with
+    the Wilson interval of the effective sample size of its linearized variance.
+    """
+
+    def __init__(self, stratum_sizes: Dict[str, int]):
+        self.stratum_sizes = stratum_sizes
+        # stratum -> [(is invalid, {entity type: (checked entities, invalid entities)})] of the sampled lines
+        self.lines = {stratum: [] for stratum in stratum_sizes}
+
+    def add(self, stratum: str, is_valid: bool, line_stats: ValidationStats):
+        """Add the result of a sampled line, validated without stopping at its first invalid entity."""
+        entity_counts = {}
+        is_invalid = not is_valid or not line_stats.annotations
+        for annotation_stats in line_stats.annotations.values():
+            is_invalid = is_invalid or annotation_stats["INVALID_FORMAT"]
+            for entity_type, entity_stats in annotation_stats["VALID"].items():
+                # validated to the end, VALID counts every entity checked, the invalid ones included
+                checked, invalid = entity_counts.get(entity_type, (0, 0))
+                entity_counts[entity_type] = (checked + entity_stats["VALID"], invalid + entity_stats["INVALID"])
+                is_invalid = is_invalid or entity_stats["INVALID"] > 0
+        self.lines[stratum].append((is_invalid, entity_counts))
+
+    def sample_size(self) -> int:
+        return sum(len(lines) for lines in self.lines.values())
+
+    def invalid_line_rate(self, confidence: float) -> Tuple[float, float, float]:
+        """Get the estimated rate of invalid lines and its confidence interval."""
+        number_of_lines = sum(self.stratum_sizes.values())
+        rate = 0.0
+        variance = 0.0
+        for stratum, lines in self.lines.items():
+            if not lines:
+                continue
+            stratum_weight = self.stratum_sizes[stratum] / number_of_lines
+            stratum_rate = sum(is_invalid for is_invalid, _ in lines) / len(lines)
+            sampling_fraction = len(lines) / self.stratum_sizes[stratum]
+            rate += stratum_weight * stratum_rate
+            variance += stratum_weight ** 2 * (1 - sampling_fraction) * stratum_rate * (1 - stratum_rate) / max(len(lines) - 1, 1)
+        return (rate, *wilson_interval(rate, effective_sample_size(rate, variance, self.sample_size(), number_of_lines), confidence))
+
+    def entity_invalid_rates(self, confidence: float) -> Dict[str, Tuple[float, float, float]]:
+        """Get the estimated invalid rate of every entity type of the sample and its confidence interval."""
+        number_of_lines = sum(self.stratum_sizes.values())
+        sample_size = self.sample_size()
+        entity_types = list(dict.fromkeys(
+            entity_type for lines in self.lines.values() for _, entity_counts in lines for entity_type in entity_counts
+        ))
+        entity_invalid_rates = {}
+        for entity_type in entity_types:
+            # stratum -> [(checked, invalid)] of the sampled lines, the estimated totals are the stratum means times sizes
+            stratum_counts = {
+                stratum: [entity_counts.get(entity_type, (0, 0)) for _, entity_counts in lines]
+                for stratum, lines in self.lines.items() if lines
+            }
+            checked_total = 0.0
+            invalid_total = 0.0
+            for stratum, counts in stratum_counts.items():
+                checked_total += self.stratum_sizes[stratum] * sum(checked for checked, _ in counts) / len(counts)
+                invalid_total += self.stratum_sizes[stratum] * sum(invalid for _, invalid in counts) / len(counts)
+            if not checked_total:
+                continue
+            rate = invalid_total / checked_total
+            variance = 0.0
+            for stratum, counts in stratum_counts.items():
+                if len(counts) < 2:
+                    continue
+                residuals = [invalid - rate * checked for checked, invalid in counts]
+                mean_residual = sum(residuals) / len(residuals)
+                residual_variance = sum((residual - mean_residual) ** 2 for residual in residuals) / (len(residuals) - 1)
+                stratum_size = self.stratum_sizes[stratum]
+                variance += stratum_size ** 2 * (1 - len(counts) / stratum_size) * residual_variance / len(counts)
+            variance /= checked_total ** 2
+            # the sample of entities is a cluster sample of lines, its size scales like the entities checked per line
+            sampled_checked = sum(checked for counts in stratum_counts.values() for checked, _ in counts)
+            size = effective_sample_size(rate, variance, sampled_checked, sampled_checked * number_of_lines / sample_size)
+            entity_invalid_rates[entity_type] = (rate, *wilson_interval(rate, size, confidence))
+        return entity_invalid_rates
+
+    def to_dict(self, confidence: float) -> dict:
+        rate, low, high = self.invalid_line_rate(confidence)
+        return {
+            "sampled_lines": self.sample_size(),
+            "manifest_lines": sum(self.stratum_sizes.values()),
+            "strata": {stratum: {"lines": size, "sampled_lines": len(self.lines[stratum])} for stratum, size in self.stratum_sizes.items()},
+            "confidence": confidence,
+            "invalid_lines": sum(is_invalid for lines in self.lines.values() for is_invalid, _ in lines),
+            "invalid_line_rate": {"estimate": rate, "low": low, "high": high},
+            "entity_invalid_rates": {
+                entity_type: {"estimate": rate, "low": low, "high": high}
+                for entity_type, (rate, low, high) in self.entity_invalid_rates(confidence).items()
+            },
+        }
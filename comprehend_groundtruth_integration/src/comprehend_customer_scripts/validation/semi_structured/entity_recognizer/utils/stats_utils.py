@@ -0,0 +1,178 @@
+import json
+from array import array
+from typing import List
+
+
+class ValidationStats:
+    """Entity counts and format issues of the validated annotation files.
+
+    The stats of separately validated manifest lines, e.g. in other threads or processes, are merged with merge, which
+    is associative: merging the stats of the lines in manifest order gives the stats of a serial run, the same counts
+    with the annotation files and entity types in the same order. The stats are picklable.
+
+    {
+        "<annotation_file_name>": {
+            "VALID": {
+                "<entity_type>": {
+                    "VALID": <int>,
+                    "INVALID": <int>
+                }
+            },
+            "INVALID_FORMAT": <boolean>
+        }
+    }
+    """
+
+    def __init__(self):
+        self.annotations = {}
+
+    def add_annotation(self, annotation_name: str) -> dict:
+        annotation_stats = self.annotations.get(annotation_name)
+        if annotation_stats is None:
+            annotation_stats = self.annotations[annotation_name] = {"VALID": {}, "INVALID_FORMAT": False}
+        return annotation_stats
+
+    def set_invalid_format(self, annotation_name: str):
+        self.add_annotation(annotation_name)["INVALID_FORMAT"] = True
+
+    def add_entity(self, annotation_name: str, entity_type: str, valid: int = 0, invalid: int = 0):
+        """Count valid and invalid entities of a type, with no count the type is listed for the annotation."""
+        entity_types = self.add_annotation(annotation_name)["VALID"]
+        entity_stats = entity_types.get(entity_type)
+        if entity_stats is None:
+            entity_stats = entity_types[entity_type] = {"VALID": 0, "INVALID": 0}
+        entity_stats["VALID"] += valid
+        entity_stats["INVALID"] += invalid
+
+    def merge(self, other: "ValidationStats"):
+        """Add the stats of the lines validated after these ones."""
+        for annotation_name, annotation_stats in other.annotations.items():
+            if annotation_stats["INVALID_FORMAT"]:
+                self.set_invalid_format(annotation_name)
+            else:
+                self.add_annotation(annotation_name)
+            for entity_type, entity_stats in annotation_stats["VALID"].items():
+                self.add_entity(annotation_name, entity_type, valid=entity_stats["VALID"], invalid=entity_stats["INVALID"])
+
+    def to_dict(self) -> dict:
+        return self.annotations
+
+    @classmethod
+    def from_dict(cls, annotations: dict) -> "ValidationStats":
+        stats = cls()
+        stats.annotations = annotations
+        return stats
+
+
+class StatsAggregator:
+    """Dataset stats of the ValidationStats of all the manifest lines, in memory bounded by the files with issues.
+
+    The entity types are interned to ids in the order they are first seen, and the dataset counts are arrays indexed
+    by id. The per file counts, an array of (entity type id, valid, invalid) triples, are kept for the files with a
+    format issue or an invalid entity, and for the files without issues until there are more than max_clean_files of
+    them: their counts are then dropped and only the files with issues are listed. Every added file is also written to
+    the JSON Lines file_stats_file when one is given, so the per file counts of all the files are kept on disk.
+    """
+
+    def __init__(self, max_clean_files: int = None, file_stats_file=None):
+        self.max_clean_files = max_clean_files
+        self.file_stats_file = file_stats_file
+        self.entity_type_ids = {}
+        self.valid_counts = array("Q")
+        self.invalid_counts = array("Q")
+        # annotation file name -> [has a format issue, has an invalid entity, (entity type id, valid, invalid) triples]
+        self.files = {}
+        self.number_of_clean_files = 0
+        self.number_of_unlisted_files = 0
+        self.clean_files_dropped = False
+
+    def _entity_type_id(self, entity_type: str) -> int:
+        entity_type_id = self.entity_type_ids.get(entity_type)
+        if entity_type_id is None:
+            entity_type_id = self.entity_type_ids[entity_type] = len(self.entity_type_ids)
+            self.valid_counts.append(0)
+            self.invalid_counts.append(0)
+        return entity_type_id
+
+    def add(self, stats: ValidationStats):
+        """Add the stats of the next manifest line."""
+        for annotation_name, annotation_stats in stats.annotations.items():
+            if self.file_stats_file is not None:
+                self.file_stats_file.write(json.dumps({"annotation": annotation_name, **annotation_stats}) + "\n")
+            file_stats = self.files.get(annotation_name)
+            if file_stats is None:
+                if self.clean_files_dropped and not self._has_issues(annotation_stats):
+                    self.number_of_unlisted_files += 1
+                    self._add_counts(annotation_stats, None)
+                    continue
+                file_stats = self.files[annotation_name] = [False, False, array("Q")]
+                self.number_of_clean_files += 1
+            was_clean = not (file_stats[0] or file_stats[1])
+            self._add_counts(annotation_stats, file_stats)
+            if was_clean and (file_stats[0] or file_stats[1]):
+                self.number_of_clean_files -= 1
+        if self.max_clean_files is not None and self.number_of_clean_files > self.max_clean_files:
+            self._drop_clean_files()
+
+    @staticmethod
+    def _has_issues(annotation_stats: dict) -> bool:
+        return annotation_stats["INVALID_FORMAT"] or any(entity_stats["INVALID"] for entity_stats in annotation_stats["VALID"].values())
+
+    def _add_counts(self, annotation_stats: dict, file_stats: list):
+        if file_stats is not None and annotation_stats["INVALID_FORMAT"]:
+            file_stats[0] = True
+        for entity_type, entity_stats in annotation_stats["VALID"].items():
+            entity_type_id = self._entity_type_id(entity_type)
+            self.valid_counts[entity_type_id] += entity_stats["VALID"]
+            self.invalid_counts[entity_type_id] += entity_stats["INVALID"]
+            if file_stats is None:
+                continue
+            if entity_stats["INVALID"]:
+                file_stats[1] = True
+            counts = file_stats[2]
+            for position in range(0, len(counts), 3):
+                if counts[position] == entity_type_id:
+                    counts[position + 1] += entity_stats["VALID"]
+                    counts[position + 2] += entity_stats["INVALID"]
+                    break
+            else:
+                counts.extend((entity_type_id, entity_stats["VALID"], entity_stats["INVALID"]))
+
+    def _drop_clean_files(self):
+        self.files = {annotation_name: file_stats for annotation_name, file_stats in self.files.items() if file_stats[0] or file_stats[1]}
+        self.number_of_unlisted_files += self.number_of_clean_files
+        self.number_of_clean_files = 0
+        self.clean_files_dropped = True
+
+    def entity_stats(self) -> dict:
+        return {
+            entity_type: {"VALID": self.valid_counts[entity_type_id], "INVALID": self.invalid_counts[entity_type_id]}
+            for entity_type, entity_type_id in self.entity_type_ids.items()
+        }
+
+    def files_with_format_issues(self) -> List[str]:
+        return [annotation_name for annotation_name, file_stats in self.files.items() if file_stats[0]]
+
+    def files_containing_invalid_entities(self) -> dict:
+        """Get the files with invalid entities of each entity type."""
+        entity_type_names = list(self.entity_type_ids)
+        files_containing_invalid_entities = {}
+        for annotation_name, file_stats in self.files.items():
+            counts = file_stats[2]
+            for position in range(0, len(counts), 3):
+                if counts[position + 2]:
+                    files_containing_invalid_entities.setdefault(entity_type_names[counts[position]], {})[annotation_name] = 1
+        return files_containing_invalid_entities
+
+    def file_entity_stats(self) -> dict:
+        """Get the entity counts of the files kept, the files with issues once the files without issues are dropped."""
+        entity_type_names = list(self.entity_type_ids)
+        file_entity_stats = {}
+        for annotation_name, file_stats in self.files.items():
+            counts = file_stats[2]
+            if counts:
+                file_entity_stats[annotation_name] = {
+                    entity_type_names[counts[position]]: {"VALID": counts[position + 1], "INVALID": counts[position + 2]}
+                    for position in range(0, len(counts), 3)
+                }
+        return file_entity_stats
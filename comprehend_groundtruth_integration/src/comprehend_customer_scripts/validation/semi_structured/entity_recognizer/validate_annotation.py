@@ -5,7 +5,8 @@ import os
 
 from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.annotation_utils import is_valid_annotation
 from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.log_utils import log_stats
-from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.s3_utils import get_object_content
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.s3_utils import get_object_bytes
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.stats_utils import StatsAggregator, ValidationStats
 
 
 def main():
@@ -20,18 +21,18 @@ def main():
     s3_client = boto3.client("s3")
     if annotation_s3_ref is not None:
         annotation_s3_ref = annotation_s3_ref.rstrip("/")
-        annotation_content = get_object_content(s3_client=s3_client, ref=annotation_s3_ref)
+        annotation_content = get_object_bytes(s3_client=s3_client, ref=annotation_s3_ref)
         annotation_name = os.path.basename(annotation_s3_ref)
     elif annotation_local_ref is not None:
         annotation_local_ref = annotation_local_ref.rstrip(os.sep)
-        with open(annotation_local_ref, "r", encoding="utf-8", errors="strict") as manifest_file:
+        with open(annotation_local_ref, "rb") as manifest_file:
             annotation_content = manifest_file.read()
         annotation_name = os.path.basename(annotation_local_ref)
     else:
         logging.error(f"Must provide either annotation-s3-ref or annotation-local-ref.")
         return
 
-    stats = {}
+    stats = ValidationStats()
     if not is_valid_annotation(
         annotation_content=annotation_content,
         annotation_name=annotation_name,
@@ -40,7 +41,9 @@ def main():
         logging.error("Validation failed.")
         return
 
-    log_stats(stats=stats)
+    aggregator = StatsAggregator()
+    aggregator.add(stats)
+    log_stats(stats=aggregator)
 
 
 if __name__ == "__main__":
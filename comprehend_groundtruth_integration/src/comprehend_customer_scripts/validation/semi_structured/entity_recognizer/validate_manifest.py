@@ -3,40 +3,98 @@ import boto3
 import json
 import logging
 import os
+import sqlite3
 import time
 import traceback
+from botocore.config import Config
+from contextlib import nullcontext
 
 from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.annotation_utils import is_valid_annotation
-from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.log_utils import log_stats
-from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.s3_utils import get_object_content, s3_file_exists
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.cache_utils import CACHE_FILENAME, DEFAULT_MAX_AGE_DAYS, DEFAULT_MAX_ENTRIES, ValidationCache
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.concurrency_utils import line_output, ordered_concurrent_map, ordered_process_map, PROCESS_BATCH_SIZE
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.log_utils import log_sample_estimates, log_stats, record_logs, replay_logs
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.manifest_utils import ManifestIndex
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.metrics_utils import count, enable_metrics, profiled, take_metrics, timed, ValidationMetrics
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.s3_utils import get_object_bytes, get_object_etag, iter_object_lines, s3_file_exists, S3ObjectIndex
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.sampling_utils import annotation_prefix, ManifestSampler, SampleEstimates
+from comprehend_customer_scripts.validation.semi_structured.entity_recognizer.utils.stats_utils import StatsAggregator, ValidationStats
 
+# number of annotation files without issues listed in the stats, above it only the files with issues are listed
+DEFAULT_MAX_LISTED_CLEAN_FILES = 100000
+DEFAULT_SAMPLE_CONFIDENCE = 0.95
+# settings of the manifest lines validated by a worker process, set by init_worker_process
+_worker_settings = {}
 
-def is_valid_annotation_ref(s3_client, ref: str, stats: dict = {}, fail_on_invalid: bool = True, is_local: bool = False):
-    """Validate an annotation S3 reference."""
+
+def annotation_version(s3_client, ref: str, is_local: bool, object_index: S3ObjectIndex = None):
+    """Get the version of an annotation, the ETag of an S3 object or the modification time and size of a local file."""
     if is_local:
-        with open(ref, "r", encoding="utf-8", errors="strict") as annotation_file:
-            annotation_content = annotation_file.read()
+        status = os.stat(ref)
+        return f"{status.st_mtime_ns}-{status.st_size}"
+    elif object_index is not None:
+        return object_index.get_object_info(ref)[1]
     else:
-        annotation_content = get_object_content(s3_client=s3_client, ref=ref)
-    return is_valid_annotation(
-        annotation_content=annotation_content,
-        annotation_name=os.path.basename(ref),
-        stats=stats,
-        fail_on_invalid=fail_on_invalid,
-    )
+        return get_object_etag(s3_client=s3_client, ref=ref)
 
 
-def file_exists(s3_client, ref: str, is_local: bool):
+def is_valid_annotation_ref(
+    s3_client, ref: str, stats: ValidationStats = None, fail_on_invalid: bool = True, is_local: bool = False,
+    object_index: S3ObjectIndex = None, cache: ValidationCache = None
+):
+    """Validate an annotation S3 reference."""
+    if stats is None:
+        stats = ValidationStats()
+    if cache is not None:
+        # a cached annotation is neither read nor validated, its messages are logged again
+        with timed("cache_lookup"):
+            version = annotation_version(s3_client=s3_client, ref=ref, is_local=is_local, object_index=object_index)
+            cached_result = cache.get(ref=ref, version=version, fail_on_invalid=fail_on_invalid)
+        if cached_result is not None:
+            count("cache_hits")
+            is_valid, annotation_stats, logs = cached_result
+            replay_logs(logs)
+            stats.merge(annotation_stats)
+            return is_valid
+        count("cache_misses")
+    with timed("annotation_fetch"):
+        if is_local:
+            with open(ref, "rb") as annotation_file:
+                annotation_content = annotation_file.read()
+        else:
+            annotation_content = get_object_bytes(s3_client=s3_client, ref=ref)
+    count("annotations_fetched")
+    count("bytes_fetched", len(annotation_content))
+    # with the cache, the stats and messages of the annotation are kept apart to be cached
+    annotation_stats = ValidationStats() if cache is not None else stats
+    with record_logs() if cache is not None else nullcontext() as logs, profiled(os.path.basename(ref)):
+        is_valid = is_valid_annotation(
+            annotation_content=annotation_content,
+            annotation_name=os.path.basename(ref),
+            stats=annotation_stats,
+            fail_on_invalid=fail_on_invalid,
+        )
+    if cache is not None:
+        cache.put(ref=ref, version=version, fail_on_invalid=fail_on_invalid, is_valid=is_valid, stats=annotation_stats, logs=logs)
+        stats.merge(annotation_stats)
+    return is_valid
+
+
+def file_exists(s3_client, ref: str, is_local: bool, object_index: S3ObjectIndex = None):
     if is_local:
         return os.path.exists(ref)
+    elif object_index is not None:
+        return object_index.exists(ref)
     else:
         return s3_file_exists(s3_client=s3_client, ref=ref)
 
 
 def is_valid_manifest_line(
-    s3_client, line: str, stats: dict = {}, fail_on_invalid: bool = True, documents_local_ref=None, annotations_local_ref=None
+    s3_client, line: str, stats: ValidationStats = None, fail_on_invalid: bool = True, documents_local_ref=None, annotations_local_ref=None,
+    object_index: S3ObjectIndex = None, cache: ValidationCache = None
 ):
     """Validate a single line in the custom EntityRecognizer manifest file."""
+    if stats is None:
+        stats = ValidationStats()
     is_local = bool(documents_local_ref and annotations_local_ref)
     try:
         obj = json.loads(line)
@@ -63,12 +121,15 @@ def is_valid_manifest_line(
             logging.info(f"Local annotation path: {annotation_ref}")
 
         return source_ref and annotation_ref and \
-            file_exists(s3_client=s3_client, ref=source_ref, is_local=is_local) and \
-            file_exists(s3_client=s3_client, ref=annotation_ref, is_local=is_local) and \
-            is_valid_annotation_ref(s3_client=s3_client, ref=annotation_ref, stats=stats, fail_on_invalid=fail_on_invalid, is_local=is_local)
+            file_exists(s3_client=s3_client, ref=source_ref, is_local=is_local, object_index=object_index) and \
+            file_exists(s3_client=s3_client, ref=annotation_ref, is_local=is_local, object_index=object_index) and \
+            is_valid_annotation_ref(
+                s3_client=s3_client, ref=annotation_ref, stats=stats, fail_on_invalid=fail_on_invalid, is_local=is_local,
+                object_index=object_index, cache=cache
+            )
     except Exception as e:
         logging.error(f"Failed to validate manifest line due to {e}.")
-        traceback.print_tb(e.__traceback__)
+        traceback.print_tb(e.__traceback__, file=line_output())
 
     if fail_on_invalid:
         return False
@@ -76,6 +137,73 @@ def is_valid_manifest_line(
         return True
 
 
+def init_worker_process(
+    documents_local_ref: str, annotations_local_ref: str, fail_on_invalid: bool, cache_file: str = None, profile_slowest: int = None
+):
+    """Set the settings of the manifest lines validated by this worker process, with a read only cache.
+
+    The metrics are recorded when profile_slowest is not None.
+    """
+    _worker_settings.update(
+        documents_local_ref=documents_local_ref, annotations_local_ref=annotations_local_ref, fail_on_invalid=fail_on_invalid,
+        cache=ValidationCache(filename=cache_file, read_only=True) if cache_file else None,
+    )
+    enable_metrics(ValidationMetrics(profile_slowest=profile_slowest) if profile_slowest is not None else None)
+
+
+def validate_local_line(manifest_line: str):
+    """Validate a manifest line with local documents and annotations in a worker process.
+
+    The new results and hits of the cache and the metrics are returned with the stats of the line, the main process
+    writes and merges them.
+    """
+    line_stats = ValidationStats()
+    cache = _worker_settings["cache"]
+    with timed("manifest_line"):
+        is_valid = is_valid_manifest_line(
+            s3_client=None, line=manifest_line, stats=line_stats, fail_on_invalid=_worker_settings["fail_on_invalid"],
+            documents_local_ref=_worker_settings["documents_local_ref"], annotations_local_ref=_worker_settings["annotations_local_ref"],
+            cache=cache
+        )
+    return is_valid, line_stats, cache.take_updates() if cache is not None else None, take_metrics()
+
+
+def write_reports(
+    args, metrics: ValidationMetrics, stats: StatsAggregator, elapsed_seconds: float, failed_line: int = None,
+    sample_estimates: SampleEstimates = None, escalated: bool = False
+):
+    """Write the JSON report, the Prometheus metrics and the profiles of the slowest annotations that were asked for."""
+    profiles = metrics.write_profiles(args.profile_output) if args.profile_slowest else []
+    if args.report_output:
+        report = {
+            "manifest": args.manifest_s3_ref or args.manifest_local_ref,
+            "result": "failed" if failed_line is not None else "passed",
+            "failed_at_line": failed_line,
+            "elapsed_seconds": elapsed_seconds,
+            **metrics.report(),
+            "profiles": profiles,
+            "annotation_files_with_format_issues": stats.files_with_format_issues(),
+            "annotation_files_containing_invalid_entities": stats.files_containing_invalid_entities(),
+            "entity_stats": stats.entity_stats(),
+        }
+        if sample_estimates is not None:
+            report["sample"] = {**sample_estimates.to_dict(args.sample_confidence), "escalated_to_full_run": escalated}
+        with open(args.report_output, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+    if args.prometheus_output:
+        gauges = {
+            "duration_seconds": elapsed_seconds,
+            "failed": int(failed_line is not None),
+            "last_run_timestamp_seconds": time.time(),
+            "annotation_files_with_format_issues": len(stats.files_with_format_issues()),
+            "invalid_entities": sum(stats.invalid_counts),
+        }
+        if sample_estimates is not None:
+            gauges["sample_estimated_invalid_line_rate"] = sample_estimates.invalid_line_rate(args.sample_confidence)[0]
+            gauges["sample_escalated_to_full_run"] = int(escalated)
+        metrics.write_prometheus(args.prometheus_output, gauges=gauges)
+
+
 def main():
     start_time = time.time()
     parser = argparse.ArgumentParser()
@@ -84,8 +212,43 @@ def main():
     parser.add_argument("--documents-local-ref", required=False, type=str, help="Local reference to document files. Usage: --documents-local-ref /local/path/to/documents")
     parser.add_argument("--annotations-local-ref", required=False, type=str, help="Local reference to annotation files. Usage: --annotations-local-ref /local/path/to/annotations")
     parser.add_argument("--fail-on-invalid", action='store_true', help="Fail validation on invalid manifest line or annotation file. Usage: --fail-on-invalid")
-    
+    parser.add_argument("--max-concurrency", type=int, default=16, help="Number of manifest lines validated at the same time, 1 validates them one at a time. Usage: --max-concurrency 32")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes validating the manifest lines with --documents-local-ref and --annotations-local-ref, instead of threads. Usage: --processes 32")
+    parser.add_argument("--max-in-flight", type=int, required=False, help=f"Number of manifest lines read ahead of the first line not validated yet, 4 times --max-concurrency, or 4 batches of {PROCESS_BATCH_SIZE} lines per process with --processes, by default. Usage: --max-in-flight 256")
+    parser.add_argument("--max-attempts", type=int, default=5, help="Number of attempts of an S3 request, retried with exponential backoff on throttling and transient errors. Usage: --max-attempts 10")
+    parser.add_argument("--no-prefix-listing", action="store_true", help="Check every source and annotation S3 object with its own listing instead of listing their folders once. Usage: --no-prefix-listing")
+    parser.add_argument("--no-cache", action="store_true", help="Validate every annotation instead of reusing the results of the previous runs for the unchanged ones. Usage: --no-cache")
+    parser.add_argument("--cache-file", type=str, default=CACHE_FILENAME, help=f"SQLite file of the cached annotation validation results, {CACHE_FILENAME} by default. Usage: --cache-file /local/path/to/cache.sqlite3")
+    parser.add_argument("--cache-max-entries", type=int, default=DEFAULT_MAX_ENTRIES, help=f"Number of cached results kept, the least recently used ones are evicted, {DEFAULT_MAX_ENTRIES} by default. Usage: --cache-max-entries 100000")
+    parser.add_argument("--cache-max-age-days", type=float, default=DEFAULT_MAX_AGE_DAYS, help=f"Days after which a cached result not used is evicted, {DEFAULT_MAX_AGE_DAYS} by default. Usage: --cache-max-age-days 7")
+    parser.add_argument("--max-listed-clean-files", type=int, default=DEFAULT_MAX_LISTED_CLEAN_FILES, help=f"Number of annotation files without issues listed in the ANNOTATION FILE AGGREGATE STATS, above it only the files with issues are listed and kept in memory, {DEFAULT_MAX_LISTED_CLEAN_FILES} by default. Usage: --max-listed-clean-files 1000")
+    parser.add_argument("--file-stats-output", required=False, type=str, help="JSON Lines file where the stats of every annotation file are written, one line per manifest line. Usage: --file-stats-output /local/path/to/file_stats.jsonl")
+    parser.add_argument("--report-output", required=False, type=str, help="JSON file where the report of the run is written, with the latency histograms of the validation phases, the counts of lines, objects, bytes and entities, and the dataset stats. Usage: --report-output /local/path/to/report.json")
+    parser.add_argument("--prometheus-output", required=False, type=str, help="File where the metrics of the run are written in the Prometheus text format, e.g. in the directory of the node exporter textfile collector. Usage: --prometheus-output /var/lib/node_exporter/manifest_validation.prom")
+    parser.add_argument("--profile-slowest", type=int, default=0, help="Number of slowest annotations whose validation is profiled with cProfile, written to --profile-output. Usage: --profile-slowest 10")
+    parser.add_argument("--profile-output", required=False, type=str, help="Directory where the profiles of the slowest annotations are written, readable with pstats. Usage: --profile-output /local/path/to/profiles")
+    parser.add_argument("--sample", type=int, required=False, help="Number of manifest lines sampled at random and validated instead of all the lines, to estimate the invalid rates of the manifest. Usage: --sample 1000")
+    parser.add_argument("--sample-by", choices=["line", "prefix"], default="line", help="Sample the lines uniformly, or stratified by the folder of their annotation-ref with a share of the sample proportional to its number of lines. Usage: --sample-by prefix")
+    parser.add_argument("--sample-confidence", type=float, default=DEFAULT_SAMPLE_CONFIDENCE, help=f"Confidence level of the intervals of the estimated invalid rates, {DEFAULT_SAMPLE_CONFIDENCE} by default. Usage: --sample-confidence 0.99")
+    parser.add_argument("--sample-escalation-threshold", type=float, default=0.0, help="Estimated invalid manifest line rate above which all the lines are validated after the sample, 0 by default: any invalid sampled line. Usage: --sample-escalation-threshold 0.01")
+    parser.add_argument("--sample-seed", type=int, required=False, help="Seed of the random sample, for a reproducible sample. Usage: --sample-seed 42")
+    parser.add_argument("--s3-endpoint-url", required=False, type=str, help="Endpoint of an S3 compatible service, e.g. a local S3 stand-in. Usage: --s3-endpoint-url http://localhost:9000")
+
     args = parser.parse_args()
+    processes = max(args.processes, 1)
+    if processes > 1 and not (args.documents_local_ref and args.annotations_local_ref):
+        parser.error("--processes requires --documents-local-ref and --annotations-local-ref")
+    if args.profile_slowest and not args.profile_output:
+        parser.error("--profile-slowest requires --profile-output")
+    if args.sample is not None and args.sample < 1:
+        parser.error("--sample must be at least 1")
+    if not 0 < args.sample_confidence < 1:
+        parser.error("--sample-confidence must be between 0 and 1")
+    # the metrics are only recorded when they are written
+    metrics = None
+    if args.report_output or args.prometheus_output or args.profile_slowest:
+        metrics = ValidationMetrics(profile_slowest=max(args.profile_slowest, 0))
+    enable_metrics(metrics)
 
     manifest_s3_ref = args.manifest_s3_ref
     manifest_local_ref = args.manifest_local_ref
@@ -93,39 +256,122 @@ def main():
     annotations_local_ref = args.annotations_local_ref
     fail_on_invalid = bool(args.fail_on_invalid)
 
-    s3_client = boto3.client("s3")
+    max_concurrency = max(args.max_concurrency, 1)
+    max_in_flight = max(args.max_in_flight or 4 * (processes * PROCESS_BATCH_SIZE if processes > 1 else max_concurrency), 1)
+
+    # one client is shared by the worker threads, with a connection per thread
+    s3_client = boto3.client(
+        "s3",
+        endpoint_url=args.s3_endpoint_url,
+        config=Config(max_pool_connections=max(max_concurrency, 10), retries={"max_attempts": args.max_attempts, "mode": "standard"}),
+    )
+    # the S3 documents and annotations are looked up in one listing of their folders
+    object_index = None if args.no_prefix_listing else S3ObjectIndex(s3_client)
+    manifest_index = None
     if manifest_s3_ref is not None:
         manifest_s3_ref = manifest_s3_ref.rstrip("/")
-        manifest_content = get_object_content(s3_client=s3_client, ref=manifest_s3_ref)
     elif manifest_local_ref is not None:
         manifest_local_ref = manifest_local_ref.rstrip(os.sep)
-        with open(manifest_local_ref, "r", encoding="utf-8", errors="strict") as manifest_file:
-            manifest_content = manifest_file.read()
+        # the local manifest is memory mapped and read line by line through its line offset index
+        manifest_index = ManifestIndex(manifest_local_ref)
     else:
         logging.error(f"Must provide either manifest-s3-ref or manifest-local-ref.")
         return
+    # the results of the annotations unchanged since a previous run are reused
+    cache = None
+    if not args.no_cache:
+        try:
+            cache = ValidationCache(filename=args.cache_file, max_entries=args.cache_max_entries, max_age_days=args.cache_max_age_days)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f"Validating without the cache {args.cache_file} due to {e}.")
 
-    """
-    {
-        "<annotation_file_name>": {
-            "VALID": {
-                "<entity_type>": {
-                    "VALID": <int>,
-                    "INVALID": <int>
-                }
-            },
-            "INVALID_FORMAT": <boolean>
-        }
-    }
-    """
-    stats = {}
-    for i, manifest_line in enumerate(manifest_content.splitlines()):
-        if not is_valid_manifest_line(
-            s3_client=s3_client, line=manifest_line, stats=stats, fail_on_invalid=fail_on_invalid,
-            documents_local_ref=documents_local_ref, annotations_local_ref=annotations_local_ref
-        ):
-            logging.error(f"Failed validation at line {i + 1}: {manifest_line}")
-            return
+    def read_manifest_lines():
+        if manifest_index is not None:
+            return (line.decode("utf-8") for line in manifest_index.iter_lines())
+        # the S3 manifest is validated line by line while it is downloaded
+        return (line.decode("utf-8") for line in iter_object_lines(s3_client=s3_client, ref=manifest_s3_ref, max_attempts=args.max_attempts))
+
+    def validate_line(manifest_line: str, fail_on_invalid: bool):
+        # every line collects its own stats, merged in manifest order
+        line_stats = ValidationStats()
+        with timed("manifest_line"):
+            is_valid = is_valid_manifest_line(
+                s3_client=s3_client, line=manifest_line, stats=line_stats, fail_on_invalid=fail_on_invalid,
+                documents_local_ref=documents_local_ref, annotations_local_ref=annotations_local_ref, object_index=object_index,
+                cache=cache
+            )
+        return is_valid, line_stats, None, None
+
+    def validate_lines(manifest_lines, fail_on_invalid: bool):
+        """Validate the lines in worker threads or processes, yield the (line, result) in manifest order."""
+        if processes > 1:
+            return ordered_process_map(
+                validate_local_line, manifest_lines, processes=processes, max_in_flight=max_in_flight, initializer=init_worker_process,
+                initargs=(documents_local_ref, annotations_local_ref, fail_on_invalid, cache.filename if cache is not None else None,
+                          metrics.profile_slowest if metrics is not None else None)
+            )
+        return ordered_concurrent_map(
+            lambda manifest_line: validate_line(manifest_line, fail_on_invalid), manifest_lines, max_workers=max_concurrency,
+            max_in_flight=max_in_flight
+        )
+
+    def add_line_results(stats: StatsAggregator, line_stats: ValidationStats, cache_updates, line_metrics: ValidationMetrics):
+        count("manifest_lines")
+        stats.add(line_stats)
+        if cache_updates is not None:
+            cache.add_updates(cache_updates)
+        if line_metrics is not None:
+            metrics.merge(line_metrics)
+
+    file_stats_file = open(args.file_stats_output, "w", encoding="utf-8") if args.file_stats_output else None
+    stats = StatsAggregator(max_clean_files=args.max_listed_clean_files, file_stats_file=file_stats_file)
+    failed_line = None
+    sample_estimates = None
+    escalated = False
+    try:
+        if args.sample is not None:
+            # the lines are read once to sample them, e.g. while the S3 manifest is downloaded, only the sample is kept
+            sampler = ManifestSampler(args.sample, stratify=annotation_prefix if args.sample_by == "prefix" else None, seed=args.sample_seed)
+            for line_number, manifest_line in enumerate(read_manifest_lines(), 1):
+                sampler.add(line_number, manifest_line)
+            sampled_lines = sampler.sample()
+            sample_estimates = SampleEstimates(sampler.stratum_sizes)
+            # the sampled lines are validated to the end, so their invalid entities are all counted
+            validated_lines = validate_lines((manifest_line for _, _, manifest_line in sampled_lines), fail_on_invalid=False)
+            for (_, stratum, _), (_, (is_valid, line_stats, cache_updates, line_metrics)) in zip(sampled_lines, validated_lines):
+                add_line_results(stats, line_stats, cache_updates, line_metrics)
+                sample_estimates.add(stratum, is_valid, line_stats)
+            log_sample_estimates(sample_estimates, args.sample_confidence)
+            escalated = sample_estimates.invalid_line_rate(args.sample_confidence)[0] > args.sample_escalation_threshold
+            if escalated:
+                logging.warning(f"The estimated invalid manifest line rate is above {args.sample_escalation_threshold:.4%}, validating all the manifest lines.")
+                if file_stats_file is not None:
+                    file_stats_file.seek(0)
+                    file_stats_file.truncate()
+                stats = StatsAggregator(max_clean_files=args.max_listed_clean_files, file_stats_file=file_stats_file)
+        if args.sample is None or escalated:
+            validated_lines = validate_lines(read_manifest_lines(), fail_on_invalid=fail_on_invalid)
+            for i, (manifest_line, (is_valid, line_stats, cache_updates, line_metrics)) in enumerate(validated_lines):
+                add_line_results(stats, line_stats, cache_updates, line_metrics)
+                if not is_valid:
+                    validated_lines.close()
+                    logging.error(f"Failed validation at line {i + 1}: {manifest_line}")
+                    failed_line = i + 1
+                    break
+    finally:
+        if manifest_index is not None:
+            manifest_index.close()
+        if cache is not None:
+            cache.close()
+        if file_stats_file is not None:
+            file_stats_file.close()
+    if metrics is not None:
+        write_reports(
+            args, metrics=metrics, stats=stats, elapsed_seconds=time.time() - start_time, failed_line=failed_line,
+            sample_estimates=sample_estimates, escalated=escalated
+        )
+    if failed_line is not None:
+        return
     log_stats(stats=stats)
     logging.info(f"Processing took {time.time() - start_time} seconds")
 